@@ -21,210 +21,557 @@ import sys
 import os
 import base64
 import json
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Optional
 import requests
+from requests.adapters import HTTPAdapter
 import urllib3
+from hostlist import expand_hostlist, BadHostlist
+from utils.utils.ini import Ini
+from utils.utils.token import Token
 
 urllib3.disable_warnings()
 
 HTTP_USER = ""
 HTTP_PASSWORD = ""
 HOST = ""
+MAX_WORKERS = 8
+DEFAULT_HOST_WORKERS = 32
+LUNA_INI = '/trinity/local/luna/utils/config/luna.ini'
+CACHE_DIR = os.environ.get("BOOTUTIL_CACHE", os.path.expanduser("~/.cache/luna/bootutil"))
 
+SESSION = requests.Session()
+SESSION.verify = False
 
-def redfish_get(url):
+
+def mount_session(workers: int) -> None:
     """
-    Get JSON data at the specified Redfish URL and return this data in the form
-    of a Python dictionary.
+    Size the connection pools of the shared session for the number of workers.
+    Every BMC gets its own keep-alive pool, kept for as many hosts as there are workers.
     """
-    global HTTP_USER, HTTP_PASSWORD
-    auth = "Basic " + base64.b64encode((HTTP_USER + ":" + HTTP_PASSWORD).encode()).decode()
-    headers = {"Authorization": auth}
-    response = requests.get(url, headers=headers, verify=False, timeout=5)
-    redfish_data = json.loads(response.text)
-    return redfish_data
+    adapter = HTTPAdapter(pool_connections=max(workers, 1), pool_maxsize=MAX_WORKERS)
+    SESSION.mount("https://", adapter)
+    SESSION.mount("http://", adapter)
 
 
-def redfish_patch(url, etag, json_data):
+class BootUtilError(Exception):
     """
-    Update JSON data at the specified Redfish URL and return the response code and body.
+    A host could not be handled, the message is reported per host.
     """
-    global HTTP_USER, HTTP_PASSWORD
-    auth = "Basic " + base64.b64encode((HTTP_USER + ":" + HTTP_PASSWORD).encode()).decode()
-    headers = {"Authorization": auth, "Content-Type": "application/json", "If-Match": etag}
-    response = requests.patch(url, headers=headers, data=json_data, verify=False, timeout=5)
-    return [response.status_code, response.text]
 
 
-def get_bootoption_urls(host, system):
+class RedfishCache():
     """
-    Get a list of Boot Options URLs for the specified system.
+    On-disk cache of the Redfish resources of one host, keyed by URI.
+    Every entry holds the etag and the parsed body, the file is read once per run.
     """
-    bootoptionsurl = f"{host}/redfish/v1/Systems/{system}/BootOptions"
-    bootoptions = redfish_get(bootoptionsurl)
-    members = bootoptions["Members"]
-    bootoption_urls = [m["@odata.id"] for m in members]
-    return bootoption_urls
-
 
-def get_system_urls(host):
+    def __init__(self, host: str, directory: str = CACHE_DIR) -> None:
+        self.filename = os.path.join(directory, re.sub(r"[^A-Za-z0-9_.-]", "_", bare_host(host)) + ".json")
+        self.entries = None
+        self.changed = False
+        self.lock = threading.Lock()
+
+
+    def lookup(self, uri: str) -> Optional[dict]:
+        """
+        Return the cached entry of a URI, or None.
+        """
+        with self.lock:
+            if self.entries is None:
+                try:
+                    with open(self.filename, "r", encoding="utf-8") as cache_file:
+                        self.entries = json.load(cache_file)
+                except (OSError, ValueError):
+                    self.entries = {}
+            return self.entries.get(uri)
+
+
+    def store(self, uri: str, etag: str, data: Any) -> None:
+        """
+        Remember the etag and body of a URI.
+        """
+        with self.lock:
+            self.entries[uri] = {"etag": etag, "data": data}
+            self.changed = True
+
+
+    def save(self) -> None:
+        """
+        Write the cache back when it changed. A cache that cannot be written is skipped with a warning.
+        """
+        if not self.changed:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.filename), mode=0o700, exist_ok=True)
+            temporary = f"{self.filename}.{os.getpid()}.{threading.get_ident()}"
+            with open(temporary, "w", encoding="utf-8") as cache_file:
+                json.dump(self.entries, cache_file)
+            os.replace(temporary, self.filename)
+            self.changed = False
+        except OSError as exp:
+            print(f"Warning: unable to write the Redfish cache {self.filename}: {exp}", file=sys.stderr)
+
+
+class Redfish():
     """
-    Get a list of system URLs for the specified host.
+    Redfish client for one BMC over the shared session.
+    The Basic auth header is computed once per host. With a cache, GET requests
+    revalidate the cached resource with If-None-Match.
     """
-    systems_url = f"{host}/redfish/v1/Systems"
-    systems = redfish_get(systems_url)
-    members = systems["Members"]
-    system_urls = [m["@odata.id"] for m in members]
-    return system_urls
 
-
-def get_boot_option_id_name_desc(url):
+    def __init__(self, host: str, user: str, password: str, cache: Optional[RedfishCache] = None) -> None:
+        self.host = host.rstrip("/")
+        auth = "Basic " + base64.b64encode((user + ":" + password).encode()).decode()
+        self.headers = {"Authorization": auth}
+        self.cache = cache
+
+
+    def url(self, uri: str) -> str:
+        """
+        Return the absolute URL of a Redfish URI.
+        """
+        return uri if "://" in uri else f"{self.host}{uri}"
+
+
+    def get(self, uri: str) -> Any:
+        """
+        Get JSON data at the specified Redfish URI and return this data in the form
+        of a Python dictionary.
+        """
+        headers = self.headers
+        cached = self.cache.lookup(uri) if self.cache else None
+        if cached:
+            headers = dict(self.headers)
+            headers["If-None-Match"] = cached["etag"]
+        response = SESSION.get(self.url(uri), headers=headers, timeout=5)
+        if cached and response.status_code == 304:
+            return cached["data"]
+        redfish_data = json.loads(response.text)
+        if self.cache and response.status_code == 200:
+            etag = response.headers.get("ETag")
+            if not etag and isinstance(redfish_data, dict):
+                etag = redfish_data.get("@odata.etag")
+            if etag:
+                self.cache.store(uri, etag, redfish_data)
+        return redfish_data
+
+
+    def patch(self, uri: str, etag: Optional[str], json_data: str) -> list:
+        """
+        Update JSON data at the specified Redfish URI and return the response code and body.
+        """
+        headers = dict(self.headers)
+        headers.update({"Content-Type": "application/json", "If-Match": etag})
+        response = SESSION.patch(self.url(uri), headers=headers, data=json_data, timeout=5)
+        return [response.status_code, response.text]
+
+
+    def expand_supported(self) -> bool:
+        """
+        Check if the service advertises $expand of subordinate resources.
+        """
+        try:
+            service_root = self.get("/redfish/v1")
+        except ValueError:
+            return False
+        expand = service_root.get("ProtocolFeaturesSupported", {}).get("ExpandQuery", {})
+        return bool(expand.get("NoLinks") or expand.get("ExpandAll"))
+
+
+    def get_system_urls(self) -> list:
+        """
+        Get a list of system URLs of the host.
+        """
+        systems = self.get("/redfish/v1/Systems")
+        return [m["@odata.id"] for m in systems["Members"]]
+
+
+    def get_bootoption_urls(self, system: str) -> list:
+        """
+        Get a list of Boot Options URLs for the specified system.
+        """
+        bootoptions = self.get(f"/redfish/v1/Systems/{system}/BootOptions")
+        return [m["@odata.id"] for m in bootoptions["Members"]]
+
+
+    def get_boot_option(self, uri: str) -> list:
+        """
+        Get the ID, Name and Description of the Boot Option at the specified URI.
+        """
+        return boot_option_id_name_desc(self.get(uri))
+
+
+    def get_boot_options(self, system: str, workers: int = MAX_WORKERS) -> list:
+        """
+        Get the ID, Name and Description of all Boot Options of the specified system.
+        With $expand support this is one request, otherwise the options are fetched
+        concurrently over the shared session.
+        """
+        bootoptionsurl = f"/redfish/v1/Systems/{system}/BootOptions"
+        if self.expand_supported():
+            members = self.get(f"{bootoptionsurl}?$expand=.($levels=1)")["Members"]
+            if all("Id" in m for m in members):
+                return [boot_option_id_name_desc(m) for m in members]
+            bo_urls = [m["@odata.id"] for m in members]
+        else:
+            bo_urls = self.get_bootoption_urls(system)
+        if not bo_urls:
+            return []
+        if workers <= 1:
+            return [self.get_boot_option(url) for url in bo_urls]
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(bo_urls)))) as executor:
+            return list(executor.map(self.get_boot_option, bo_urls))
+
+
+    def get_system(self, system: str) -> dict:
+        """
+        Get the System resource, which holds both the boot order and the etag.
+        """
+        return self.get(f"/redfish/v1/Systems/{system}")
+
+
+    def set_bootorder(self, system: str, etag: Optional[str], bootorder: str) -> list:
+        """
+        Set the boot order of the specified system.
+        """
+        json_data = {
+            "Boot" : {
+                "BootOrder" : bootorder
+            }
+        }
+        return self.patch(f"/redfish/v1/Systems/{system}", etag, json.dumps(json_data))
+
+
+def boot_option_id_name_desc(bootoption: dict) -> list:
     """
-    Get the ID, Name and Description of the Boot Option at the specified URL.
+    Get the ID, Name and Description of a Boot Option resource.
     """
-    global HOST
-    bootoption = redfish_get(f"{HOST}{url}")
-    boot_id = bootoption["Id"]
-    name = bootoption["Name"]
-    desc = bootoption["Description"]
-    return [boot_id, name, desc]
+    return [bootoption["Id"], bootoption["Name"], bootoption["Description"]]
 
 
-def get_bootorder(system):
+def bare_host(host: str) -> str:
     """
-    Get the boot order of the specified system.
+    Return the host name of a BMC URL, used as key for credentials.
     """
-    system_data = redfish_get(f"{HOST}/redfish/v1/Systems/{system}")
-    boot_data = system_data["Boot"]
-    bootorder = boot_data["BootOrder"]
-    return bootorder
+    return host.split("://", 1)[-1].rstrip("/")
 
 
-def get_system_etag(system):
+def expand_hosts(expression: str) -> list:
     """
-    Get the etag of the specified system.
+    Expand a hostlist of BMCs. The protocol defaults to https and may be given once in front.
     """
-    system_data = redfish_get(f"{HOST}/redfish/v1/Systems/{system}")
-    etag = system_data["@odata.etag"]
-    return etag
+    scheme = "https"
+    if "://" in expression:
+        scheme, expression = expression.split("://", 1)
+    try:
+        hosts = expand_hostlist(expression.rstrip("/"))
+    except BadHostlist:
+        hosts = [expression.rstrip("/")]
+    return [f"{scheme}://{host}" for host in hosts]
 
 
-def set_bootorder(system, etag, bootorder):
+def read_credentials(filename: str) -> dict:
+    """
+    Read a credentials file with one '<host|hostlist|*> <user> <password>' per line.
+    """
+    credentials = {}
+    try:
+        with open(filename, "r", encoding="utf-8") as credentials_file:
+            for line in credentials_file:
+                fields = line.split()
+                if len(fields) < 3 or fields[0].startswith("#"):
+                    continue
+                user, password = fields[1], " ".join(fields[2:])
+                if fields[0] == "*":
+                    credentials["*"] = (user, password)
+                    continue
+                for host in expand_hosts(fields[0]):
+                    credentials[bare_host(host)] = (user, password)
+    except OSError as exp:
+        print(f"Unable to read credentials file {filename}: {exp}", file=sys.stderr)
+        sys.exit(1)
+    return credentials
+
+
+def luna_targets(nodes: str) -> list:
+    """
+    Resolve luna node names into BMC hosts and credentials from the luna daemon.
+    """
+    conf = Ini.read_ini(ini_file=LUNA_INI)
+    token = Token.get_token(username=conf["USERNAME"], password=conf["PASSWORD"], protocol=conf["PROTOCOL"],
+                            endpoint=conf["ENDPOINT"], verify_certificate=conf["VERIFY_CERTIFICATE"])
+    base = f'{conf["PROTOCOL"]}://{conf["ENDPOINT"]}'
+    headers = {"x-access-tokens": token}
+
+    def luna_get(route: str) -> dict:
+        """
+        Return the objects of a luna config route, exiting when the daemon does not deliver them.
+        """
+        try:
+            response = SESSION.get(f"{base}/{route}", headers=headers, timeout=30,
+                                   verify=conf["VERIFY_CERTIFICATE"])
+        except requests.exceptions.RequestException as exp:
+            print(f"Unable to reach the luna daemon for {route}: {exp}", file=sys.stderr)
+            sys.exit(1)
+        if response.status_code != 200:
+            print(f"Luna daemon returned HTTP {response.status_code} for {route}", file=sys.stderr)
+            sys.exit(1)
+        try:
+            return response.json().get("config", {}).get(route.split("/")[1], {})
+        except ValueError:
+            print(f"Luna daemon returned invalid JSON for {route}", file=sys.stderr)
+            sys.exit(1)
+
+    try:
+        names = expand_hostlist(nodes)
+    except BadHostlist:
+        print(f"Invalid node list {nodes}", file=sys.stderr)
+        sys.exit(1)
+    node_config = luna_get("config/node")
+    bmcsetup = luna_get("config/bmcsetup")
+    targets = []
+    for node in names:
+        config = node_config.get(node) or {}
+        interfaces = config.get("interfaces") or []
+        address = next((i.get("ipaddress") for i in interfaces if str(i.get("interface")).upper() == "BMC"), None)
+        setup = bmcsetup.get(config.get("bmcsetup")) or {}
+        targets.append({
+            "host": f"https://{address}" if address else None,
+            "node": node,
+            "user": setup.get("username"),
+            "password": setup.get("password"),
+        })
+    return targets
+
+
+def run_host(target: dict, mode: str, bootorder: Optional[str] = None, workers: int = MAX_WORKERS,
+             use_cache: bool = True) -> dict:
     """
-    Set the boot order of the specified system.
+    Run list, get or set on one BMC and return the result as a dictionary.
+    The System resource is fetched once for both the boot order and the etag.
     """
-    url = f"{HOST}/redfish/v1/Systems/{system}"
-    json_data = {
-        "BootOrder" : bootorder
-    }
-    json_data = {
-        "Boot" : json_data
-    }
-    json_string = json.dumps(json_data)
-    result = redfish_patch(url, etag, json_string)
+    result = {"host": target.get("node") or bare_host(target["host"] or "")}
+    cache = RedfishCache(target["host"]) if use_cache and target["host"] else None
+    try:
+        if not target["host"]:
+            raise BootUtilError("no BMC address known")
+        if not target["user"] or target["password"] is None:
+            raise BootUtilError("no BMC credentials known")
+        redfish = Redfish(target["host"], target["user"], target["password"], cache)
+        sy_urls = redfish.get_system_urls()
+        if len(sy_urls) != 1:
+            raise BootUtilError(f"Expected exactly one system on {target['host']}, found {len(sy_urls)}.")
+        system = os.path.basename(sy_urls[0].rstrip("/"))
+        result["system"] = system
+
+        if mode in ["list", "get"]:
+            result["bootoptions"] = [
+                {"id": boot_id, "name": name, "description": desc}
+                for boot_id, name, desc in redfish.get_boot_options(system, workers)
+            ]
+        if mode in ["get", "set"]:
+            system_data = redfish.get_system(system)
+            if mode == "get":
+                result["bootorder"] = system_data["Boot"]["BootOrder"]
+            else:
+                code, text = redfish.set_bootorder(system, system_data["@odata.etag"], bootorder)
+                result["http_code"] = code
+                result["response"] = text
+                if not 200 <= code < 300:
+                    raise BootUtilError(f"HTTP-result: {code}")
+        result["ok"] = True
+    except (requests.exceptions.RequestException, ValueError, KeyError, BootUtilError) as exp:
+        result["ok"] = False
+        result["error"] = str(exp) if not isinstance(exp, KeyError) else f"missing {exp} in Redfish response"
+    if cache:
+        cache.save()
     return result
 
 
-MODE = ''
-DISPLAY_HELP = False
-DESIRED_BOOTORDER = ''
-
-if len(sys.argv) > 1:
-    STATE = 'option'
-    for i in range(1, len(sys.argv)):
-        arg = sys.argv[i]
-        if STATE == 'option':
-            if arg in ['-U', '--user']:
-                STATE = 'user'
-            elif arg in ['-P', '--password']:
-                STATE = 'password'
-            elif arg in ['-H', '--host']:
-                STATE = 'host'
-            elif arg == 'list':
-                MODE = 'list'
-            elif arg == 'get':
-                MODE = 'get'
-            elif arg == 'set':
-                MODE = 'set'
-                STATE = 'set'
-        elif STATE == 'user':
-            HTTP_USER = arg
-            STATE = 'option'
-        elif STATE == 'password':
-            HTTP_PASSWORD = arg
-            STATE = 'option'
-        elif STATE == 'host':
-            HOST = arg
-            STATE = 'option'
-        elif STATE == 'set':
-            DESIRED_BOOTORDER = arg.split()
-            STATE = 'option'
-else:
-    DISPLAY_HELP = True
-
-if not sys.argv[1:] or MODE == "":
-    print("Please specify a mode on the command line.", file=sys.stderr)
-    DISPLAY_HELP = True
-if not HOST:
-    print("Please specify a host on the command line.", file=sys.stderr)
-    DISPLAY_HELP = True
-if not HTTP_USER:
-    print("Please specify an HTTP user on the command line.", file=sys.stderr)
-    DISPLAY_HELP = True
-if not HTTP_PASSWORD:
-    print("Please specify an HTTP password on the command line.", file=sys.stderr)
-    DISPLAY_HELP = True
-if DISPLAY_HELP:
+def print_single(result: dict, mode: str, bootorder: str) -> None:
+    """
+    Print the result of one host in the classic bootutil layout.
+    """
+    if mode == "set" and "http_code" in result:
+        code = result["response"]
+        if result["ok"]:
+            print(f'Set boot order to "{bootorder}" successful! (HTTP-result: {code})')
+        else:
+            print(f'Set boot order to "{bootorder}" failed! (HTTP-result: {code})')
+        return
+    if not result["ok"]:
+        print(result["error"], file=sys.stderr)
+        return
+    if mode == "list":
+        print("Available boot devices:")
+        print("")
+        print("ID    |Name            |Desc")
+        print("------+----------------+------------------------------------------------------")
+        for option in result["bootoptions"]:
+            print(f"{option['id']:<6}|{option['name']:<16}|{option['description']:<58}")
+    if mode == "get":
+        descriptions = {option["id"]: option["description"] for option in result["bootoptions"]}
+        print("Current boot order:")
+        for i, bo in enumerate(result["bootorder"], start=1):
+            print(f"{i} - {bo} {descriptions.get(bo, '')}")
+
+
+def print_table(results: list, mode: str) -> None:
+    """
+    Print the results of many hosts as one table, one row per host.
+    """
+    width = max([len(result["host"]) for result in results] + [4])
+    column = {"list": "Boot options", "get": "Boot order", "set": "Result"}[mode]
+    print(f"{'Host':<{width}} |Status |{column}")
+    print(f"{'-' * width}-+-------+{'-' * 54}")
+    for result in results:
+        if not result["ok"]:
+            value = result["error"]
+        elif mode == "list":
+            value = " ".join(option["id"] for option in result["bootoptions"])
+        elif mode == "get":
+            value = " ".join(result["bootorder"])
+        else:
+            value = f"HTTP-result: {result['http_code']}"
+        print(f"{result['host']:<{width}} |{'OK' if result['ok'] else 'FAILED':<7}|{value}")
+
+
+def call_help() -> None:
+    """
+    Print the usage to stderr and exit.
+    """
     print("\nUsage: bootutil [options...] <mode>\n", file=sys.stderr)
     print("<mode> can be either:", file=sys.stderr)
     print("  list         -- list available boot options", file=sys.stderr)
     print("  get          -- get current boot order", file=sys.stderr)
     print("  set <order>  -- set current boot order\n", file=sys.stderr)
     print("Available [options...]:", file=sys.stderr)
-    print(" -H, --host      -- Redfish host. Must include protocol, e.g. https://host",
+    print(" -H, --host        -- Redfish host or hostlist of hosts. Protocol defaults to https,",
           file=sys.stderr)
-    print(" -U, --user      -- HTTP user name", file=sys.stderr)
-    print(" -P, --password  -- HTTP user password", file=sys.stderr)
+    print("                      e.g. https://host or https://node[001-100]-bmc", file=sys.stderr)
+    print(" -U, --user        -- HTTP user name", file=sys.stderr)
+    print(" -P, --password    -- HTTP user password", file=sys.stderr)
+    print(" -C, --credentials -- file with '<host|hostlist|*> <user> <password>' lines", file=sys.stderr)
+    print(" -L, --luna        -- -H is a luna node list, BMC address and credentials come from luna",
+          file=sys.stderr)
+    print(f" -w, --workers     -- number of hosts handled concurrently (default {DEFAULT_HOST_WORKERS})",
+          file=sys.stderr)
+    print(" -j, --json        -- JSON output", file=sys.stderr)
+    print(f" --no-cache        -- do not use the Redfish response cache in {CACHE_DIR}", file=sys.stderr)
     sys.exit(1)
 
-#Perform the requested task
-#Parse system and boot option URLs based on host
 
-sy_urls = get_system_urls(HOST)
-if len(sy_urls) != 1:
-    print(f"Expected exactly one system on {HOST}, found {len(sy_urls)}.", file=sys.stderr)
-    sys.exit(1)
-system = os.path.basename(sy_urls[0])
-bo_urls = get_bootoption_urls(HOST, system)
-
-if MODE == "list":
-    print("Available boot devices:")
-    print("")
-    print("ID    |Name            |Desc")
-    print("------+----------------+------------------------------------------------------")
-
-bootoption = {}
-for bo_url in bo_urls:
-    id, name, desc = get_boot_option_id_name_desc(bo_url)
-    bootoption[id] = desc
-    if MODE == "list":
-        print(f"{id:<6}|{name:<16}|{desc:<58}")
-
-#Retrieve and output the current boot order
-
-if MODE == "get":
-    print("Current boot order:")
-    bootorder = get_bootorder(system)
-    i = 1
-    for bo in bootorder:
-        print(f"{i} - {bo} {bootoption.get(bo, '')}")
-        i += 1
-
-#Set the boot order
-
-if MODE == "set":
-    etag = get_system_etag(system)
-    encode, code = set_bootorder(system, etag, DESIRED_BOOTORDER)
-    if encode>=200 and encode<300:
-        print(f'Set boot order to "{DESIRED_BOOTORDER}" successful! (HTTP-result: {code})')
+def main(argv: list) -> None:
+    """
+    The main method to initiate the script.
+    """
+    global HTTP_USER, HTTP_PASSWORD, HOST
+    mode = ''
+    display_help = False
+    desired_bootorder = ''
+    credentials_file = None
+    luna = False
+    as_json = False
+    workers = DEFAULT_HOST_WORKERS
+    use_cache = True
+
+    if argv:
+        state = 'option'
+        for arg in argv:
+            if state == 'option':
+                if arg in ['-U', '--user']:
+                    state = 'user'
+                elif arg in ['-P', '--password']:
+                    state = 'password'
+                elif arg in ['-H', '--host']:
+                    state = 'host'
+                elif arg in ['-C', '--credentials']:
+                    state = 'credentials'
+                elif arg in ['-w', '--workers']:
+                    state = 'workers'
+                elif arg in ['-L', '--luna']:
+                    luna = True
+                elif arg in ['-j', '--json']:
+                    as_json = True
+                elif arg == '--no-cache':
+                    use_cache = False
+                elif arg == 'list':
+                    mode = 'list'
+                elif arg == 'get':
+                    mode = 'get'
+                elif arg == 'set':
+                    mode = 'set'
+                    state = 'set'
+            elif state == 'user':
+                HTTP_USER = arg
+                state = 'option'
+            elif state == 'password':
+                HTTP_PASSWORD = arg
+                state = 'option'
+            elif state == 'host':
+                HOST = arg
+                state = 'option'
+            elif state == 'credentials':
+                credentials_file = arg
+                state = 'option'
+            elif state == 'workers':
+                workers = int(arg) if arg.isdigit() else DEFAULT_HOST_WORKERS
+                state = 'option'
+            elif state == 'set':
+                desired_bootorder = arg.split()
+                state = 'option'
+    else:
+        display_help = True
+
+    if not argv or mode == "":
+        print("Please specify a mode on the command line.", file=sys.stderr)
+        display_help = True
+    if not HOST:
+        print("Please specify a host on the command line.", file=sys.stderr)
+        display_help = True
+    if not HTTP_USER and not credentials_file and not luna:
+        print("Please specify an HTTP user on the command line.", file=sys.stderr)
+        display_help = True
+    if not HTTP_PASSWORD and not credentials_file and not luna:
+        print("Please specify an HTTP password on the command line.", file=sys.stderr)
+        display_help = True
+    if display_help:
+        call_help()
+
+    workers = max(workers, 1)
+    mount_session(workers)
+
+    #Resolve the hosts and their credentials
+
+    if luna:
+        targets = luna_targets(HOST)
     else:
-        print(f'Set boot order to "{DESIRED_BOOTORDER}" failed! (HTTP-result: {code})')
+        credentials = read_credentials(credentials_file) if credentials_file else {}
+        targets = []
+        for host in expand_hosts(HOST):
+            user, password = credentials.get(bare_host(host)) or credentials.get("*") or (HTTP_USER, HTTP_PASSWORD)
+            targets.append({"host": host, "user": user, "password": password})
+
+    #Perform the requested task on every host
+
+    if len(targets) == 1:
+        results = [run_host(targets[0], mode, desired_bootorder, MAX_WORKERS, use_cache)]
+    else:
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(targets)))) as executor:
+            results = list(executor.map(lambda target: run_host(target, mode, desired_bootorder, 1, use_cache),
+                                        targets))
+
+    if as_json:
+        print(json.dumps(results, indent=2))
+    elif len(results) == 1:
+        print_single(results[0], mode, desired_bootorder)
+    else:
+        print_table(results, mode)
+    sys.exit(0 if all(result["ok"] for result in results) else 1)
+
+
+# hidden at the bottom; the call for the main function...
+main(sys.argv[1:])
@@ -29,6 +29,7 @@ __email__       = "sumit.sharma@clustervision.com"
 __status__      = "Production"
 
 
+import argparse
 import getpass
 import json
 import os
@@ -39,8 +40,10 @@ import sys
 import threading
 import textwrap
 from configparser import RawConfigParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
-from time import monotonic, sleep
+from time import monotonic, sleep, time
+from typing import Any, Optional, Union
 from urllib.parse import quote, urlparse, urlunparse
 
 try:
@@ -82,6 +85,8 @@ SLURM_UNIX_SOCKET_CANDIDATES = [
 ]
 
 SLURM_FALLBACK_PORTS = [6820, 6802]
+SLURM_CACHE_TTL = 15.0
+SLURM_NODE_LINE_RE = re.compile(r'\bNodeName=(\S+).*?\bState=(\S+)')
 
 ALERTX_STATUS_PRIORITY = {
     'OK': 0,
@@ -94,6 +99,38 @@ ALERTX_RULE_CATEGORIES = {'generic', 'service', 'hardware', 'other'}
 ANSI_ESCAPE_RE = re.compile(r'\x1b\[[0-9;]*m')
 DEFAULT_OUTPUT_CHUNK_SIZE = 5
 TABLE_COLUMN_MAX_WIDTHS = [4, 9, 17, 10, 28, 24, 21]
+DEFAULT_SERVE_INTERVAL = 60.0
+MIN_REQUEST_TIMEOUT = 0.1
+METRIC_SOURCES = ['alertx', 'ipmi', 'luna', 'slurm']
+
+
+class DeadlineRetry(Retry):
+    """
+    urllib3 Retry that stops retrying and backing off once the LCluster deadline has passed.
+    """
+
+    def __init__(self, lcluster: Optional['LCluster'] = None, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self.lcluster = lcluster
+
+
+    def new(self, **kwargs: Any) -> 'DeadlineRetry':
+        retry = super().new(**kwargs)
+        retry.lcluster = self.lcluster
+        return retry
+
+
+    def is_exhausted(self) -> bool:
+        if self.lcluster is not None and self.lcluster.expired():
+            return True
+        return super().is_exhausted()
+
+
+    def get_backoff_time(self) -> float:
+        backoff = super().get_backoff_time()
+        if self.lcluster is not None:
+            backoff = min(backoff, self.lcluster.time_left(backoff))
+        return backoff
 
 
 class LCluster():
@@ -101,9 +138,11 @@ class LCluster():
     LCluster Class responsible to all Monitoring activities.
     """
 
-    def __init__(self):
+    def __init__(self, check: bool = False, deadline: Optional[float] = None) -> None:
         """
         Default variables should be here before calling any method.
+        The daemon is validated by the first real request, unless an explicit check is asked for.
+        With a deadline (seconds) every collector and HTTP call shares one monotonic time budget.
         """
         self.errors = []
         self.username = None
@@ -118,12 +157,19 @@ class LCluster():
         self.slurm_auth = None
         self.slurm_verify = None
         self.slurm_timeout = 3.0
+        self.slurm_cache = {}
+        self.slurm_cache_ttl = SLURM_CACHE_TTL
         self.ipmi_poll_interval = 1.0
         self.ipmi_max_wait = 120.0
         self.request_timeout = 5
         self.output_chunk_size = DEFAULT_OUTPUT_CHUNK_SIZE
+        self.deadline_budget = deadline
+        self.deadline = None
+        self.timed_out = set()
         self.prometheus = None
         self.prometheus_status = None
+        self.colored_cache = {}
+        self.cell_cache = {}
 
         file_check = os.path.isfile(INI_FILE)
         read_check = os.access(INI_FILE, os.R_OK)
@@ -156,8 +202,10 @@ class LCluster():
             sys.exit(1)
 
         urllib3.disable_warnings()
+        self.start_deadline()
         self.session = Session()
-        self.retries = Retry(
+        self.retries = DeadlineRetry(
+            lcluster=self,
             total=10,
             backoff_factor=0.1,
             status_forcelist=[502, 503, 504],
@@ -165,7 +213,8 @@ class LCluster():
         )
         self.session.mount('https://', HTTPAdapter(max_retries=self.retries))
         self.session.mount('http://', HTTPAdapter(max_retries=self.retries))
-        self.daemon_validation()
+        if check:
+            self.daemon_validation()
 
 
     def _extract_host(self, endpoint):
@@ -218,19 +267,72 @@ class LCluster():
         sys.exit(1)
 
 
-    def run_cmd(self, cmd=None, timeout=30):
+    def start_deadline(self) -> Optional[float]:
+        """
+        Start the time budget of a run. Does nothing without --deadline.
+        """
+        self.timed_out = set()
+        if self.deadline_budget:
+            self.deadline = monotonic() + float(self.deadline_budget)
+        return self.deadline
+
+
+    def time_left(self, default: Optional[float] = None) -> Optional[float]:
+        """
+        Return the seconds left in the budget, capped at default.
+        Without a deadline the default is returned unchanged.
+        """
+        if self.deadline is None:
+            return default
+        remaining = max(self.deadline - monotonic(), 0)
+        return remaining if default is None else min(default, remaining)
+
+
+    def expired(self) -> bool:
+        """
+        Check if the time budget of this run is used up.
+        """
+        return self.deadline is not None and monotonic() >= self.deadline
+
+
+    def request_timeout_for(self, timeout: float) -> float:
+        """
+        Return the timeout for one HTTP request, bounded by the time budget.
+        """
+        return max(self.time_left(timeout), MIN_REQUEST_TIMEOUT)
+
+
+    def mark_timeout(self, response: dict, lookup: str) -> dict:
+        """
+        Mark the values which were never collected as TIMEOUT, if lookup really timed out.
+        Values that were collected and are simply empty, like a node unknown to Slurm, stay as they are.
+        """
+        if lookup in self.timed_out:
+            for key, value in response.items():
+                if value is None:
+                    response[key] = 'TIMEOUT'
+        return response
+
+
+    def run_cmd(self, cmd: Union[str, list, None] = None, timeout: float = 30) -> tuple:
         """
         Returns: return_code, stdout, stderr, exception.
+        A list command is executed directly, without a shell.
         """
         if not cmd:
             return 255, '', '', 'Empty command'
 
+        timeout = self.time_left(timeout)
+        if timeout is not None and timeout <= 0:
+            return 124, '', '', 'Deadline expired'
+
         try:
-            proc = sp.run(cmd, shell=True, stdout=sp.PIPE, stderr=sp.PIPE, text=True, timeout=timeout, check=False)
+            proc = sp.run(cmd, shell=isinstance(cmd, str), stdout=sp.PIPE, stderr=sp.PIPE, text=True,
+                          timeout=timeout, check=False)
             return proc.returncode, proc.stdout or '', proc.stderr or '', ''
         except sp.TimeoutExpired as exp:
             return 124, exp.stdout or '', exp.stderr or '', exp
-        except sp.SubprocessError as exp:
+        except (sp.SubprocessError, OSError) as exp:
             return 255, '', '', exp
 
 
@@ -250,7 +352,7 @@ class LCluster():
         return False
 
 
-    def token(self):
+    def token(self) -> Union[str, bool]:
         """
         Fetch a valid Luna token.
         """
@@ -258,7 +360,8 @@ class LCluster():
         data = {'username': self.username, 'password': self.password}
         daemon_url = f'{self.daemon}/token'
         try:
-            call = self.session.post(url=daemon_url, json=data, stream=True, timeout=5, verify=self.security)
+            call = self.session.post(url=daemon_url, json=data, stream=True, timeout=self.request_timeout_for(5),
+                                     verify=self.security)
             if call.content:
                 data = call.json()
                 if 'token' in data:
@@ -302,70 +405,114 @@ class LCluster():
         return response
 
 
-    def post_data(self, url=None, daemon=False, payload=None):
+    def post_data(self, url: Optional[str] = None, daemon: bool = False, payload: Optional[dict] = None) -> Any:
         """
         Make a POST request.
         """
         response = None
+        if self.expired():
+            self.timed_out.add(url)
+            return response
         try:
             headers = {'x-access-tokens': self.get_token()} if daemon else None
-            response = self.session.post(url=url, json=payload if payload else None, stream=True, headers=headers, timeout=5, verify=self.security)
+            response = self.session.post(url=url, json=payload if payload else None, stream=True, headers=headers,
+                                         timeout=self.request_timeout_for(5), verify=self.security)
         except requests.exceptions.SSLError as ssl_loop_error:
             self.exit_lcluster(f'ERROR :: {ssl_loop_error}')
         except requests.exceptions.Timeout:
-            self.exit_lcluster(f'Timeout on {url}.')
+            if not self.expired():
+                self.exit_lcluster(f'Timeout on {url}.')
+            self.timed_out.add(url)
+        except requests.exceptions.ConnectionError as conn_error:
+            if not self.expired():
+                self.exit_lcluster(conn_error)
+            self.timed_out.add(url)
         except requests.exceptions.TooManyRedirects:
             self.exit_lcluster(f'Too Many Redirects on {url}.')
+        except requests.exceptions.RetryError:
+            if not self.expired():
+                self.exit_lcluster(f'Retries exhausted on {url}.')
+            self.timed_out.add(url)
         return response
 
 
-    def get_data_real(self, url=None, daemon=False, payload=None):
+    def get_data_real(self, url: Optional[str] = None, daemon: bool = False, payload: Optional[dict] = None) -> Any:
         """
         Make a GET request and return the raw response object.
         """
         response = None
+        if self.expired():
+            self.timed_out.add(url)
+            return response
         try:
             headers = {'x-access-tokens': self.get_token()} if daemon else None
-            response = self.session.get(url=url, json=payload if payload else None, stream=True, headers=headers, timeout=5, verify=self.security)
+            response = self.session.get(url=url, json=payload if payload else None, stream=True, headers=headers,
+                                        timeout=self.request_timeout_for(5), verify=self.security)
         except requests.exceptions.SSLError as ssl_loop_error:
             self.exit_lcluster(f'ERROR :: {ssl_loop_error}')
         except requests.exceptions.Timeout:
-            self.exit_lcluster(f'Timeout on {url}.')
+            if not self.expired():
+                self.exit_lcluster(f'Timeout on {url}.')
+            self.timed_out.add(url)
+        except requests.exceptions.ConnectionError as conn_error:
+            if not self.expired():
+                self.exit_lcluster(conn_error)
+            self.timed_out.add(url)
         except requests.exceptions.TooManyRedirects:
             self.exit_lcluster(f'Too Many Redirects on {url}.')
+        except requests.exceptions.RetryError:
+            if not self.expired():
+                self.exit_lcluster(f'Retries exhausted on {url}.')
+            self.timed_out.add(url)
         except requests.exceptions.RequestException:
             self.exit_lcluster(f'Request Exception on {url}.')
         return response
 
 
-    def get_data(self, url=None, daemon=False, payload=None):
+    def get_data(self, url: Optional[str] = None, daemon: bool = False, payload: Optional[dict] = None) -> Any:
         """
         Make a GET request and return JSON data.
         """
         response = None
+        if self.expired():
+            self.timed_out.add(url)
+            return response
         try:
             headers = {'x-access-tokens': self.get_token()} if daemon else None
-            call = self.session.get(url=url, json=payload if payload else None, stream=True, headers=headers, timeout=5, verify=self.security)
+            call = self.session.get(url=url, json=payload if payload else None, stream=True, headers=headers,
+                                    timeout=self.request_timeout_for(5), verify=self.security)
             response = call.json()
         except requests.exceptions.SSLError as ssl_loop_error:
             self.exit_lcluster(f'ERROR :: {ssl_loop_error}')
         except requests.exceptions.Timeout:
-            self.exit_lcluster(f'Timeout on {url}.')
+            if not self.expired():
+                self.exit_lcluster(f'Timeout on {url}.')
+            self.timed_out.add(url)
+        except requests.exceptions.ConnectionError as conn_error:
+            if not self.expired():
+                self.exit_lcluster(conn_error)
+            self.timed_out.add(url)
         except requests.exceptions.TooManyRedirects:
             self.exit_lcluster(f'Too Many Redirects on {url}.')
-        except requests.exceptions.RequestException:
-            self.exit_lcluster(f'Request Exception on {url}.')
+        except requests.exceptions.RetryError:
+            if not self.expired():
+                self.exit_lcluster(f'Retries exhausted on {url}.')
+            self.timed_out.add(url)
         except requests.exceptions.JSONDecodeError:
             self.exit_lcluster(f'Response is not JSON on {url}.')
+        except requests.exceptions.RequestException:
+            self.exit_lcluster(f'Request Exception on {url}.')
         return response
 
 
-    def health_checkup(self):
+    def get_node_inventory(self) -> tuple:
         """
-        Fetch Luna node list, then stream node health rows in chunks.
+        Fetch the Luna node list and return nodes, hostnames and Luna status.
         """
         node_url = f'{self.daemon}/config/node'
-        get_node_list = self._run_with_loader('Fetching Nodes Stats...', self.get_data, node_url, True)
+        get_node_list = self.get_data(node_url, True)
+        if not get_node_list and self.expired():
+            self.exit_lcluster(f'Deadline of {self.deadline_budget}s expired before the node list was fetched.')
         if not get_node_list:
             self.exit_lcluster(f'No Nodes available with {self.daemon}')
 
@@ -379,10 +526,22 @@ class LCluster():
             node: node_config[node].get('hostname') or node
             for node in nodes
         }
+        return nodes, node_hostname, node_status
+
+
+    def health_checkup(self) -> bool:
+        """
+        Fetch Luna node list, then stream node health rows in chunks.
+        """
+        nodes, node_hostname, node_status = self._run_with_loader('Fetching Nodes Stats...', self.get_node_inventory)
 
         alertx_state = self._run_with_loader('Fetching AlertX Status...', self.get_overview, list(node_hostname.values()))
         slurm_state = self.call_slurm(nodes)
-        widths = self._table_widths(nodes, node_hostname, node_status, alertx_state, slurm_state)
+        node_alertx = {
+            node: self._lookup_alertx_status(alertx_state, node_hostname.get(node) or node, node)
+            for node in nodes
+        }
+        widths = self._table_widths(nodes, node_hostname, node_status, node_alertx, slurm_state)
         sys.stdout.write(colored(f'Wait, Fetching IPMI Status of Nodes with {self.daemon} ...\n', 'yellow'))
         self._stream_table_start(widths)
 
@@ -403,7 +562,7 @@ class LCluster():
                     self.get_colored(row_number),
                     self.get_colored(node),
                     self.get_colored(hostname),
-                    self.get_colored(self._lookup_alertx_status(alertx_state, hostname, node)),
+                    self.get_colored(node_alertx.get(node)),
                     self.get_colored(ipmi_state.get(node)),
                     self.get_colored(node_status.get(node)),
                     self.get_colored(slurm_state.get(node)),
@@ -419,26 +578,56 @@ class LCluster():
         return True
 
 
-    def get_prometheus_status(self):
+    def collect_states(self) -> dict:
+        """
+        Run every collector once for all nodes and return the per-node states.
+        """
+        nodes, node_hostname, node_status = self.get_node_inventory()
+        alertx_state = self.get_overview(list(node_hostname.values()))
+        slurm_state = self.call_slurm(nodes)
+        ipmi_state = self.get_ipmi_state(nodes, False)
+
+        states = {}
+        for node in nodes:
+            hostname = node_hostname.get(node) or node
+            states[node] = {
+                'hostname': hostname,
+                'alertx': self._lookup_alertx_status(alertx_state, hostname, node),
+                'ipmi': ipmi_state.get(node),
+                'luna': node_status.get(node),
+                'slurm': slurm_state.get(node),
+            }
+        return states
+
+
+    def get_prometheus_status(self) -> Optional[dict]:
         """
         Fetch Prometheus alerting rules. This is intentionally non-fatal:
         """
         if not self.prometheus_status:
             return None
+        if self.expired():
+            self.timed_out.add(self.prometheus_status)
+            return None
 
         try:
-            response = self.session.get(self.prometheus_status, stream=True, timeout=self.request_timeout, verify=self.security)
+            response = self.session.get(self.prometheus_status, stream=True,
+                                        timeout=self.request_timeout_for(self.request_timeout), verify=self.security)
             if response.status_code != 200:
                 sys.stderr.write(colored(f'WARNING :: AlertX/Prometheus returned HTTP {response.status_code} from {self.prometheus_status}.\n', 'yellow'))
                 return None
             return response.json()
+        except requests.exceptions.Timeout as exp:
+            self.timed_out.add(self.prometheus_status)
+            sys.stderr.write(colored(f'WARNING :: AlertX status from {self.prometheus_status} timed out: {exp}\n',
+                                     'yellow'))
         except requests.exceptions.RequestException as exp:
             sys.stderr.write(colored(f'WARNING :: Unable to fetch AlertX status from {self.prometheus_status}: {exp}\n', 'yellow'))
         except ValueError:
             sys.stderr.write(colored(f'WARNING :: AlertX/Prometheus response is not JSON: {self.prometheus_status}\n', 'yellow'))
         return None
 
-    def get_overview(self, hostnames):
+    def get_overview(self, hostnames: list) -> dict:
         """
         Return one AlertX status per hostname.
         """
@@ -452,7 +641,7 @@ class LCluster():
 
         rules = self.get_prometheus_status()
         if not rules:
-            return {host: 'N/A' for host in hostnames}
+            return {host: 'TIMEOUT' if self.prometheus_status in self.timed_out else 'N/A' for host in hostnames}
 
         groups = rules.get('data', {}).get('groups', [])
         if not isinstance(groups, list):
@@ -582,7 +771,7 @@ class LCluster():
         return response
 
 
-    def get_ipmi_state(self, nodes, show_message=True):
+    def get_ipmi_state(self, nodes: list, show_message: bool = True) -> dict:
         """
         Check IPMI State through one bulk Luna request and bounded polling.
         """
@@ -601,6 +790,8 @@ class LCluster():
         ipmi_url = f'{self.daemon}/control/action/power/_status'
         payload = {'control': {'power': {'status': {'hostlist': node_hostlist}}}}
         ipmi_response = self.post_data(ipmi_url, True, payload)
+        if ipmi_response is None and ipmi_url in self.timed_out:
+            return self.mark_timeout(response, ipmi_url)
 
         if not ipmi_response or ipmi_response.status_code != 200:
             code = ipmi_response.status_code if ipmi_response else 'NO RESPONSE'
@@ -617,16 +808,16 @@ class LCluster():
             return response
 
         ipmi_status_url = f'{self.daemon}/control/status/{request_id}'
-        deadline = monotonic() + self.ipmi_max_wait
+        deadline = monotonic() + self.time_left(self.ipmi_max_wait)
 
         while monotonic() < deadline:
             if all(value is not None for value in response.values()):
                 return response
 
-            sleep(self.ipmi_poll_interval)
+            sleep(self.time_left(self.ipmi_poll_interval))
             ipmi_status_response = self.get_data_real(ipmi_status_url, True)
             if not ipmi_status_response:
-                return response
+                return self.mark_timeout(response, ipmi_status_url)
 
             if ipmi_status_response.status_code == 404:
                 return response
@@ -638,6 +829,10 @@ class LCluster():
             ipmi_status = ipmi_status_response.json()
             self._merge_ipmi_payload(nodes, ipmi_status, response)
 
+        if self.expired():
+            # polling stopped at the deadline, the nodes still without a status never got one in time
+            self.timed_out.add(ipmi_status_url)
+            return self.mark_timeout(response, ipmi_status_url)
         sys.stderr.write(
             colored(
                 f'WARNING :: IPMI status polling timed out after {self.ipmi_max_wait:.0f}s. '\
@@ -648,19 +843,21 @@ class LCluster():
         return response
 
 
-    def call_slurm(self, nodes=None):
+    def call_slurm(self, nodes: Optional[list] = None) -> dict:
         """
         Call Slurm REST if available, otherwise fall back to scontrol/sinfo.
         """
         nodes = nodes or []
+        if self.expired():
+            return {node: 'TIMEOUT' for node in nodes}
         backend = self.choose_slurm()
 
         if backend['type'] == 'api':
-            return self.slurm_api_state(nodes, backend)
+            return self.mark_timeout(self.slurm_api_state(nodes, backend), 'slurm')
         if backend['type'] == 'scontrol':
-            return self.slurm_scontrol_state(nodes)
+            return self.mark_timeout(self.slurm_scontrol_state(nodes), 'slurm')
         if backend['type'] == 'sinfo':
-            return self.slurm_sinfo_state(nodes)
+            return self.mark_timeout(self.slurm_sinfo_state(nodes), 'slurm')
 
         return {node: 'SLURM N/A' for node in nodes}
 
@@ -982,12 +1179,17 @@ class LCluster():
         return self.slurm_auth
 
 
-    def _slurm_get_json(self, session, url, headers):
+    def _slurm_get_json(self, session: Any, url: str, headers: dict) -> Optional[dict]:
+        """
+        GET one Slurm REST url within the time budget, None when it fails or the budget is used up.
+        """
+        if self.expired():
+            return None
         try:
             call = session.get(
                 url,
                 headers=headers,
-                timeout=self.slurm_timeout,
+                timeout=self.request_timeout_for(self.slurm_timeout),
                 verify=self.slurm_verify,
             )
             if call.status_code != 200:
@@ -1080,65 +1282,138 @@ class LCluster():
         return response
 
 
-    def slurm_scontrol_state(self, nodes):
+    def slurm_scontrol_state(self, nodes: list) -> dict:
         """
-        Fetch Slurm node state using scontrol. Prefer JSON when supported, otherwise parse `scontrol show nodes -o`.
+        Fetch Slurm node state using scontrol.
         """
-        response = {node: False for node in nodes}
-        wanted = set(nodes)
-
-        return_code, stdout, _, _ = self.run_cmd('scontrol show nodes --json', timeout=30)
-        if return_code == 0 and stdout.strip().startswith('{'):
-            try:
-                data = json.loads(stdout)
-                for item in data.get('nodes', []):
-                    name = item.get('name') or item.get('hostname')
-                    if name in wanted:
-                        response[name] = self._normalise_slurm_state(item.get('state'))
-                return response
-            except json.JSONDecodeError:
-                pass
+        return self.slurm_command_state(nodes, 'scontrol')
 
-        return_code, stdout, _, _ = self.run_cmd('scontrol show nodes -o', timeout=30)
-        if return_code == 0 and stdout:
-            for line in stdout.splitlines():
-                name_match = re.search(r'\bNodeName=(\S+)', line)
-                state_match = re.search(r'\bState=(\S+)', line)
-                if not name_match or not state_match:
-                    continue
-                name = name_match.group(1)
-                state = self._normalise_slurm_state(state_match.group(1))
-                if name in wanted:
-                    response[name] = state
-            return response
 
-        if shutil.which('sinfo'):
-            return self.slurm_sinfo_state(nodes)
+    def slurm_sinfo_state(self, nodes: list) -> dict:
+        """
+        Final Slurm command fallback.
+        """
+        return self.slurm_command_state(nodes, 'sinfo')
 
-        return response
+
+    def _slurm_commands(self, command: str, node_hostlist: str) -> list:
+        """
+        Candidate argument lists for a Slurm command, best first.
+        Only the first one runs on a healthy cluster, the others cover unknown nodes and pre-JSON Slurm.
+        """
+        if command == 'scontrol':
+            return [
+                ('json', ['scontrol', '--json', 'show', 'node', node_hostlist]),
+                ('json', ['scontrol', '--json', 'show', 'node']),
+                ('text', ['scontrol', '-o', 'show', 'node']),
+            ]
+        return [
+            ('json', ['sinfo', '--json', '-N', '-n', node_hostlist]),
+            ('json', ['sinfo', '--json', '-N']),
+            ('text', ['sinfo', '-N', '-h', '-o', '%N|%T']),
+        ]
 
 
-    def slurm_sinfo_state(self, nodes):
+    def slurm_command_state(self, nodes: list, command: str = 'scontrol') -> dict:
         """
-        Final Slurm command fallback. One sinfo call, one dictionary lookup per node.
+        Fetch Slurm node state with one scontrol or sinfo call restricted to the nodes, without a shell.
+        The working command variant is remembered and the result is cached, both for slurm_cache_ttl seconds,
+        so a fallback chosen after a passing failure does not stick for the life of an exporter.
         """
         response = {node: False for node in nodes}
-        return_code, stdout, _, _ = self.run_cmd('sinfo -N -h -o "%N|%T"', timeout=30)
-        if return_code != 0 or not stdout:
+        if not nodes:
             return response
 
-        by_name = {}
-        for line in stdout.splitlines():
-            if '|' not in line:
+        node_hostlist = collect_hostlist(nodes)
+        cached = self.slurm_cache.get((command, node_hostlist))
+        if cached and monotonic() - cached[0] < self.slurm_cache_ttl:
+            return dict(cached[1])
+
+        candidates = self._slurm_commands(command, node_hostlist)
+        variant = 0
+        remembered = self.slurm_cache.get((command, 'variant'))
+        if remembered and monotonic() - remembered[0] < self.slurm_cache_ttl:
+            variant = remembered[1]
+        by_name = None
+        timed_out = False
+        for index in range(variant, len(candidates)):
+            output_format, cmd = candidates[index]
+            return_code, stdout, _, _ = self.run_cmd(cmd, timeout=30)
+            timed_out = timed_out or return_code == 124
+            if return_code != 0 or not stdout:
                 continue
-            name, state = line.split('|', 1)
-            by_name[name.strip()] = self._normalise_slurm_state(state)
+            if output_format == 'json':
+                by_name = self._parse_slurm_json(stdout)
+            else:
+                by_name = self._parse_slurm_text(stdout)
+            if by_name is not None:
+                self.slurm_cache[(command, 'variant')] = (monotonic(), index)
+                break
+
+        if by_name is None:
+            if command == 'scontrol' and shutil.which('sinfo'):
+                return self.slurm_command_state(nodes, 'sinfo')
+            if timed_out:
+                # not collected rather than unknown to Slurm
+                self.timed_out.add('slurm')
+                return {node: None for node in nodes}
+            return response
 
         for node in nodes:
             response[node] = by_name.get(node, False)
+        self.slurm_cache[(command, node_hostlist)] = (monotonic(), dict(response))
         return response
 
 
+    def _parse_slurm_json(self, stdout: str) -> Optional[dict]:
+        """
+        Map node name to state from scontrol/sinfo JSON output in one pass.
+        Handles the `nodes` list of scontrol and old sinfo, and the `sinfo` list of Slurm 23.02+.
+        """
+        try:
+            data = json.loads(stdout)
+        except json.JSONDecodeError:
+            return None
+        if not isinstance(data, dict):
+            return None
+
+        by_name = {}
+        if isinstance(data.get('nodes'), list):
+            for item in data['nodes']:
+                if not isinstance(item, dict):
+                    continue
+                name = item.get('name') or item.get('hostname')
+                if name:
+                    by_name[name] = self._normalise_slurm_state(item.get('state'))
+            return by_name
+
+        if isinstance(data.get('sinfo'), list):
+            for item in data['sinfo']:
+                if not isinstance(item, dict):
+                    continue
+                state = self._normalise_slurm_state((item.get('node') or {}).get('state'))
+                for name in (item.get('nodes') or {}).get('nodes') or []:
+                    by_name[name] = state
+            return by_name
+        return None
+
+
+    def _parse_slurm_text(self, stdout: str) -> dict:
+        """
+        Map node name to state from `scontrol -o show node` or `sinfo -N -h -o %N|%T` output.
+        """
+        by_name = {}
+        for line in stdout.splitlines():
+            if '|' in line and 'NodeName=' not in line:
+                name, state = line.split('|', 1)
+                by_name[name.strip()] = self._normalise_slurm_state(state)
+                continue
+            match = SLURM_NODE_LINE_RE.search(line)
+            if match:
+                by_name[match.group(1)] = self._normalise_slurm_state(match.group(2))
+        return by_name
+
+
     def loader(self, message=None, stop_event=None):
         """
         Terminal loader shown while a slow fetch is running.
@@ -1215,11 +1490,14 @@ class LCluster():
             yield items[index:index + size]
 
 
-    def _visible_len(self, text):
+    def _visible_len(self, text: Any) -> int:
         """
         Return visible terminal length, ignoring ANSI colour escape sequences.
         """
-        return len(ANSI_ESCAPE_RE.sub('', str(text)))
+        text = str(text)
+        if '\x1b' not in text:
+            return len(text)
+        return len(ANSI_ESCAPE_RE.sub('', text))
 
 
     def _ansi_center(self, text, width):
@@ -1243,37 +1521,26 @@ class LCluster():
         return f"{value}{' ' * padding}"
 
 
-    def _table_widths(self, nodes, node_hostname, node_status, alertx_state, slurm_state):
+    def _table_widths(self, nodes: list, node_hostname: dict, node_status: dict, node_alertx: dict,
+                      slurm_state: dict) -> list:
         """
         Calculate stable table widths before streaming begins.
-        """
-        headers = ['#', 'Node Name', 'Hostname', 'AlertX', 'IPMI', 'Luna', 'SLURM']
-
-        raw_rows = []
-        for index, node in enumerate(nodes, start=1):
-            hostname = node_hostname.get(node) or node
-            raw_rows.append([
-                index,
-                node,
-                hostname,
-                self._lookup_alertx_status(alertx_state, hostname, node),
-                'NOT RESPONDING',
-                node_status.get(node) or 'N/A',
-                slurm_state.get(node) or 'N/A',
-            ])
-
-        width_values = [headers]
-        width_values.extend(raw_rows)
-        width_values.append(['#', 'Node Name', 'Hostname', 'FAIL + NHC', 'NOT RESPONDING', 'WARNING', 'DOWN+NOT_RESPONDING'])
+        Only distinct values are measured, states repeat heavily across nodes.
+        """
+        columns = [
+            {'#', str(len(nodes))},
+            {'Node Name'} | set(nodes),
+            {'Hostname'} | {node_hostname.get(node) or node for node in nodes},
+            {'AlertX', 'FAIL + NHC'} | {str(node_alertx.get(node) or 'N/A') for node in nodes},
+            {'IPMI', 'NOT RESPONDING'},
+            {'Luna', 'WARNING'} | {str(node_status.get(node) or 'N/A') for node in nodes},
+            {'SLURM', 'DOWN+NOT_RESPONDING'} | {str(slurm_state.get(node) or 'N/A') for node in nodes},
+        ]
 
         widths = []
-        for column_index in range(len(headers)):
-            measured_width = max(
-                self._visible_len(row[column_index])
-                for row in width_values
-            )
-            max_width = TABLE_COLUMN_MAX_WIDTHS[column_index]
-            widths.append(min(measured_width, max_width))
+        for column_index, values in enumerate(columns):
+            measured_width = max(self._visible_len(value) for value in values)
+            widths.append(min(measured_width, TABLE_COLUMN_MAX_WIDTHS[column_index]))
         return widths
 
 
@@ -1281,11 +1548,14 @@ class LCluster():
         return '+' + '+'.join('-' * (width + 2) for width in widths) + '+'
 
 
-    def _wrap_cell(self, value, width):
+    def _wrap_cell(self, value: Any, width: int) -> list:
         """
         Wrap a possibly-coloured cell to the target visible width.
         """
         value = str(value)
+        if self._visible_len(value) <= width:
+            return [value]
+
         plain = ANSI_ESCAPE_RE.sub('', value)
 
         prefix_match = re.match(r'^((?:\x1b\[[0-9;]*m)+)', value)
@@ -1307,23 +1577,37 @@ class LCluster():
         return wrapped
 
 
-    def _table_row_lines(self, values, widths):
+    def _layout_cell(self, value: Any, width: int) -> list:
+        """
+        Return the wrapped and centred lines of a cell, cached per distinct value and width.
+        """
+        key = (value, width)
+        cell = self.cell_cache.get(key)
+        if cell is None:
+            cell = [self._ansi_center(line, width) for line in self._wrap_cell(value, width)]
+            self.cell_cache[key] = cell
+        return cell
+
+
+    def _table_row_lines(self, values: list, widths: list) -> list:
         """
         Return one or more printable table lines for a logical row.
         """
-        wrapped_cells = [
-            self._wrap_cell(value, width)
+        cells = [
+            self._layout_cell(value, width)
             for value, width in zip(values, widths)
         ]
-        row_height = max(len(cell) for cell in wrapped_cells) if wrapped_cells else 1
+        row_height = max(len(cell) for cell in cells) if cells else 1
+        if row_height == 1:
+            return ['| ' + ' | '.join(cell[0] for cell in cells) + ' |']
 
         lines = []
         for line_index in range(row_height):
-            cells = []
-            for cell_lines, width in zip(wrapped_cells, widths):
-                cell_value = cell_lines[line_index] if line_index < len(cell_lines) else ''
-                cells.append(self._ansi_center(cell_value, width))
-            lines.append('| ' + ' | '.join(cells) + ' |')
+            line = [
+                cell[line_index] if line_index < len(cell) else ' ' * width
+                for cell, width in zip(cells, widths)
+            ]
+            lines.append('| ' + ' | '.join(line) + ' |')
         return lines
 
 
@@ -1331,7 +1615,7 @@ class LCluster():
         return self._table_row_lines(values, widths)[0]
 
 
-    def _stream_table_start(self, widths):
+    def _stream_table_start(self, widths: list) -> None:
         """
         Print table title and header once.
         """
@@ -1348,41 +1632,64 @@ class LCluster():
             colored('SLURM', 'yellow', attrs=['bold']),
         ]
 
-        print(border)
-        print(f"| {self._ansi_center(title, title_width)} |")
-        print(border)
-        print(self._table_row(headers, widths))
-        print(border)
+        lines = [
+            border,
+            f"| {self._ansi_center(title, title_width)} |",
+            border,
+            self._table_row(headers, widths),
+            border,
+        ]
+        sys.stdout.write('\n'.join(lines) + '\n')
 
 
-    def _stream_table_rows(self, rows, widths):
+    def _stream_table_rows(self, rows: list, widths: list) -> None:
         """
-        Print a batch of already-coloured rows.
+        Write a batch of already-coloured rows in one go.
         """
+        lines = []
         for row in rows:
-            for line in self._table_row_lines(row, widths):
-                print(line)
+            lines.extend(self._table_row_lines(row, widths))
+        if lines:
+            sys.stdout.write('\n'.join(lines) + '\n')
         sys.stdout.flush()
 
 
-    def _stream_table_finish(self, widths):
+    def _stream_table_finish(self, widths: list) -> None:
         """
         Print the final bottom border.
         """
-        print(self._table_border(widths))
+        sys.stdout.write(self._table_border(widths) + '\n')
         sys.stdout.flush()
 
 
-    def get_colored(self, text=None):
+    def get_colored(self, text: Any = None) -> str:
+        """
+        Apply terminal colour to a table value, cached per distinct value.
+        Row numbers are unique per row and are not cached.
+        """
+        if isinstance(text, int) and not isinstance(text, bool):
+            return colored(text, 'light_blue')
+        key = (type(text), text)
+        try:
+            response = self.colored_cache.get(key)
+        except TypeError:
+            return self._colorize(text)
+        if response is None:
+            response = self._colorize(text)
+            self.colored_cache[key] = response
+        return response
+
+
+    def _colorize(self, text: Any = None) -> str:
         """
-        Apply terminal colour to a table value.
+        Map a table value to its terminal colour.
         """
         raw = text
         value = str(text).lower() if text is not None else ''
 
         if raw is True or raw in ['PASS', 'ON', 'OK']:
             return colored(raw, 'green')
-        if raw in ['OFF', 'WARNING', 'FAIL']:
+        if raw in ['OFF', 'WARNING', 'FAIL', 'TIMEOUT']:
             return colored(raw, 'yellow')
         if raw == 'FAIL + NHC':
             return colored(raw, 'red')
@@ -1409,12 +1716,208 @@ class LCluster():
         return True
 
 
-def main():
+class LClusterExporter():
+    """
+    Serve the latest LCluster node states as Prometheus metrics.
+    Collection runs on its own schedule, scrapes only read the last snapshot.
+    """
+
+    def __init__(self, lcluster: Optional[LCluster] = None, interval: float = DEFAULT_SERVE_INTERVAL) -> None:
+        """
+        Default variables should be here before calling any method.
+        """
+        self.lcluster = lcluster
+        self.interval = max(float(interval), 1.0)
+        if self.lcluster is not None:
+            # keep Slurm results until the next collection, which comes one interval later
+            self.lcluster.slurm_cache_ttl = self.interval + SLURM_CACHE_TTL
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.states = {}
+        self.last_success = 0
+        self.snapshot = self.render_metrics(self.states, 0.0, 0)
+
+
+    def parse_listen(self, listen: Optional[str] = None) -> tuple:
+        """
+        Parse :port, host:port or [ipv6]:port into a (host, port) tuple.
+        """
+        listen = str(listen or '').strip()
+        match = re.match(r'^(?:\[(?P<ipv6>[^\]]+)\]|(?P<host>[^:]*)):(?P<port>\d+)$', listen)
+        if not match and listen.isdigit():
+            return '', int(listen)
+        if not match:
+            self.lcluster.exit_lcluster(f'Invalid --serve address {listen}, expected [host]:port.')
+        host = match.group('ipv6') or match.group('host') or ''
+        return host, int(match.group('port'))
+
+
+    def escape_label(self, value: str) -> str:
+        """
+        Escape a Prometheus label value.
+        """
+        value = str(value)
+        return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+    def metric_state(self, value: Any) -> str:
+        """
+        Return the state label for a collector value, matching the table output.
+        """
+        if value is None or value is False or value == '':
+            return 'N/A'
+        if value is True:
+            return 'OK'
+        return str(value)
+
+
+    def render_metrics(self, states: dict, duration: float, success: int) -> bytes:
+        """
+        Render a full Prometheus text exposition for one snapshot.
+        """
+        lines = [
+            '# HELP lcluster_node_state Node state per source, 1 for the currently reported state.',
+            '# TYPE lcluster_node_state gauge',
+        ]
+        for node, values in states.items():
+            node_label = self.escape_label(node)
+            host_label = self.escape_label(values.get('hostname') or node)
+            for source in METRIC_SOURCES:
+                state = self.escape_label(self.metric_state(values.get(source)))
+                lines.append(
+                    f'lcluster_node_state{{node="{node_label}",hostname="{host_label}",'
+                    f'source="{source}",state="{state}"}} 1'
+                )
+        lines.extend([
+            '# HELP lcluster_nodes Number of nodes in the last successful collection.',
+            '# TYPE lcluster_nodes gauge',
+            f'lcluster_nodes {len(states)}',
+            '# HELP lcluster_collection_success Whether the last collection succeeded.',
+            '# TYPE lcluster_collection_success gauge',
+            f'lcluster_collection_success {int(success)}',
+            '# HELP lcluster_collection_duration_seconds Duration of the last collection.',
+            '# TYPE lcluster_collection_duration_seconds gauge',
+            f'lcluster_collection_duration_seconds {duration:.3f}',
+            '# HELP lcluster_last_success_timestamp_seconds Unix time of the last successful collection.',
+            '# TYPE lcluster_last_success_timestamp_seconds gauge',
+            f'lcluster_last_success_timestamp_seconds {self.last_success:.0f}',
+        ])
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+    def collect(self) -> bool:
+        """
+        Run one collection and swap in the new snapshot.
+        A failed collection keeps the previous node states and only flips the success gauge.
+        """
+        start = monotonic()
+        self.lcluster.start_deadline()
+        try:
+            states = self.lcluster.collect_states()
+        # the exporter has to outlive whatever a collector runs into, including its exit paths
+        except (Exception, SystemExit) as exp:
+            sys.stderr.write(colored(f'WARNING :: Collection failed: {exp}\n', 'yellow'))
+            with self.lock:
+                self.snapshot = self.render_metrics(self.states, monotonic() - start, 0)
+            return False
+
+        self.last_success = time()
+        with self.lock:
+            self.states = states
+            self.snapshot = self.render_metrics(states, monotonic() - start, 1)
+        return True
+
+
+    def collect_loop(self) -> None:
+        """
+        Collect on a fixed interval until stopped, independent of scrapes.
+        """
+        while not self.stop_event.is_set():
+            start = monotonic()
+            self.collect()
+            self.stop_event.wait(max(self.interval - (monotonic() - start), 0))
+
+
+    def get_snapshot(self) -> bytes:
+        """
+        Return the current metrics payload.
+        """
+        with self.lock:
+            return self.snapshot
+
+
+    def handler(self) -> type:
+        """
+        Build the request handler class bound to this exporter.
+        """
+        exporter = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            """
+            Serve /metrics from the in-memory snapshot.
+            """
+
+            def do_GET(self) -> None:
+                """
+                Answer a scrape with the last snapshot, collecting is left to the collector thread.
+                """
+                if self.path.split('?')[0] not in ['/metrics', '/']:
+                    self.send_error(404)
+                    return
+                body = exporter.get_snapshot()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args: Any) -> None:
+                """
+                Keep scrapes out of the output, the default handler logs every request to stderr.
+                """
+
+        return MetricsHandler
+
+
+    def serve(self, listen: Optional[str] = None) -> bool:
+        """
+        Start the collector thread and serve metrics until interrupted.
+        """
+        host, port = self.parse_listen(listen)
+        server = ThreadingHTTPServer((host, port), self.handler())
+        server.daemon_threads = True
+        thread = threading.Thread(target=self.collect_loop, daemon=True)
+        thread.start()
+        sys.stdout.write(colored(f'Serving lcluster metrics on {host or "*"}:{port}/metrics '
+                                 f'every {self.interval:.0f}s\n', 'blue'))
+        sys.stdout.flush()
+        try:
+            server.serve_forever()
+        finally:
+            self.stop_event.set()
+            server.server_close()
+        return True
+
+
+def main() -> bool:
     """
     Main entry point.
     """
+    parser = argparse.ArgumentParser(prog='lcluster', description='Health & Status of Luna nodes.')
+    parser.add_argument('--check', action='store_true',
+                        help='probe the Luna daemon /version endpoint before collecting')
+    parser.add_argument('--deadline', type=float, metavar='SECONDS',
+                        help='hard time budget for a run (per collection in exporter mode), '
+                             'values not collected in time are shown as TIMEOUT')
+    parser.add_argument('--serve', metavar='[HOST]:PORT',
+                        help='run as a Prometheus exporter on this address instead of printing the table')
+    parser.add_argument('--interval', type=float, default=DEFAULT_SERVE_INTERVAL, metavar='SECONDS',
+                        help=f'collection interval in exporter mode (default {DEFAULT_SERVE_INTERVAL:.0f})')
+    args = parser.parse_args()
     try:
-        return LCluster().health_checkup()
+        if args.serve:
+            return LClusterExporter(LCluster(args.check, args.deadline), args.interval).serve(args.serve)
+        return LCluster(args.check, args.deadline).health_checkup()
     except KeyboardInterrupt:
         sys.stderr.write("\nKeyboard Interrupted.\n")
         sys.exit(1)
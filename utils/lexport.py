@@ -38,9 +38,19 @@ import sys
 from builtins import dict
 import re
 import json
-from time import sleep, time
+from time import sleep, time, monotonic
+from typing import Any, Iterator, Optional
 import subprocess
 import shutil
+import tarfile
+import tempfile
+import hashlib
+import stat
+import codecs
+import fcntl
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 import requests
 from requests import Session
 from requests.adapters import HTTPAdapter
@@ -52,6 +62,45 @@ from utils.utils.token import Token
 
 global TMP_DIR
 TMP_DIR='/tmp'
+# stdout as it was before main() sends our messages to stderr, used when the file is '-'
+global STDOUT
+STDOUT=sys.stdout
+
+# compression programs usable for osimages. the codec is recorded in .osimage.dat,
+# imports of archives without one fall back to lbzip2 as that is what we always used.
+DEFAULT_CODEC='lbzip2'
+CHUNK_SIZE=1024*1024
+# the image is cut in parts of this size when the archive goes to a pipe, as tar needs the size up front
+PART_SIZE=64*1024*1024
+# osimages exported into a store are cut in chunks of this size, each stored once by its sha256
+STORE_CHUNK_SIZE=4*1024*1024
+MANIFEST_FORMAT='lexport-manifest'
+# directories at the image root of which tar, the manifest and the store export leave out the contents
+EXCLUDED_DIRS=['proc', 'dev', 'sys', 'tmp']
+# a path is exported again by an incremental export when any of these differ from the previous manifest
+MANIFEST_KEYS=['type', 'size', 'mtime', 'inode', 'mode', 'uid', 'gid', 'target', 'rdev']
+# files up to this size are hashed by the worker pool when verifying an archive, bigger ones as they stream by
+VERIFY_POOL_SIZE=8*1024*1024
+# seconds between progress updates on a terminal, and between JSON progress records otherwise
+PROGRESS_INTERVAL=1
+PROGRESS_RECORD_INTERVAL=10
+# seconds the daemon may stay silent during cluster exports and imports, --timeout overrides it
+TIMEOUT=10
+# cluster imports are posted per section in batches of at most this many objects
+CLUSTER_BATCH_SIZE=500
+# object types the daemon has a config endpoint per object for, --diff sends the others through the import
+OBJECT_SECTIONS=['node', 'group', 'osimage', 'network', 'switch', 'otherdevices', 'bmcsetup']
+# objects --diff sends at once, unless --threads says otherwise
+DIFF_WORKERS=8
+# seconds between checkpoints of the import journal while unpacking
+JOURNAL_INTERVAL=10
+CODECS={
+    'lbzip2': {'program': 'lbzip2', 'extension': '.bz2', 'level': 9, 'levels': (1, 9), 'threads': ['-n', '{threads}']},
+    'pigz':   {'program': 'pigz',   'extension': '.gz',  'level': 6, 'levels': (1, 9), 'threads': ['-p', '{threads}']},
+    'zstd':   {'program': 'zstd',   'extension': '.zst', 'level': 3, 'levels': (1, 19), 'threads': ['-T{threads}']},
+    'lz4':    {'program': 'lz4',    'extension': '.lz4', 'level': 1, 'levels': (1, 12), 'threads': []},
+    'none':   {'program': None,     'extension': '',     'level': None, 'levels': None, 'threads': []}
+}
 
 urllib3.disable_warnings()
 session = Session()
@@ -68,7 +117,7 @@ CONF = Ini.read_ini(ini_file='/trinity/local/luna/utils/config/luna.ini')
 
 # ============================================================================
 
-def main(argv):
+def main(argv: list) -> None:
     """
     The main method to initiate the script.
     """
@@ -84,6 +133,18 @@ def main(argv):
     IMAGENAME=None
     MATTHEW=None
     FORCE=False
+    CODEC=DEFAULT_CODEC
+    LEVEL=None
+    THREADS=None
+    STORE=None
+    SINCE=None
+    VERIFY=False
+    TIMEOUT_SECONDS=TIMEOUT
+    DIFF=False
+    DRYRUN=False
+    RESUME=False
+    PROGRESS=False
+    FILES=[]
     if (len(argv) == 0):
         call_help()
         exit()
@@ -108,27 +169,84 @@ def main(argv):
             MATTHEW=argv.pop(0)
         elif (item == "-n" or item == "--name"):
             IMAGENAME=argv.pop(0)
+        elif (item == "--codec"):
+            CODEC=argv.pop(0) if argv else None
+            if CODEC not in CODECS:
+                print(f"ERROR :: Unknown codec {CODEC}. Choose from {', '.join(CODECS)}.")
+                exit(1)
+        elif (item == "--level" or item == "--threads" or item == "--timeout"):
+            value=argv.pop(0) if argv else ''
+            if not value.isdigit() or int(value) < 1:
+                print(f"ERROR :: {item} needs a positive number.")
+                exit(1)
+            if item == "--level":
+                LEVEL=int(value)
+            elif item == "--threads":
+                THREADS=int(value)
+            else:
+                TIMEOUT_SECONDS=int(value)
+        elif (item == "-s" or item == "--store"):
+            STORE=argv.pop(0) if argv else None
+            if not STORE or not os.path.isdir(STORE):
+                print(f"STOP :: store directory {STORE} does not exist.")
+                exit(1)
+        elif (item == "--verify"):
+            VERIFY=True
+        elif (item == "--resume"):
+            RESUME=True
+        elif (item == "--diff"):
+            DIFF=True
+        elif (item == "--progress"):
+            PROGRESS=True
+        elif (item == "--dry-run"):
+            DIFF=True
+            DRYRUN=True
+        elif (item == "--since"):
+            SINCE=argv.pop(0) if argv else None
+            if not SINCE or not os.path.isfile(SINCE):
+                print(f"STOP :: previous export {SINCE} does not exist.")
+                exit(1)
         elif (item == "-t" or item == "--tmp"):
             global TMP_DIR
             TMP_DIR=argv.pop(0)
-        elif (item[0] == "-"):
+        elif (item[0] == "-" and item != "-"):
             print("ERROR :: Invalid options used.")
             call_help()
             exit()
         else:
-            FILE=item
+            FILES.append(item)
+    FILE=FILES[0] if FILES else None
+    if len(FILES) > 1 and (WHAT != 'image' or ACTION != 'import' or '-' in FILES):
+        print("ERROR :: Only osimage imports take more than one file, and not from stdin.")
+        exit(1)
     if not os.path.exists(TMP_DIR):
         print(f"STOP :: {TMP_DIR} directory does not exist.")
         logger.error(f"CONFIG: STOP :: TMP_DIR: {TMP_DIR} directory does not exist.")
         exit(1)
+    if VERIFY:
+        if not FILE:
+            print("ERROR :: --verify needs an archive.")
+            exit(1)
+        if verify_request(file=FILE,path=IMAGEPATH,threads=THREADS):
+            exit(0)
+        exit(1)
     if ((WHAT is None) or (ACTION is None)):
         print("ERROR :: Instruction incomplete. Required options or flags missing.")
         call_help()
         exit()
+    if FILE == '-' and ACTION == 'export':
+        # the export goes to stdout, everything we have to say goes to stderr
+        sys.stdout=sys.stderr
+    if DIFF and (WHAT != 'cluster' or ACTION != 'import'):
+        print("ERROR :: --diff and --dry-run go with cluster imports only.")
+        exit(1)
     if WHAT == 'cluster':
-        handleClusterRequest(action=ACTION,file=FILE,force=FORCE)
+        handleClusterRequest(action=ACTION,file=FILE,force=FORCE,timeout=TIMEOUT_SECONDS,diff=DIFF,dry_run=DRYRUN,
+                             threads=THREADS,progress_records=PROGRESS)
     elif WHAT == 'image':
-        handleImageRequest(action=ACTION,file=FILE,name=IMAGENAME,path=IMAGEPATH,config_file=MATTHEW,force=FORCE)
+        codec={'codec': CODEC, 'level': LEVEL, 'threads': THREADS}
+        handleImageRequest(action=ACTION,file=FILE,name=IMAGENAME,path=IMAGEPATH,config_file=MATTHEW,force=FORCE,
+                           codec=codec,store=STORE,since=SINCE,incrementals=FILES[1:],resume=RESUME)
     exit()
 
 # ============================================================================
@@ -138,7 +256,8 @@ def call_help():
     This method will provide a Help Menu.
     """
     print("""
-usage: lexport <-c|-o> <-e|-i> [file]
+usage: lexport <-c|-o> <-e|-i> [file] [incremental ...]
+       lexport --verify <file> [-p path]
 
 Luna configuration im/exporter.
 
@@ -153,19 +272,65 @@ optional arguments:
                         when exporting osimage and no file given, it will render
                         a file based on cluster name, osimage name and date.
                         without --force it will warn if a file will be overwritten.
+                        - means stdout for exports and stdin for imports.
+  incremental           osimage imports apply these incremental exports, in order, on top of file.
+                        when file itself is incremental, it is applied to the image already at the path.
   -n, --name            used only in combination with osimage operations.
   -m, --matthew         use an external config file during osimage operations, Matthew mode. 
                         used for osimage imports and exports. handle with care.
   -h, --help            show this help message and exit.
   -f, --force           do not warn, do not ask, just do it.
-  -t, --tmp             use this directory as tmp dir instead of /tmp. directory has to exist.
+  -t, --tmp             keep temporary files, like tar listings and error output, in this directory
+                        instead of /tmp. directory has to exist.
+  --codec               compression used for osimage exports: zstd, lz4, lbzip2, pigz or none.
+                        defaults to lbzip2. imports pick the codec recorded in the archive.
+  --level               compression level of the codec, e.g. 1-19 for zstd or 1-9 for lbzip2.
+  --threads             number of compression threads. defaults to all cores.
+  --timeout             seconds the daemon may take to answer during cluster exports and imports.
+                        defaults to 10. exports are streamed to file, imports are read as they go and
+                        sent per section in batches of 500 objects. the daemon merges every batch
+                        into the configuration, when one fails the ones before it stay imported.
+  --progress            cluster exports and imports report their progress as JSON records on stderr
+                        when it is no terminal. on a terminal a progress line is shown regardless.
+  --diff                cluster imports compare the file with the current configuration and only send
+                        the objects that changed, each to its own endpoint, --threads at a time.
+                        objects the file does not have are left alone.
+  --dry-run             show what --diff would change, without changing anything.
+  -s, --store           export the osimage into this deduplicating chunk store, writing only a
+                        manifest to file, or import the osimage of a manifest from it. files are
+                        stored in chunks by content, so revisions only add what changed.
+                        extended attributes, ACLs and SELinux labels are not kept in the store.
+  --since               export only what changed since this previous export or manifest, together
+                        with the list of deleted paths.
+  --resume              carry on with an osimage import that stopped halfway, given the same archives.
+                        files that were unpacked completely are kept and daemon steps that were
+                        done are skipped. the progress is kept in <path>.lexport-journal.
+  --verify              check the files in an archive against the hashes recorded during export.
+                        with -p, check the osimage at that path against them instead.
+                        imports always verify the osimage before it is registered.
 
 examples:
   lexport -c -e /tmp/cluster-config.dat     exports all cluster configuration to /tmp/cluster-config.dat
   lexport -c -e                             exports all cluster configuration and prints to STDOUT
   lexport -c -i /tmp/cluster-config.dat     imports all cluster configuration from /tmp/cluster-config.dat
+  lexport -c -i --dry-run /tmp/cluster-config.dat
+                                            shows what importing cluster-config.dat would change
+  lexport -c -i --diff /tmp/cluster-config.dat
+                                            imports only what changed in cluster-config.dat
   lexport -o -e -n compute /tmp/compute.tar exports compute osimage to compute.tar with embedded configuration
   lexport -o -i /tmp/compute.tar            imports compute.tar with embedded configuration
+  lexport -o -e -n compute --codec zstd --level 3 /tmp/compute
+                                            exports compute osimage to compute.tar, compressed with zstd
+  lexport -o -e -n compute -s /trinity/store /tmp/compute
+                                            exports compute osimage into the store, the manifest to compute.manifest
+  lexport -o -e -n compute --since /tmp/compute.tar /tmp/compute-1
+                                            exports the changes to compute since compute.tar
+  lexport -o -i /tmp/compute.tar /tmp/compute-1.tar /tmp/compute-2.tar
+                                            imports compute.tar and applies two incremental exports
+  lexport --verify /tmp/compute.tar -p /trinity/images/compute
+                                            checks the compute osimage against the hashes in compute.tar
+  lexport -o -e -n compute - | ssh remote lexport -o -i -
+                                            moves the compute osimage to another controller in one pass
   lexport -o -i /tmp/compute.tar -p /trinity/images/compute_2    
                                             imports compute.tar, using embedded configuration but
                                             overrides path to /trinity/images/compute_2
@@ -175,7 +340,12 @@ examples:
 
 # ----------------------------------------------------------------------------
 
-def handleClusterRequest(action=None,file=None,force=False):
+def handleClusterRequest(action: Optional[str] = None, file: Optional[str] = None, force: bool = False,
+                         timeout: float = TIMEOUT, diff: bool = False, dry_run: bool = False,
+                         threads: Optional[int] = None, progress_records: bool = False) -> None:
+    """
+    Exports the cluster configuration of the daemon, or imports one, streamed in both directions.
+    """
     if (action and action == 'export') or (action and action == 'import' and file):
         CONF['TOKEN']=Token.get_token(username=CONF['USERNAME'], password=CONF['PASSWORD'], protocol=CONF["PROTOCOL"], endpoint=CONF["ENDPOINT"], verify_certificate=CONF["VERIFY_CERTIFICATE"])
 
@@ -184,18 +354,35 @@ def handleClusterRequest(action=None,file=None,force=False):
 
         if action == 'export':
             try:
-                r = requests.get(f'{CONF["PROTOCOL"]}://{CONF["ENDPOINT"]}/config/cluster/export',headers=headers, stream=True, timeout=10, verify=CONF["VERIFY_CERTIFICATE"])
+                if file and file != '-' and os.path.exists(file) and not force:
+                    print(f"STOP :: {file} already exists. Please use another name or use --force to override")
+                    logger.error(f"CONFIG: STOP :: {file} already exists.")
+                    exit(1)
+                r = requests.get(f'{CONF["PROTOCOL"]}://{CONF["ENDPOINT"]}/config/cluster/export',headers=headers,
+                                 stream=True, timeout=timeout, verify=CONF["VERIFY_CERTIFICATE"])
                 status_code=str(r.status_code)
                 if status_code == '200':
-                    if file:
-                        if os.path.exists(file) and not force:
-                            print(f"STOP :: {file} already exists. Please use another name or use --force to override")
-                            logger.error(f"CONFIG: STOP :: {file} already exists.")
-                            exit(1)
-                        with open(file,'w', encoding = "utf-8") as file:
-                            file.write(r.text)
+                    progress=Progress('export', 'cluster', total=int(r.headers.get('Content-Length') or 0) or None,
+                                      records=progress_records)
+                    if not file or file == '-':
+                        target=MeteredStream(STDOUT.buffer, progress, 'write', count=True)
+                        for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                            target.write(chunk)
+                        target.flush()
                     else:
-                        print (r.text)
+                        # written next to the file and moved in place when complete,
+                        # a broken transfer leaves no half export
+                        partial=f"{file}.partial"
+                        try:
+                            with open(partial,'wb') as export_file:
+                                target=MeteredStream(export_file, progress, 'write', count=True)
+                                for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                                    target.write(chunk)
+                            os.replace(partial, file)
+                        finally:
+                            if os.path.exists(partial):
+                                os.remove(partial)
+                    progress.finish()
                     exit(0)
                 else:
                     print(f"ERROR :: trouble processing request: {r.text}")
@@ -219,20 +406,25 @@ def handleClusterRequest(action=None,file=None,force=False):
                 exit(3)
         elif action == 'import':
             try:
-                if not os.path.exists(file):
+                if file != '-' and not os.path.exists(file):
                     print(f"STOP :: {file} does not exist")
                     logger.error(f"CONFIG: STOP :: {file} does not exist")
                     exit(1)
-                with open(file,'r', encoding = "utf-8") as file:
-                    data=file.read()
-                    myjson=json.loads(data)
-                r = requests.post(f'{CONF["PROTOCOL"]}://{CONF["ENDPOINT"]}/config/cluster/import', json=myjson, headers=headers, stream=True, timeout=10, verify=CONF["VERIFY_CERTIFICATE"])
-                status_code=str(r.status_code)
-                if status_code == '201':
+                with (open(file,'r', encoding = "utf-8") if file != '-' else sys.stdin) as config_file:
+                    if diff:
+                        ret=diff_cluster(source=config_file, headers=headers, timeout=timeout, threads=threads,
+                                         dry_run=dry_run)
+                    else:
+                        ret=import_cluster(source=config_file, total=os.path.getsize(file) if file != '-' else None,
+                                           headers=headers, timeout=timeout, records=progress_records)
+                if ret and dry_run:
+                    print("dry run, nothing changed")
+                    exit(0)
+                if ret:
                     print(f"finished importing configuration")
                     exit(0)
-                print(f"importing failed with code {status_code}: {r.text}")
-                logger.error(f"CONFIG: importing failed with code {status_code}: {r.text}")
+                print("ERROR :: importing stopped")
+                exit(2)
    
             except requests.exceptions.HTTPError as err:
                 print("ERROR :: trouble getting results: "+str(err))
@@ -256,8 +448,15 @@ def handleClusterRequest(action=None,file=None,force=False):
 
 # ----------------------------------------------------------------------------
 
-def handleImageRequest(action=None,file=None,name=None,path=None,config_file=None,force=False):
+def handleImageRequest(action: Optional[str] = None, file: Optional[str] = None, name: Optional[str] = None,
+                       path: Optional[str] = None, config_file: Optional[str] = None, force: bool = False,
+                       codec: Optional[dict] = None, store: Optional[str] = None, since: Optional[str] = None,
+                       incrementals: Optional[list] = None, resume: bool = False) -> None:
+    """
+    Exports an osimage with its configuration into an archive or store, or imports one from them.
+    """
     if (action and action == 'export') or (action and action == 'import' and file):
+        api_start=monotonic()
         CONF['TOKEN']=Token.get_token(username=CONF['USERNAME'], password=CONF['PASSWORD'], protocol=CONF["PROTOCOL"], endpoint=CONF["ENDPOINT"], verify_certificate=CONF["VERIFY_CERTIFICATE"])
         
         RET={'400': 'invalid request', '404': 'unknown osimage', '401': 'action not authorized', '503': 'service not available'}
@@ -275,54 +474,65 @@ def handleImageRequest(action=None,file=None,name=None,path=None,config_file=Non
                     data=json.loads(r.text)
                     cluster_name = data['config']['cluster']['name'] or 'cluster'
                 r = requests.get(f'{CONF["PROTOCOL"]}://{CONF["ENDPOINT"]}/config/osimage/{name}', headers=headers, stream=True, timeout=10, verify=CONF["VERIFY_CERTIFICATE"])
+                logger.info(f"EXPORT: daemon api took {monotonic() - api_start:.2f}s")
                 status_code=str(r.status_code)
                 if status_code == '200':
                     data=json.loads(r.text)
                     config=data['config']['osimage'][name]
-                    if file:
-                        file = f"{file}.tar"
+                    extension='.manifest' if store else '.tar'
+                    if file == '-':
+                        pass
+                    elif file:
+                        file = f"{file}{extension}"
                     else:
                         epoch_time = int(time())
-                        file = f"{cluster_name}-{name}-{epoch_time}.tar"
+                        file = f"{cluster_name}-{name}-{epoch_time}{extension}"
                     logger.info(f"EXPORT: config: {config}, file: {file}")
-                    if os.path.exists(file) and not force:
+                    if file != '-' and os.path.exists(file) and not force:
                         print(f"STOP :: {file} already exists. Please use another name or use --force to override")
                         exit(1)
-                    image_file=f'{cluster_name}-{name}.tar.bz2'
+                    codec=codec or {'codec': DEFAULT_CODEC}
+                    if not store and not check_codec(codec=codec['codec'], level=codec.get('level')):
+                        exit(1)
+                    image_file=f"{cluster_name}-{name}.tar{CODECS[codec['codec']]['extension']}"
                     logger.info(f"EXPORT: image_file: {image_file}")
-                    if os.path.exists(image_file):
-                        os.remove(image_file)
-                    if config['path']:
-                        ret = pack_image(cluster=cluster_name, name=name, path=config['path'], image_file=image_file)
+                    if not config['path']:
+                        print(f"STOP :: osimage {name} has no path to export")
+                        logger.error(f"EXPORT: STOP :: osimage {name} has no path")
+                        exit(1)
+                    image_config=json.loads(r.text)['config']['osimage'][name]
+                    if 'assigned_tags' in image_config:
+                        del image_config['assigned_tags']
+                    if 'tag' in image_config:
+                        del image_config['tag']
+                    if config_file: # Matthew mode
+                        if os.path.exists(config_file) and not force:
+                            print(f"STOP :: {config_file} already exists. "
+                                  "Please use another name or use --force to override")
+                            logger.error(f"EXPORT: STOP :: {config_file} already exists")
+                            exit(1)
+                        with open(config_file,'w', encoding = "utf-8") as mfile:
+                            mfile.write(json.dumps(image_config))
+                    previous=None
+                    if since and store:
+                        print("STOP :: --since does not go together with --store, "
+                              "the store only adds what changed already")
+                        exit(1)
+                    if since:
+                        previous=read_previous(file=since)
+                        if not previous:
+                            exit(1)
+                    if store:
+                        ret = export_store(file=file, name=name, path=config['path'], config=json.dumps(image_config),
+                                           store=store, threads=codec.get('threads'))
+                    else:
+                        ret = export_image(file=file, name=name, path=config['path'], image_file=image_file,
+                                           config=json.dumps(image_config), codec=codec, previous=previous)
                     if not ret:
                         print("ERROR :: Encountered a problem exporting osimage")
                         logger.error(f"EXPORT: ERROR :: Encountered a problem exporting osimage")
                         exit(4)
-                    if file:
-                        raw_config=json.loads(r.text)
-                        image_config=raw_config['config']['osimage'][name]
-                        if 'assigned_tags' in image_config:
-                            del image_config['assigned_tags']
-                        if 'tag' in image_config:
-                            del image_config['tag']
-                        if config_file: # Matthew mode
-                            if os.path.exists(config_file) and not force:
-                                print(f"STOP :: {config_file} already exists. Please use another name or use --force to override")
-                                logger.error(f"EXPORT: STOP :: {config_file} already exists")
-                                exit(1)
-                            with open(config_file,'w', encoding = "utf-8") as mfile:
-                                mfile.write(json.dumps(image_config))
-                        ret = merge(file=file, image_file=image_file, config=json.dumps(image_config))
-                        if not ret:
-                            print("ERROR :: Encountered a problem exporting osimage")
-                            logger.error(f"EXPORT: ERROR :: Encountered a problem exporting osimage")
-                            exit(4)
-                        print(f"finished exporting to {file}")
-                        exit(0)
-                    else:
-                        print(f"STOP :: i do not have a file to write to. not sure what went wrong")
-                        logger.error(f"EXPORT: STOP :: i do not have a file to write to")
-                        exit(1)
+                    print(f"finished exporting to {'stdout' if file == '-' else file}")
                     exit(0)
                 else:
                     print(f"ERROR :: trouble processing request: {r.text}")
@@ -342,21 +552,48 @@ def handleImageRequest(action=None,file=None,name=None,path=None,config_file=Non
                 exit(3)
         elif action == 'import':
             try:
-                if not os.path.exists(file):
+                if file != '-' and not os.path.exists(file):
                     print(f"STOP :: {file} does not exist")
                     exit(1)
-                image_config, image_file=unmerge(file=file)
+                if store:
+                    archive, image_file, image_codec=None, None, 'none'
+                    manifest=read_manifest(file=file, store=store)
+                    if not manifest:
+                        exit(1)
+                    image_config, image_file=manifest['config'], file
+                else:
+                    archive, image_config, image_file, image_codec=unmerge(file=file)
                 if (not image_config) or (not image_file):
                     print(f"STOP :: cannot continue. Missing config and/or a path. Is this a valid exported osimage?")
                     logger.error(f"IMPORT: STOP :: cannot continue. Missing config and/or a path. Is this a valid exported osimage?")
                     exit(1)
+                base_incremental=bool(archive and archive.metadata().get('parent'))
+                previous_id=manifest.get('id') if store else archive.metadata().get('id')
+                chain=[]
+                for incremental in incrementals or []:
+                    incremental_archive, incremental_config, _, incremental_codec=unmerge(file=incremental)
+                    if not incremental_archive:
+                        exit(1)
+                    parent=incremental_archive.metadata().get('parent')
+                    if not parent or parent != previous_id:
+                        print(f"STOP :: {incremental} is not an incremental export of the export before it")
+                        logger.error(f"IMPORT: STOP :: {incremental} does not follow {previous_id}")
+                        exit(1)
+                    if not check_codec(codec=incremental_codec):
+                        exit(1)
+                    previous_id=incremental_archive.metadata().get('id')
+                    # the config of the latest export is the one that counts
+                    image_config=incremental_config or image_config
+                    chain.append((incremental_archive, incremental_codec))
                 if config_file: # Matthew mode
                     with open(config_file,'r', encoding = "utf-8") as mfile:
                         data=mfile.read()
                         image_config=json.loads(data)
                 if 'assigned_tags' in image_config:
                     del image_config['assigned_tags']
-                logger.info(f"config: {image_config}, file: {image_file}")
+                logger.info(f"config: {image_config}, file: {image_file}, codec: {image_codec}")
+                if not check_codec(codec=image_codec):
+                    exit(1)
                 image_path=image_config['path']
                 if path:
                     image_path=path
@@ -365,58 +602,140 @@ def handleImageRequest(action=None,file=None,name=None,path=None,config_file=Non
                     print(f"STOP :: path {image_path} does not feel correct. Please use another path or use --force to override")
                     logger.error(f"IMPORT: STOP :: path {image_path} does not feel correct")
                     exit(1)
-                if os.path.exists(image_path) and not force:
-                    print(f"STOP :: path {image_path} already exists. Please use another path or use --force to override")
-                    logger.error(f"IMPORT: STOP :: path {image_path} already exists")
-                    exit(1)
-                if os.path.exists(image_path):
-                    shutil.rmtree(image_path)
-                os.makedirs(image_path)
                 image_name=image_config['name']
                 if name:
                     image_name=name
                     image_config['name']=name
-                r = requests.get(f'{CONF["PROTOCOL"]}://{CONF["ENDPOINT"]}/config/osimage/{name}', headers=headers, stream=True, timeout=10, verify=CONF["VERIFY_CERTIFICATE"])
-                logger.info(f"image check: {r.status_code}")
-                status_code=str(r.status_code)
-                if status_code == '200' and not force:
-                    print(f"STOP :: osimage {image_name} already exists. Please use another name or use --force to override")
-                    logger.error(f"IMPORT: STOP :: osimage {image_name} already exists")
-                    exit(1)
+                journal=Journal(image_path)
+                # the archives are known by their export id, or by name when they predate those
+                archive_ids=[(manifest.get('id') if store else archive.metadata().get('id')) or os.path.basename(file)]
+                archive_ids+=[incremental_archive.metadata().get('id') or os.path.basename(incremental)
+                              for (incremental_archive, _), incremental in zip(chain, incrementals or [])]
+                resumed=None
+                if resume:
+                    resumed=journal.load()
+                    if not resumed or resumed.get('name') != image_name or resumed.get('archives') != archive_ids:
+                        print(f"STOP :: there is no import of {image_name} from these archives "
+                              f"to resume at {image_path}")
+                        logger.error(f"IMPORT: STOP :: no journal {journal.file} "
+                                     f"matching {image_name} and {archive_ids}")
+                        exit(1)
+                    print(f"resuming the import of {image_name}, "
+                          f"{resumed.get('applied', 0)} of {len(archive_ids)} archives were unpacked")
+                    logger.info(f"IMPORT: resuming {image_name} from {journal.file}: {resumed}")
+                elif base_incremental:
+                    if not os.path.isdir(image_path):
+                        print(f"STOP :: {file} is incremental and needs the image it was exported from at {image_path}")
+                        logger.error(f"IMPORT: STOP :: incremental {file} without an image at {image_path}")
+                        exit(1)
+                else:
+                    if os.path.exists(image_path) and not force:
+                        print(f"STOP :: path {image_path} already exists. "
+                              "Please use another path or use --force to override")
+                        if os.path.exists(journal.file):
+                            print(f"an earlier import into {image_path} stopped halfway, --resume carries on with it")
+                        logger.error(f"IMPORT: STOP :: path {image_path} already exists")
+                        exit(1)
+                    if os.path.exists(image_path):
+                        shutil.rmtree(image_path)
+                    os.makedirs(image_path)
+                if not resumed:
+                    r = requests.get(f'{CONF["PROTOCOL"]}://{CONF["ENDPOINT"]}/config/osimage/{name}', headers=headers,
+                                     stream=True, timeout=10, verify=CONF["VERIFY_CERTIFICATE"])
+                    logger.info(f"image check: {r.status_code}")
+                    status_code=str(r.status_code)
+                    if status_code == '200' and not force:
+                        print(f"STOP :: osimage {image_name} already exists. "
+                              "Please use another name or use --force to override")
+                        logger.error(f"IMPORT: STOP :: osimage {image_name} already exists")
+                        exit(1)
+                    journal.save(name=image_name, path=image_path, archives=archive_ids, applied=0, member=None,
+                                 verified=False, daemon=[])
+                api_time=monotonic()-api_start
+                # unpack and verify before the daemon hears about it, a broken archive then leaves the daemon alone
+                threads=(codec or {}).get('threads')
+                ret=True
+                for index in range(journal.state['applied'], len(chain) + 1):
+                    if index == 0 and store:
+                        if resumed:
+                            # restoring from the local store is quick, it starts over
+                            shutil.rmtree(image_path)
+                        ret=restore_store(name=image_name,path=image_path,manifest=manifest,store=store,threads=threads)
+                    elif index == 0 and base_incremental:
+                        ret=apply_incremental(name=image_name,path=image_path,archive=archive,
+                                              codec={'codec': image_codec, 'threads': threads},journal=journal)
+                    elif index == 0:
+                        # files that made it are kept, the rest is unpacked again
+                        skip_existing=bool(resumed) and resume_point(name=image_name,path=image_path,archive=archive,
+                                                                     member=journal.state.get('member'))
+                        ret=unpack_image(name=image_name,path=image_path,archive=archive,
+                                         codec={'codec': image_codec, 'threads': threads},journal=journal,
+                                         skip_existing=skip_existing)
+                    else:
+                        incremental_archive, incremental_codec=chain[index-1]
+                        ret=apply_incremental(name=image_name,path=image_path,archive=incremental_archive,
+                                              codec={'codec': incremental_codec, 'threads': threads},journal=journal)
+                    if not ret:
+                        break
+                    journal.save(applied=index + 1, member=None)
+                if not ret:
+                    logger.error("IMPORT: ERROR :: Encountered a problem importing osimage")
+                    print("ERROR :: Encountered a problem importing osimage")
+                    print("once the problem is solved, the same command with --resume carries on where it stopped")
+                    exit(4)
+                if not store and not journal.state.get('verified'):
+                    last_archive=chain[-1][0] if chain else archive
+                    last_archive.read_tail()
+                    hashes=last_archive.hashes()
+                    if hashes is None:
+                        logger.info(f"IMPORT: {image_name}: archive holds no hashes, not verified")
+                    elif not verify_path(path=image_path, hashes=hashes, threads=threads):
+                        # nothing to resume, the archive itself is off
+                        journal.remove()
+                        print(f"STOP :: osimage {image_name} at {image_path} does not match the archive, "
+                              "it is not registered")
+                        logger.error(f"IMPORT: STOP :: {image_name} at {image_path} failed verification")
+                        exit(4)
+                    journal.save(verified=True)
+                api_start=monotonic()
+                steps=journal.state.get('daemon', [])
                 # we HAVE to set a fake path as mother will kick in after some time to clean up the old image...
-                fakepath_image_config={'path': '/tmp/__doesnotexist__'}
-                myjson={'config': {'osimage': {image_name: fakepath_image_config}}}
-                r = requests.post(f'{CONF["PROTOCOL"]}://{CONF["ENDPOINT"]}/config/osimage/{image_name}', json=myjson, headers=headers, stream=True, timeout=10, verify=CONF["VERIFY_CERTIFICATE"])
-                logger.info(f"fake path return: {r.status_code}")
-                status_code=str(r.status_code)
-                if status_code not in ['201','204']:
-                    print(f"ERROR :: trouble processing request: {r.text}")
-                    logger.error(f"IMPORT: ERROR :: Error processing request: {r.text}")
-                    exit(2)
+                if 'fakepath' not in steps:
+                    fakepath_image_config={'path': '/tmp/__doesnotexist__'}
+                    myjson={'config': {'osimage': {image_name: fakepath_image_config}}}
+                    r = requests.post(f'{CONF["PROTOCOL"]}://{CONF["ENDPOINT"]}/config/osimage/{image_name}',
+                                      json=myjson, headers=headers, stream=True, timeout=10,
+                                      verify=CONF["VERIFY_CERTIFICATE"])
+                    logger.info(f"fake path return: {r.status_code}")
+                    status_code=str(r.status_code)
+                    if status_code not in ['201','204']:
+                        print(f"ERROR :: trouble processing request: {r.text}")
+                        logger.error(f"IMPORT: ERROR :: Error processing request: {r.text}")
+                        exit(2)
+                    journal.done('fakepath')
                 # now we set the image for deletion
-                r = requests.get(f'{CONF["PROTOCOL"]}://{CONF["ENDPOINT"]}/config/osimage/{image_name}/_delete', headers=headers, stream=True, timeout=10, verify=CONF["VERIFY_CERTIFICATE"])
-                logger.info(f"delete return: {r.status_code}")
-                status_code=str(r.status_code)
-                if status_code not in ['201','204']:
-                    print(f"ERROR :: trouble processing request: {r.text}")
-                    logger.error(f"IMPORT: ERROR :: Error processing request: {r.text}")
-                    exit(2)
+                if 'delete' not in steps:
+                    r = requests.get(f'{CONF["PROTOCOL"]}://{CONF["ENDPOINT"]}/config/osimage/{image_name}/_delete',
+                                     headers=headers, stream=True, timeout=10, verify=CONF["VERIFY_CERTIFICATE"])
+                    logger.info(f"delete return: {r.status_code}")
+                    status_code=str(r.status_code)
+                    if status_code not in ['201','204']:
+                        print(f"ERROR :: trouble processing request: {r.text}")
+                        logger.error(f"IMPORT: ERROR :: Error processing request: {r.text}")
+                        exit(2)
+                    journal.done('delete')
                 # and create the new image
                 myjson={'config': {'osimage': {image_name: image_config}}}
                 logger.info(f"myjson: {myjson}")
                 r = requests.post(f'{CONF["PROTOCOL"]}://{CONF["ENDPOINT"]}/config/osimage/{image_name}', json=myjson, headers=headers, stream=True, timeout=10, verify=CONF["VERIFY_CERTIFICATE"])
                 logger.info(f"add image returned: {r.status_code}")
                 status_code=str(r.status_code)
-                if status_code in ['201','204']:
-                    ret=unpack_image(name=image_name,path=image_path,image_file=image_file)
-                    if not ret:
-                        logger.error(f"IMPORT: ERROR :: Encountered a problem exporting osimage")
-                        print("ERROR :: Encountered a problem exporting osimage")
-                        exit(4)
-                else:
+                if status_code not in ['201','204']:
                     print(f"ERROR :: trouble processing request: {r.text}")
                     logger.error(f"IMPORT: ERROR :: Error processing request: {r.text}")
                     exit(2)
+                journal.remove()
+                logger.info(f"IMPORT: daemon api took {api_time + monotonic() - api_start:.2f}s")
                 print(f"finished importing {image_name}")
                 exit(0)
    
@@ -437,166 +756,1560 @@ def handleImageRequest(action=None,file=None,name=None,path=None,config_file=Non
 
 # ----------------------------------------------------------------------------
 
-def pack_image(cluster='cluster',name=None,path=None,image_file=None):
-    if name and path and image_file:
-        epoch_time = int(time())
-        packed_image_file = f"{TMP_DIR}/{image_file}"
-        if os.path.exists('/usr/bin/lbzip2') and os.path.exists('/usr/bin/tar'):
-            try:
-                output = subprocess.check_output(
-                    [
-                        '/usr/bin/tar',
-                        '-C', f"{path}",
-                        '--one-file-system',
-                        '--xattrs',
-                        '--selinux',
-                        '--acls',
-                        '--ignore-failed-read',
-                        '--exclude=/proc/*',
-                        '--exclude=/dev/*',
-                        '--exclude=/sys/*',
-                        '--exclude=/tmp/*',
-                        '--checkpoint=100000',
-                        '--use-compress-program=/usr/bin/lbzip2',
-                        '-c', '-f', packed_image_file, '.'
-                    ],
-                    stderr=subprocess.STDOUT,
-                    universal_newlines=True)
-            except subprocess.CalledProcessError as exc:
-                if os.path.isfile(packed_image_file):
-                    os.remove(packed_image_file)
-                output=f"{exc.output}"
-                outputs=output.split("\n")
-                joined='. '.join(outputs[-5:])
-                print(f"Tarring {name} failed with exit code {exc.returncode}: {joined}")
-                logger.error(f"Tarring {name} failed with exit code {exc.returncode}: {joined}")
-                return False
-            #print(f"Tarring {name} successful.")
-            return True
-        print("tar and bzip2 need to be installed")
-        logger.error(f"tar and/or bzip missing")
+def check_codec(codec: Optional[str] = None, level: Optional[int] = None) -> bool:
+    """
+    Verifies the codec is known, installed and the level is in its range.
+    """
+    if codec not in CODECS:
+        print(f"ERROR :: Unknown codec {codec}. Choose from {', '.join(CODECS)}.")
+        logger.error(f"Unknown codec {codec}")
+        return False
+    program=CODECS[codec]['program']
+    if program and not shutil.which(program):
+        print(f"ERROR :: {program} needs to be installed for codec {codec}")
+        logger.error(f"{program} missing for codec {codec}")
         return False
-    print("Not enough parameters to work with. could not continue due to missing osimage name or path")
-    logger.error(f"Not enough parameters to work with. could not continue due to missing osimage name or path")
-    return False
-
-def merge(file=None,image_file=None,tmp_dir=None,config=None):
-    if file and image_file and config:
-        with open(f"{TMP_DIR}/.config.dat",'w', encoding = "utf-8") as config_file:
-            config_file.write(config)
-        with open(f"{TMP_DIR}/.osimage.dat",'w', encoding = "utf-8") as osimage_file:
-            osimage_file.write(f"{image_file}")
-        if os.path.exists('/usr/bin/tar'):
+    levels=CODECS[codec]['levels']
+    if level is not None and (not levels or not levels[0] <= level <= levels[1]):
+        print(f"ERROR :: Level {level} is not supported by codec {codec}")
+        logger.error(f"Level {level} is not supported by codec {codec}")
+        return False
+    return True
+
+def codec_command(codec: str = DEFAULT_CODEC, level: Optional[int] = None, threads: Optional[int] = None,
+                  decompress: bool = False) -> Optional[list]:
+    """
+    Returns the compression or decompression command line of the codec as a list.
+    None for the codec 'none', meaning the data is passed as is.
+    """
+    settings=CODECS[codec]
+    if not settings['program']:
+        return None
+    command=[shutil.which(settings['program']) or settings['program']]
+    if decompress:
+        command.append('-dc')
+    else:
+        command+=['-c', f"-{level or settings['level']}"]
+    threads=threads or os.cpu_count() or 1
+    command+=[arg.format(threads=threads) for arg in settings['threads']]
+    return command
+
+def codec_for_file(image_file: Optional[str] = None) -> str:
+    """
+    Guesses the codec from the extension of the image file, for archives without a recorded codec.
+    """
+    for codec, settings in CODECS.items():
+        if settings['extension'] and image_file and image_file.endswith(f".tar{settings['extension']}"):
+            return codec
+    return DEFAULT_CODEC
+
+class Progress():
+    """
+    Keeps track of the bytes going through a pack or unpack and of the time spent waiting per
+    stage of the pipeline. On a terminal a progress line with throughput and ETA is kept up to
+    date, otherwise a JSON record is written every PROGRESS_RECORD_INTERVAL seconds, unless records
+    is False. Both go to stderr as stdout may carry the archive.
+    """
+
+    def __init__(self, action: Optional[str] = None, name: Optional[str] = None, total: Optional[int] = None,
+                 records: bool = True) -> None:
+        self.action = action
+        self.name = name
+        self.total = total
+        self.done = 0
+        self.stages = {}
+        self.start = monotonic()
+        self.reported = self.start
+        self.tty = sys.stderr.isatty()
+        self.records = records
+        self.interval = PROGRESS_INTERVAL if self.tty else PROGRESS_RECORD_INTERVAL
+        self.lock = threading.Lock()
+
+    def timed(self, stage: Optional[str] = None, seconds: float = 0, size: int = 0) -> None:
+        """
+        Books time spent on a stage and the bytes that went through, reporting once per interval.
+        """
+        with self.lock:
+            self.stages[stage] = self.stages.get(stage, 0) + seconds
+            self.done += size
+            now = monotonic()
+            if now - self.reported < self.interval:
+                return
+            self.reported = now
+        self.report(now)
+
+    def report(self, now: Optional[float] = None, final: bool = False) -> None:
+        """
+        Writes a progress line on a terminal, or a JSON record when records are asked for.
+        """
+        if not self.tty and not self.records:
+            return
+        elapsed = max((now or monotonic()) - self.start, 0.001)
+        rate = self.done / elapsed
+        eta = None
+        if self.total and rate:
+            eta = max(self.total - self.done, 0) / rate
+        if self.tty:
+            line = f"{self.action} {self.name}: {self.done / 1048576:.0f} MiB"
+            if self.total:
+                line += f" of {self.total / 1048576:.0f} MiB ({min(100 * self.done / self.total, 100):.0f}%)"
+            line += f" at {rate / 1048576:.1f} MiB/s"
+            if eta is not None and not final:
+                line += f", ETA {int(eta) // 60}:{int(eta) % 60:02d}"
+            print(f"\r{line}\033[K", end="\n" if final else "", file=sys.stderr, flush=True)
+        else:
+            record = {'action': self.action, 'name': self.name, 'bytes': self.done, 'total': self.total,
+                      'elapsed': round(elapsed, 1), 'rate': int(rate), 'eta': round(eta) if eta is not None else None}
+            if final:
+                record['stages'] = {stage: round(seconds, 2) for stage, seconds in self.stages.items()}
+            print(json.dumps(record), file=sys.stderr, flush=True)
+
+    def finish(self) -> None:
+        """
+        Writes the last progress line and logs the throughput and where the time went.
+        """
+        now = monotonic()
+        self.report(now, final=True)
+        elapsed = max(now - self.start, 0.001)
+        stages = ', '.join(f"{stage} {seconds:.1f}s" for stage, seconds in self.stages.items())
+        logger.info(f"{self.action.upper()}: {self.name}: {self.done} bytes in {elapsed:.1f}s, "
+                    f"{self.done / elapsed / 1048576:.1f} MiB/s, waited on {stages or 'nothing'}")
+
+
+class MeteredStream():
+    """
+    Wraps a file object of the pipeline. The time spent in its reads and writes is booked on
+    a stage of the progress, and with count the bytes as well.
+    """
+
+    def __init__(self, fileobj: Any = None, progress: Optional[Progress] = None, stage: Optional[str] = None,
+                 count: bool = False) -> None:
+        self.fileobj = fileobj
+        self.progress = progress
+        self.stage = stage
+        self.count = count
+
+    def read(self, size: int = -1) -> bytes:
+        """
+        Reads from the wrapped file object, booking the time on the stage.
+        """
+        start = monotonic()
+        data = self.fileobj.read(size)
+        self.progress.timed(self.stage, monotonic() - start, len(data) if self.count else 0)
+        return data
+
+    def write(self, data: Optional[bytes] = None) -> Optional[int]:
+        """
+        Writes to the wrapped file object, booking the time on the stage.
+        """
+        start = monotonic()
+        written = self.fileobj.write(data)
+        self.progress.timed(self.stage, monotonic() - start, len(data) if self.count else 0)
+        return written
+
+    def __getattr__(self, attribute: str) -> Any:
+        return getattr(self.fileobj, attribute)
+
+
+class HashingStream():
+    """
+    Wraps the tar output of an export. What is read through it is parsed by a thread as well,
+    which hashes the files as tar packed them, so the hashes match what an import unpacks
+    even when a file changes during the export. Nothing is read from the image twice.
+    """
+
+    def __init__(self, fileobj: Any = None, threads: Optional[int] = None) -> None:
+        self.fileobj = fileobj
+        self.hashes = {}
+        self.error = None
+        reader, writer = os.pipe()
+        self.sink = open(writer, 'wb')
+        self.thread = threading.Thread(target=self.parse, args=(reader, threads), daemon=True)
+        self.thread.start()
+
+    def parse(self, reader: Optional[int] = None, threads: Optional[int] = None) -> None:
+        """
+        Hashes the tar stream coming in through the pipe, run by the parser thread.
+        """
+        with open(reader, 'rb') as source:
             try:
-                output = subprocess.check_output(
-                    [
-                        '/usr/bin/tar',
-                        '-C', f"{TMP_DIR}/",
-                        '-cf', f"{file}", 
-                        '.config.dat',
-                        '.osimage.dat',
-                        f"{image_file}"
-                    ],
-                    stderr=subprocess.STDOUT,
-                    universal_newlines=True)
-            except subprocess.CalledProcessError as exc:
-                output=f"{exc.output}"
-                outputs=output.split("\n")
-                joined='. '.join(outputs[-5:])
-                print(f"Merging {file} failed with exit code {exc.returncode}: {joined}")
-                logger.error(f"Merging {file} failed with exit code {exc.returncode}: {joined}")
-                return False
-            return True
+                self.hashes = hash_tar(source, threads=threads)
+            except (OSError, tarfile.TarError) as exp:
+                self.error = exp
+            # the reads of the export must never block on a parser that gave up
+            while source.read(CHUNK_SIZE):
+                pass
+
+    def read(self, size: int = -1) -> bytes:
+        """
+        Reads from the tar output and hands the same bytes to the parser.
+        """
+        data = self.fileobj.read(size)
+        if data:
+            self.sink.write(data)
+        return data
+
+    def close(self) -> dict:
+        """
+        Returns the hashes once the whole tar stream has been parsed.
+        """
+        if not self.sink.closed:
+            self.sink.close()
+        self.thread.join()
+        if self.error:
+            raise OSError(f"hashing the packed files failed: {self.error}")
+        return self.hashes
+
+
+def pump(source: Any = None, sink: Any = None) -> None:
+    """
+    Copies the output of one pipeline process into the next one. Closes the sink when done,
+    a process that gave up shows in its exit code.
+    """
+    try:
+        while True:
+            chunk=source.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            sink.write(chunk)
+    except (BrokenPipeError, ValueError):
+        pass
+    finally:
+        try:
+            sink.close()
+        except OSError:
+            pass
+
+
+class ArchiveWriter():
+    """
+    Writes the outer osimage archive as a plain tar stream. Small members are added from memory,
+    the compressed image is streamed in as it is produced. Its header is written with a
+    placeholder size and rewritten once the size is known, so no copy of the image lands in TMP_DIR.
+    Pipes and files opened for appending cannot be rewound, there the image is written
+    as parts of PART_SIZE instead. Offsets are absolute, the archive may start anywhere.
+    """
+
+    def __init__(self, fileobj: Any = None) -> None:
+        self.fileobj = fileobj
+        self.rewindable = False
+        self.offset = 0
+        try:
+            if fileobj.seekable():
+                self.offset = fileobj.tell()
+                self.rewindable = not fcntl.fcntl(fileobj.fileno(), fcntl.F_GETFL) & os.O_APPEND
+        except (OSError, ValueError):
+            self.rewindable = False
+
+    def header(self, name: Optional[str] = None, size: int = 0) -> bytes:
+        """
+        Returns the GNU tar header of a regular member.
+        """
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mode = 0o644
+        info.mtime = int(time())
+        info.uid, info.gid = os.getuid(), os.getgid()
+        return info.tobuf(tarfile.GNU_FORMAT, 'utf-8', 'surrogateescape')
+
+    def write(self, data: Optional[bytes] = None) -> None:
+        """
+        Writes data at the current offset of the archive.
+        """
+        self.fileobj.write(data)
+        self.offset += len(data)
+
+    def pad(self, size: int = 0) -> None:
+        """
+        Pads a member of size bytes up to the tar block size.
+        """
+        remainder = size % tarfile.BLOCKSIZE
+        if remainder:
+            self.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+
+    def add(self, name: Optional[str] = None, data: Optional[bytes] = None) -> None:
+        """
+        Adds a member held in memory.
+        """
+        self.write(self.header(name, len(data)))
+        self.write(data)
+        self.pad(len(data))
+
+    def stream(self, name: Optional[str] = None, source: Any = None) -> int:
+        """
+        Streams source into one member of which the header is rewritten once the size is known.
+        """
+        if not self.rewindable:
+            return self.stream_parts(name, source)
+        header_offset = self.offset
+        # GNU format keeps sizes beyond 8GB in the same header block, so the rewrite fits
+        self.write(self.header(name, 0))
+        size = 0
+        while True:
+            chunk = source.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            self.write(chunk)
+            size += len(chunk)
+        self.pad(size)
+        self.fileobj.seek(header_offset)
+        self.fileobj.write(self.header(name, size))
+        self.fileobj.seek(self.offset)
+        return size
+
+    def stream_parts(self, name: Optional[str] = None, source: Any = None) -> int:
+        """
+        Streams source into members of PART_SIZE, for archives that cannot be rewound.
+        """
+        size, part, data = 0, 0, bytearray()
+        while True:
+            chunk = source.read(CHUNK_SIZE)
+            data += chunk
+            # an empty image still needs its first part
+            while len(data) >= PART_SIZE or (not chunk and (data or not part)):
+                piece = bytes(data[:PART_SIZE])
+                del data[:PART_SIZE]
+                self.add(f"{name}.part{part:06d}", piece)
+                size += len(piece)
+                part += 1
+            if not chunk:
+                return size
+
+    def close(self) -> None:
+        """
+        Writes the end of archive marker and flushes.
+        """
+        self.write(tarfile.NUL * tarfile.BLOCKSIZE * 2)
+        self.fileobj.flush()
+
+
+def tar_command(path: Optional[str] = None, listed: bool = False) -> list:
+    """
+    Returns the tar command line which packs the osimage at path to stdout.
+    When listed, only the null separated paths tar reads from stdin are packed.
+    """
+    return [
+        '/usr/bin/tar',
+        '-C', f"{path}",
+        '--one-file-system',
+        '--xattrs',
+        '--selinux',
+        '--acls',
+        '--ignore-failed-read',
+    ] + [f"--exclude=./{directory}/*" for directory in EXCLUDED_DIRS] + [
+        '-c', '-f', '-'
+    ] + (['--no-recursion', '--null', '-T', '-'] if listed else ['.'])
+
+def process_error(process: Optional[subprocess.Popen] = None, errors: Any = None) -> str:
+    """
+    Returns the last lines a failed pipeline process wrote to stderr.
+    """
+    errors.seek(0)
+    outputs=errors.read().decode('utf-8', 'replace').strip().split("\n")
+    return f"exit code {process.returncode}: {'. '.join(outputs[-5:])}"
+
+def kill_processes(processes: Optional[list] = None) -> None:
+    """
+    Stops what is left of a pipeline after a failure.
+    """
+    for process, _ in processes:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+
+def export_image(file: Optional[str] = None, name: Optional[str] = None, path: Optional[str] = None,
+                 image_file: Optional[str] = None, config: Optional[str] = None, codec: Optional[dict] = None,
+                 previous: Optional[dict] = None) -> bool:
+    """
+    Exports the osimage in a single pass: tar output is piped through the codec straight
+    into the image member of the final archive, after the .config.dat, .osimage.dat and
+    .manifest.dat members. With a previous manifest only what changed since is packed,
+    and the paths deleted since go into .deleted.dat. The files are hashed from the tar
+    stream as it is packed and the hashes close the archive as .hashes.dat.
+    """
+    if not (file and name and path and image_file and config):
+        print("Not enough parameters to work with. could not continue due to missing osimage name or path")
+        logger.error("Not enough parameters to work with. could not continue due to missing osimage name or path")
+        return False
+    if not os.path.exists('/usr/bin/tar'):
         print("tar needs to be installed")
+        logger.error("tar missing")
+        return False
+    codec=codec or {'codec': DEFAULT_CODEC}
+    compress=codec_command(codec['codec'], level=codec.get('level'), threads=codec.get('threads'))
+    processes, progress=[], None
+    try:
+        start=monotonic()
+        # the manifest is taken before packing, a file changing meanwhile is then part of the next incremental
+        manifest={'format': MANIFEST_FORMAT, 'version': 1, 'id': uuid.uuid4().hex, 'name': name,
+                  'created': int(time()), 'entries': scan_image(path)}
+        metadata={'image_file': image_file, 'codec': codec['codec'], 'id': manifest['id']}
+        hashes={}
+        if previous:
+            changed, deleted=compare_manifests(previous['entries'], manifest['entries'])
+            # unchanged files keep the hash of the previous export, so the last one in a chain covers the whole image
+            current={entry['path'] for entry in manifest['entries'] if entry['type'] == 'file'}
+            hashes={item: digest for item, digest in (previous.get('hashes') or {}).items() if item in current}
+            changed_set=set(changed)
+        progress=Progress('export', name, total=sum(entry.get('size', 0) for entry in manifest['entries']
+                          if entry['type'] == 'file' and (not previous or entry['path'] in changed_set)))
+        progress.stages['scan']=monotonic()-start
+        with (open(file, 'wb') if file != '-' else open(STDOUT.fileno(), 'wb', closefd=False)) as archive, \
+                tempfile.TemporaryFile(dir=TMP_DIR) as tar_errors, \
+                tempfile.TemporaryFile(dir=TMP_DIR) as codec_errors, \
+                tempfile.TemporaryFile(dir=TMP_DIR) as listing:
+            if previous:
+                metadata['parent']=previous.get('id')
+                listing.write(b''.join(os.fsencode('.' if item == '.' else f"./{item}") + b'\0' for item in changed))
+                listing.seek(0)
+                logger.info(f"EXPORT: incremental since {metadata['parent']}: "
+                            f"{len(changed)} changed, {len(deleted)} deleted")
+            writer=ArchiveWriter(MeteredStream(archive, progress, 'write'))
+            writer.add('.config.dat', config.encode('utf-8'))
+            writer.add('.osimage.dat', json.dumps(metadata).encode('utf-8'))
+            writer.add('.manifest.dat', json.dumps(manifest).encode('utf-8'))
+            if previous:
+                writer.add('.deleted.dat', json.dumps(deleted).encode('utf-8'))
+            command=tar_command(path, listed=bool(previous))
+            logger.info(f"EXPORT: {' '.join(command)} | {' '.join(compress or ['cat'])} > {file}:{image_file}")
+            processes.append((subprocess.Popen(command, stdin=listing if previous else subprocess.DEVNULL,
+                                               stdout=subprocess.PIPE, stderr=tar_errors), tar_errors))
+            hasher=HashingStream(MeteredStream(processes[0][0].stdout, progress, 'read', count=True),
+                                 threads=codec.get('threads'))
+            source=hasher
+            feeder=None
+            if compress:
+                processes.append((subprocess.Popen(compress, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                                   stderr=codec_errors), codec_errors))
+                # tar output is counted and hashed on its way into the codec
+                feeder=threading.Thread(target=pump, args=(source, processes[1][0].stdin), daemon=True)
+                feeder.start()
+                source=MeteredStream(processes[1][0].stdout, progress, 'compress')
+            size=writer.stream(image_file, source)
+            if feeder:
+                feeder.join()
+            failed=None
+            for process, errors in processes:
+                if process.wait() != 0 and not failed:
+                    failed=process_error(process, errors)
+            if failed:
+                raise OSError(failed)
+            start=monotonic()
+            hashes.update(hasher.close())
+            progress.stages['hash']=monotonic()-start
+            writer.add('.hashes.dat', json.dumps({'algorithm': 'sha256', 'hashes': hashes}).encode('utf-8'))
+            writer.close()
+        progress.finish()
+        logger.info(f"EXPORT: wrote {size} bytes of {image_file} to {file}")
+        return True
+    except (OSError, ValueError) as exp:
+        kill_processes(processes)
+        if progress:
+            progress.report(final=True)
+        if file != '-' and os.path.isfile(file):
+            os.remove(file)
+        print(f"Exporting {name} failed: {exp}")
+        logger.error(f"Exporting {name} failed: {exp}")
         return False
-    return False
 
-def unpack_image(name=None,path=None,image_file=None):
-    if name and path and image_file:
-        packed_image_file=f"{TMP_DIR}/{image_file}"
-        if os.path.exists('/usr/bin/lbzip2') and os.path.exists('/usr/bin/tar'):
+class ArchiveReader():
+    """
+    Reads the outer osimage archive as a stream, in a single pass. The config members at the head
+    are read into memory, the image member is then handed out as a file object to decompress from.
+    """
+
+    def __init__(self, fileobj: Any = None) -> None:
+        self.tar = tarfile.open(fileobj=fileobj, mode='r|')
+        self.members = {}
+        self.image = None
+        self.pending = None
+
+    def read_head(self) -> dict:
+        """
+        Reads the members in front of the image into memory and stops at the image member.
+        """
+        for member in self.tar:
+            if member.name.startswith('.') and member.name.endswith('.dat'):
+                self.members[member.name] = self.tar.extractfile(member).read().decode('utf-8')
+            elif member.isfile():
+                self.image = member
+                break
+        return self.members
+
+    def read_tail(self) -> dict:
+        """
+        Reads the members after the image, once the image has been streamed.
+        """
+        member = self.pending or self.tar.next()
+        self.pending = None
+        while member:
+            if member.name.startswith('.') and member.name.endswith('.dat'):
+                self.members[member.name] = self.tar.extractfile(member).read().decode('utf-8')
+            member = self.tar.next()
+        return self.members
+
+    def hashes(self) -> Optional[dict]:
+        """
+        Returns the hashes recorded at export, None when the archive predates them.
+        """
+        if '.hashes.dat' not in self.members:
+            return None
+        return json.loads(self.members['.hashes.dat']).get('hashes') or {}
+
+    def metadata(self) -> dict:
+        """
+        Returns the .osimage.dat of the archive, empty when it is missing or unreadable.
+        """
+        try:
+            metadata = json.loads(self.members.get('.osimage.dat') or '')
+        except ValueError:
+            metadata = None
+        return metadata if isinstance(metadata, dict) else {}
+
+    def image_stream(self) -> Any:
+        """
+        Returns a file object of the image, joining the parts when it was written in parts.
+        """
+        if self.image.name.endswith('.part000000'):
+            return PartsReader(self)
+        return self.tar.extractfile(self.image)
+
+    def close(self) -> None:
+        """
+        Closes the archive.
+        """
+        self.tar.close()
+
+
+class PartsReader():
+    """
+    Reads an image that was written to a pipe in parts as one stream.
+    """
+
+    def __init__(self, archive: Optional[ArchiveReader] = None) -> None:
+        self.archive = archive
+        self.prefix = archive.image.name[:-len('000000')]
+        self.current = archive.tar.extractfile(archive.image)
+
+    def read(self, size: int = -1) -> bytes:
+        """
+        Reads from the current part and moves on to the next one when it runs out.
+        """
+        while self.current:
+            data = self.current.read(size)
+            if data:
+                return data
+            member = self.archive.tar.next()
+            self.current = None
+            if member and member.name.startswith(self.prefix):
+                self.current = self.archive.tar.extractfile(member)
+            else:
+                # first member after the image, left for read_tail
+                self.archive.pending = member
+        return b''
+
+
+def unpack_image(name: Optional[str] = None, path: Optional[str] = None, archive: Optional[ArchiveReader] = None,
+                 codec: Optional[dict] = None, journal: Optional['Journal'] = None,
+                 skip_existing: bool = False) -> bool:
+    """
+    Pipes the image member of the archive through the codec into tar, no copy of it lands in TMP_DIR.
+    With skip_existing, files already at path are left as they are, for resumed imports.
+    With a journal, the member tar is unpacking is recorded in it, so a resume unpacks it again.
+    """
+    if not (name and path and archive and archive.image):
+        print("Not enough parameters to work with. could not continue due to missing osimage name or path")
+        logger.error("Not enough parameters to work with. could not continue due to missing osimage name or path")
+        return False
+    if not os.path.exists('/usr/bin/tar'):
+        print("tar needs to be installed")
+        logger.error("tar missing")
+        return False
+    codec=codec or {'codec': DEFAULT_CODEC}
+    decompress=codec_command(codec['codec'], threads=codec.get('threads'), decompress=True)
+    processes, member, listener=[], [None], None
+    try:
+        if not os.path.exists(f'{path}'):
+            os.makedirs(path)
+        with tempfile.TemporaryFile(dir=TMP_DIR) as codec_errors, tempfile.TemporaryFile(dir=TMP_DIR) as tar_errors:
+            command=['/usr/bin/tar', '-C', path, '-x', '-f', '-']
+            if skip_existing:
+                command.append('--skip-old-files')
+            tar_output=subprocess.DEVNULL
+            if journal:
+                # tar names every member on stdout before it unpacks it
+                command+=['-v', '--quoting-style=c']
+                tar_output=subprocess.PIPE
+            logger.info(f"UNPACK_IMAGE: {archive.image.name} | {' '.join(decompress or ['cat'])} | {' '.join(command)}")
+            if decompress:
+                processes.append((subprocess.Popen(decompress, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                                   stderr=codec_errors), codec_errors))
+                processes.append((subprocess.Popen(command, stdin=processes[0][0].stdout, stdout=tar_output,
+                                                   stderr=tar_errors), tar_errors))
+                # only tar should hold the read end of the codec pipe
+                processes[0][0].stdout.close()
+            else:
+                processes.append((subprocess.Popen(command, stdin=subprocess.PIPE, stdout=tar_output,
+                                                   stderr=tar_errors), tar_errors))
+            # an image in parts does not tell its size up front
+            progress=Progress('import', name,
+                              total=None if archive.image.name.endswith('.part000000') else archive.image.size)
+            source=MeteredStream(archive.image_stream(), progress, 'read', count=True)
+            sink=MeteredStream(processes[0][0].stdin, progress, 'decompress' if decompress else 'unpack')
+            if journal:
+                listener=threading.Thread(target=follow_members, args=(processes[-1][0].stdout, member), daemon=True)
+                listener.start()
             try:
-                if not os.path.exists(f'{path}'):
-                    os.makedirs(path)
-                    if not os.path.exists(f'{path}'):
-                        logger.error(f"Image path {path} could not be created")
-                        print(f"Image path {path} could not be created")
-                        return False
-                my_proc = subprocess.Popen(
-                    f"cd {path} && /usr/bin/lbzip2 -dc < {packed_image_file} | /usr/bin/tar xf -",
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    shell=True)
-                output = my_proc.communicate()
-                exit_code = my_proc.wait()
-                logger.info(f"UNPACK_IMAGE: file: {packed_image_file}, exit_code: {exit_code}, output: {output}")
-                if exit_code != 0:
-                    print(f"Untarring failed: {output[1]}")
-                    logger.error(f"Untarring failed: {output[1]}")
-                    return False
-            except subprocess.CalledProcessError as exc:
-                output=f"{exc.output}"
-                outputs=output.split("\n")
-                joined='. '.join(outputs[-5:])
-                print(f"Untarring {name} failed with exit code {exc.returncode}: {joined}")
-                logger.error(f"Untarring {name} failed with exit code {exc.returncode}: {joined}")
-                return False
-            except Exception as exp:
-                print(f"Untarring {name} failed: {exp}")
-                logger.error(f"Untarring {name} failed: {exp}")
-                return False
-            #print(f"Untarring {name} successful.")
-            return True
-        print("tar and bzip2 need to be installed")
-        logger.error(f"tar and/or bzip missing")
+                while True:
+                    chunk=source.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    sink.write(chunk)
+                    if journal:
+                        journal.checkpoint(member=member[0])
+                sink.close()
+            except BrokenPipeError:
+                # the pipeline gave up, its exit codes below tell why
+                pass
+            start=monotonic()
+            failed=None
+            for process, errors in processes:
+                if process.wait() != 0 and not failed:
+                    failed=process_error(process, errors)
+            progress.timed('unpack', monotonic()-start)
+            progress.finish()
+            if failed:
+                raise OSError(failed)
+        logger.info(f"UNPACK_IMAGE: {archive.image.name} unpacked into {path}")
+        return True
+    except (OSError, ValueError, tarfile.TarError) as exp:
+        kill_processes(processes)
+        if listener:
+            # with tar gone its output ends, the last member named is the one that may be cut short
+            listener.join()
+            journal.save(member=member[0])
+        print(f"Untarring {name} failed: {exp}")
+        logger.error(f"Untarring {name} failed: {exp}")
         return False
-    print("Not enough parameters to work with. could not continue due to missing osimage name or path")
-    logger.error(f"Not enough parameters to work with. could not continue due to missing osimage name or path")
-    return False
 
-def unmerge(file=None):
+def follow_members(output: Any = None, member: Optional[list] = None) -> None:
+    """
+    Reads the member names a verbose tar extraction writes in C quoting and keeps the last one
+    in member[0]. Reads until tar closes its output, so tar never blocks on it.
+    """
+    for line in output:
+        line=line.rstrip(b'\n')
+        if len(line) > 1 and line.startswith(b'"') and line.endswith(b'"'):
+            member[0]=os.fsdecode(codecs.escape_decode(line[1:-1])[0])
+    output.close()
+
+def unmerge(file: Optional[str] = None) -> tuple:
+    """
+    Opens the archive and reads the config from its head. The returned reader is positioned
+    at the image member, which unpack_image then streams from.
+    """
     if file:
-        config, image_file = None, None
-        if os.path.exists('/usr/bin/tar'):
+        try:
+            archive=ArchiveReader(open(file, 'rb') if file != '-' else sys.stdin.buffer)
+            members=archive.read_head()
+            config=json.loads(members['.config.dat']) if '.config.dat' in members else None
+            image_file, codec=read_osimage_dat(members.get('.osimage.dat'))
+            if not archive.image:
+                raise ValueError("no osimage found in the archive")
+            if image_file and archive.image.name not in [image_file, f"{image_file}.part000000"]:
+                raise ValueError(f"expected image {image_file} but found {archive.image.name}")
+            return archive, config, image_file, codec
+        except (OSError, ValueError, tarfile.TarError) as exp:
+            print(f"Unmerging {file} failed: {exp}")
+            logger.error(f"Unmerging {file} failed: {exp}")
+    return None, None, None, None
+
+def read_osimage_dat(data: Optional[str] = None) -> tuple:
+    """
+    Parses .osimage.dat. Older exports only hold the image file name, newer ones
+    a json document with the image file name and the codec.
+    """
+    try:
+        osimage=json.loads(data)
+    except (TypeError, ValueError):
+        osimage=None
+    if not isinstance(osimage, dict):
+        image_file=(data or '').strip()
+        return image_file, codec_for_file(image_file)
+    return osimage.get('image_file'), osimage.get('codec') or codec_for_file(osimage.get('image_file'))
+
+def walk_image(path: Optional[str] = None) -> Iterator[tuple]:
+    """
+    Walks the osimage the way the export tar does: symlinks are not followed and other filesystems
+    as well as the contents of proc, dev, sys and tmp are skipped. Yields relative paths with their
+    lstat, parents before their children, starting with the image root itself as '.'.
+    """
+    root=os.lstat(path)
+    yield '.', root
+    pending=['']
+    while pending:
+        relative=pending.pop()
+        with os.scandir(os.path.join(path, relative) if relative else path) as entries:
+            for entry in entries:
+                item=f"{relative}/{entry.name}" if relative else entry.name
+                item_stat=entry.stat(follow_symlinks=False)
+                yield item, item_stat
+                if not stat.S_ISDIR(item_stat.st_mode) or item_stat.st_dev != root.st_dev:
+                    continue
+                if not relative and entry.name in EXCLUDED_DIRS:
+                    continue
+                pending.append(item)
+
+def manifest_entry(path: Optional[str] = None, item: Optional[str] = None,
+                   item_stat: Optional[os.stat_result] = None) -> Optional[dict]:
+    """
+    Returns the manifest entry of a walked path, without content.
+    """
+    entry={'path': item, 'mode': stat.S_IMODE(item_stat.st_mode), 'uid': item_stat.st_uid,
+           'gid': item_stat.st_gid, 'mtime': item_stat.st_mtime_ns}
+    for kind, check in [('dir', stat.S_ISDIR), ('file', stat.S_ISREG), ('symlink', stat.S_ISLNK),
+                        ('char', stat.S_ISCHR), ('block', stat.S_ISBLK), ('fifo', stat.S_ISFIFO)]:
+        if check(item_stat.st_mode):
+            entry['type']=kind
+            break
+    if entry.get('type') in ['char', 'block']:
+        entry['rdev']=item_stat.st_rdev
+    elif entry.get('type') == 'file':
+        entry['size']=item_stat.st_size
+        entry['inode']=item_stat.st_ino
+    elif entry.get('type') == 'symlink':
+        entry['target']=os.readlink(os.path.join(path, item))
+    return entry
+
+def scan_image(path: Optional[str] = None) -> list:
+    """
+    Returns the manifest entries of all paths in the osimage.
+    """
+    return [entry for entry in (manifest_entry(path, item, item_stat) for item, item_stat in walk_image(path))
+            if 'type' in entry]
+
+def compare_manifests(previous: Optional[list] = None, current: Optional[list] = None) -> tuple:
+    """
+    Compares two lists of manifest entries. Returns the paths that are new or changed, in walk order,
+    and the paths that are gone. Paths which changed type are in both, so they are replaced.
+    Parent directories of all of these are listed as changed too, to restore their mtimes after import.
+    """
+    before={entry['path']: entry for entry in previous}
+    changed, deleted=set(), []
+    for entry in current:
+        old=before.pop(entry['path'], None)
+        if old is None:
+            changed.add(entry['path'])
+        elif old.get('type') != entry['type']:
+            changed.add(entry['path'])
+            deleted.append(entry['path'])
+        elif any(old.get(key, entry.get(key)) != entry.get(key, old.get(key)) for key in MANIFEST_KEYS):
+            changed.add(entry['path'])
+    deleted.extend(before)
+    for item in list(changed) + deleted:
+        while item != '.':
+            item=os.path.dirname(item) or '.'
+            changed.add(item)
+    return [entry['path'] for entry in current if entry['path'] in changed], deleted
+
+def read_members(source: Any = None) -> dict:
+    """
+    Reads the .dat members of an archive on disk, seeking past the image instead of reading it.
+    """
+    members={}
+    with tarfile.open(fileobj=source, mode='r:') as tar:
+        for member in tar:
+            if member.name.startswith('.') and member.name.endswith('.dat'):
+                members[member.name]=tar.extractfile(member).read().decode('utf-8')
+    return members
+
+def read_previous(file: Optional[str] = None) -> Optional[dict]:
+    """
+    Reads the manifest of a previous export, which is either a manifest or an archive holding one.
+    """
+    try:
+        with open(file, 'rb') as source:
+            if source.read(1) == b'{':
+                source.seek(0)
+                manifest=json.load(source)
+            else:
+                source.seek(0)
+                members=read_members(source)
+                if '.manifest.dat' not in members:
+                    raise ValueError("the archive has no manifest, it predates incremental exports")
+                manifest=json.loads(members['.manifest.dat'])
+                if '.hashes.dat' in members:
+                    manifest['hashes']=json.loads(members['.hashes.dat']).get('hashes')
+        if not isinstance(manifest, dict) or manifest.get('format') != MANIFEST_FORMAT:
+            raise ValueError("not an osimage manifest")
+        return manifest
+    except (OSError, ValueError, tarfile.TarError) as exp:
+        print(f"Reading previous export {file} failed: {exp}")
+        logger.error(f"Reading previous export {file} failed: {exp}")
+        return None
+
+def apply_incremental(name: Optional[str] = None, path: Optional[str] = None, archive: Optional[ArchiveReader] = None,
+                      codec: Optional[dict] = None, journal: Optional['Journal'] = None) -> bool:
+    """
+    Applies an incremental export to the image at path: removes what was deleted, then unpacks what changed.
+    """
+    try:
+        deleted=json.loads(archive.members.get('.deleted.dat') or '[]')
+        for item in sorted(deleted, key=lambda item: item.count('/'), reverse=True):
+            target=safe_path(path, item)
+            if os.path.isdir(target) and not os.path.islink(target):
+                shutil.rmtree(target)
+            elif os.path.lexists(target):
+                os.remove(target)
+    except (OSError, ValueError) as exp:
+        print(f"Applying incremental export to {name} failed: {exp}")
+        logger.error(f"Applying incremental export to {name} failed: {exp}")
+        return False
+    logger.info(f"IMPORT: incremental {archive.metadata().get('id')} removed {len(deleted)} paths from {path}")
+    return unpack_image(name=name,path=path,archive=archive,codec=codec,journal=journal)
+
+class Journal():
+    """
+    Checkpoint journal of an osimage import, kept next to the image path. It records the archives
+    being imported, how many of them are unpacked, the member of the current one tar was unpacking,
+    whether the result was verified and which daemon steps were done, so --resume can carry on.
+    """
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self.file = f"{path.rstrip('/')}.lexport-journal"
+        self.state = {}
+        self.saved = 0
+
+    def load(self) -> Optional[dict]:
+        """
+        Reads the journal, None when there is none or it cannot be read.
+        """
+        try:
+            with open(self.file, 'r', encoding='utf-8') as journal_file:
+                self.state = json.load(journal_file)
+        except (OSError, ValueError):
+            return None
+        return self.state
+
+    def save(self, **fields: Any) -> None:
+        """
+        Updates the journal with fields and writes it out at once.
+        """
+        self.state.update(fields)
+        self.saved = monotonic()
+        temporary = f"{self.file}.{os.getpid()}"
+        try:
+            with open(temporary, 'w', encoding='utf-8') as journal_file:
+                json.dump(self.state, journal_file)
+            os.replace(temporary, self.file)
+        except OSError as exp:
+            # a full disk is a likely reason to end up here, the import itself decides what happens next
+            logger.warning(f"IMPORT: could not write journal {self.file}: {exp}")
+
+    def checkpoint(self, **fields: Any) -> None:
+        """
+        Saves fields when the last save is JOURNAL_INTERVAL seconds ago.
+        """
+        if monotonic() - self.saved >= JOURNAL_INTERVAL:
+            self.save(**fields)
+
+    def done(self, step: Optional[str] = None) -> None:
+        """
+        Records a daemon step as done.
+        """
+        self.save(daemon=self.state.get('daemon', []) + [step])
+
+    def remove(self) -> None:
+        """
+        Removes the journal once the import is complete.
+        """
+        if os.path.exists(self.file):
+            os.remove(self.file)
+
+
+def resume_point(name: Optional[str] = None, path: Optional[str] = None, archive: Optional[ArchiveReader] = None,
+                 member: Optional[str] = None) -> bool:
+    """
+    Takes the image at path back to the last consistent point of a failed unpack of archive.
+    The member the journal has tar unpacking last is removed, it may have been cut short. So are
+    the files of which size or mtime differ from the manifest, as tar sets the mtime of a file once
+    it is written completely. Returns False when the archive predates manifests, then everything
+    has to be unpacked again.
+    """
+    if '.manifest.dat' not in archive.members:
+        return False
+    removed=0
+    if member and os.path.normpath(member) != '.':
+        target=safe_path(path, os.path.normpath(member))
+        if os.path.isfile(target) and not os.path.islink(target):
+            os.remove(target)
+            removed+=1
+    for entry in json.loads(archive.members['.manifest.dat'])['entries']:
+        if entry['type'] != 'file':
+            continue
+        target=safe_path(path, entry['path'])
+        try:
+            item_stat=os.lstat(target)
+        except FileNotFoundError:
+            continue
+        if stat.S_ISDIR(item_stat.st_mode):
+            continue
+        # archives keep whole seconds unless tar went for the posix format
+        if not stat.S_ISREG(item_stat.st_mode) or item_stat.st_size != entry['size'] \
+                or item_stat.st_mtime_ns // 1000000000 != entry['mtime'] // 1000000000:
+            os.remove(target)
+            removed+=1
+    logger.info(f"IMPORT: resuming {name} at {path}, removed {removed} files that were cut short")
+    return True
+
+def safe_path(path: Optional[str] = None, item: Optional[str] = None) -> str:
+    """
+    Joins a manifest path to the image path, refusing paths that would end up outside of it.
+    """
+    if item == '.':
+        return path
+    if os.path.isabs(item) or '..' in item.split('/'):
+        raise ValueError(f"refusing unsafe path {item} in manifest")
+    return os.path.join(path, item)
+
+
+class ChunkStore():
+    """
+    Content addressed store of osimage file chunks. Every chunk is kept once under the sha256
+    of its content, so revisions of an image only add the chunks that changed.
+    """
+
+    def __init__(self, directory: Optional[str] = None) -> None:
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.new_chunks = 0
+        self.new_bytes = 0
+
+    def object_path(self, digest: Optional[str] = None) -> str:
+        """
+        Returns the path of a chunk in the store.
+        """
+        return os.path.join(self.directory, 'objects', digest[:2], digest)
+
+    def has(self, digest: Optional[str] = None) -> bool:
+        """
+        Checks if the store holds a chunk.
+        """
+        return os.path.exists(self.object_path(digest))
+
+    def put(self, data: Optional[bytes] = None) -> str:
+        """
+        Stores a chunk unless it is there already and returns its digest.
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        target = self.object_path(digest)
+        if os.path.exists(target):
+            return digest
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        temporary = f"{target}.{os.getpid()}.{threading.get_ident()}"
+        with open(temporary, 'wb') as chunk_file:
+            chunk_file.write(data)
+        os.replace(temporary, target)
+        with self.lock:
+            self.new_chunks += 1
+            self.new_bytes += len(data)
+        return digest
+
+    def put_file(self, filename: Optional[str] = None) -> list:
+        """
+        Stores a file in chunks of STORE_CHUNK_SIZE and returns their digests.
+        """
+        chunks = []
+        with open(filename, 'rb') as source:
+            while True:
+                data = source.read(STORE_CHUNK_SIZE)
+                if not data:
+                    break
+                chunks.append(self.put(data))
+        return chunks
+
+    def get_file(self, filename: Optional[str] = None, chunks: Optional[list] = None) -> None:
+        """
+        Writes a file back from its chunks.
+        """
+        with open(filename, 'wb') as target:
+            for digest in chunks:
+                with open(self.object_path(digest), 'rb') as chunk_file:
+                    target.write(chunk_file.read())
+
+
+def export_store(file: Optional[str] = None, name: Optional[str] = None, path: Optional[str] = None,
+                 config: Optional[str] = None, store: Optional[str] = None, threads: Optional[int] = None) -> bool:
+    """
+    Exports the osimage into the chunk store. The export itself becomes a small manifest with
+    the config and, per path, its metadata and the chunks holding its content.
+    """
+    if not (file and name and path and config and store):
+        print("Not enough parameters to work with. could not continue due to missing osimage name or path")
+        logger.error("Not enough parameters to work with. could not continue due to missing osimage name or path")
+        return False
+    chunk_store=ChunkStore(store)
+    entries, jobs, inodes, total = [], {}, {}, 0
+    try:
+        with ThreadPoolExecutor(max_workers=threads or os.cpu_count() or 1) as executor:
+            for item, item_stat in walk_image(path):
+                entry=manifest_entry(path, item, item_stat)
+                if 'type' not in entry:
+                    continue
+                if entry['type'] == 'file':
+                    inode=(item_stat.st_dev, item_stat.st_ino)
+                    if item_stat.st_nlink > 1 and inode in inodes:
+                        entry={'path': item, 'type': 'hardlink', 'link': inodes[inode]}
+                    else:
+                        inodes[inode]=item
+                        total+=item_stat.st_size
+                        jobs[executor.submit(chunk_store.put_file, os.path.join(path, item))]=entry
+                entries.append(entry)
+            for future, entry in jobs.items():
+                entry['chunks']=future.result()
+        manifest={'format': MANIFEST_FORMAT, 'version': 1, 'id': uuid.uuid4().hex, 'name': name,
+                  'config': json.loads(config),
+                  'chunk_size': STORE_CHUNK_SIZE, 'created': int(time()), 'entries': entries}
+        if file == '-':
+            json.dump(manifest, STDOUT)
+            STDOUT.flush()
+        else:
+            with open(file, 'w', encoding='utf-8') as manifest_file:
+                json.dump(manifest, manifest_file)
+    except (OSError, ValueError) as exp:
+        print(f"Exporting {name} into store {store} failed: {exp}")
+        logger.error(f"Exporting {name} into store {store} failed: {exp}")
+        return False
+    print(f"stored {chunk_store.new_chunks} new chunks, {chunk_store.new_bytes} of {total} bytes, "
+          f"for {len(entries)} paths")
+    logger.info(f"EXPORT: store {store}: {chunk_store.new_chunks} new chunks, {chunk_store.new_bytes} of {total} bytes")
+    return True
+
+def read_manifest(file: Optional[str] = None, store: Optional[str] = None) -> Optional[dict]:
+    """
+    Reads a store manifest and checks that the store holds every chunk it refers to.
+    Returns the manifest or None.
+    """
+    try:
+        if file == '-':
+            manifest=json.load(sys.stdin)
+        else:
+            with open(file, 'r', encoding='utf-8') as manifest_file:
+                manifest=json.load(manifest_file)
+        if not isinstance(manifest, dict) or manifest.get('format') != MANIFEST_FORMAT:
+            raise ValueError("not an osimage manifest")
+    except (OSError, ValueError) as exp:
+        print(f"Reading manifest {file} failed: {exp}")
+        logger.error(f"Reading manifest {file} failed: {exp}")
+        return None
+    chunk_store=ChunkStore(store)
+    missing=set()
+    for entry in manifest['entries']:
+        missing.update(digest for digest in entry.get('chunks', []) if not chunk_store.has(digest))
+    if missing:
+        print(f"STOP :: store {store} misses {len(missing)} chunks of this manifest")
+        logger.error(f"IMPORT: STOP :: store {store} misses {len(missing)} chunks")
+        return None
+    return manifest
+
+def restore_store(name: Optional[str] = None, path: Optional[str] = None, manifest: Optional[dict] = None,
+                  store: Optional[str] = None, threads: Optional[int] = None) -> bool:
+    """
+    Reassembles the osimage at path from the manifest and the chunk store.
+    """
+    chunk_store=ChunkStore(store)
+    entries=manifest['entries']
+    try:
+        os.makedirs(path, exist_ok=True)
+        for entry in entries:
+            if entry['type'] == 'dir':
+                os.makedirs(safe_path(path, entry['path']), exist_ok=True)
+        with ThreadPoolExecutor(max_workers=threads or os.cpu_count() or 1) as executor:
+            jobs=[executor.submit(chunk_store.get_file, safe_path(path, entry['path']), entry['chunks'])
+                  for entry in entries if entry['type'] == 'file']
+            for future in jobs:
+                future.result()
+        for entry in entries:
+            target=safe_path(path, entry['path'])
+            if entry['type'] == 'symlink':
+                os.symlink(entry['target'], target)
+            elif entry['type'] == 'hardlink':
+                os.link(safe_path(path, entry['link']), target)
+            elif entry['type'] in ['char', 'block', 'fifo']:
+                kind={'char': stat.S_IFCHR, 'block': stat.S_IFBLK, 'fifo': stat.S_IFIFO}[entry['type']]
+                os.mknod(target, kind | entry['mode'], entry.get('rdev', 0))
+        # ownership before modes as chown clears setuid bits, directories last for their mtimes
+        for entry in sorted(entries, key=lambda entry: entry['type'] == 'dir'):
+            if entry['type'] == 'hardlink':
+                continue
+            target=safe_path(path, entry['path'])
+            os.lchown(target, entry['uid'], entry['gid'])
+            if entry['type'] != 'symlink':
+                os.chmod(target, entry['mode'])
+            os.utime(target, ns=(entry['mtime'], entry['mtime']), follow_symlinks=False)
+    except (OSError, ValueError) as exp:
+        print(f"Restoring {name} from store {store} failed: {exp}")
+        logger.error(f"Restoring {name} from store {store} failed: {exp}")
+        return False
+    logger.info(f"IMPORT: restored {len(entries)} paths of {name} from store {store} into {path}")
+    return True
+
+def hash_file(filename: Optional[str] = None) -> str:
+    """
+    Returns the sha256 of a file, read in CHUNK_SIZE blocks. hashlib lets go of the GIL, so a pool of these scales.
+    """
+    digest=hashlib.sha256()
+    with open(filename, 'rb') as source:
+        while True:
+            data=source.read(CHUNK_SIZE)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+def hash_data(data: Optional[bytes] = None) -> str:
+    """
+    Returns the sha256 of data held in memory.
+    """
+    return hashlib.sha256(data).hexdigest()
+
+def hash_tar(source: Any = None, threads: Optional[int] = None) -> dict:
+    """
+    Returns the sha256 of every file in a tar stream, read to its very end. Small files are
+    hashed by a pool of workers, bigger ones as they stream by.
+    """
+    actual, jobs, links={}, {}, {}
+    with ThreadPoolExecutor(max_workers=threads or os.cpu_count() or 1) as executor, \
+            tarfile.open(fileobj=source, mode='r|') as inner:
+        for member in inner:
+            if member.islnk():
+                links[os.path.normpath(member.name)]=os.path.normpath(member.linkname)
+            if not member.isfile():
+                continue
+            item=os.path.normpath(member.name)
+            data=inner.extractfile(member)
+            if member.size <= VERIFY_POOL_SIZE:
+                jobs[executor.submit(hash_data, data.read())]=item
+                continue
+            digest=hashlib.sha256()
+            while True:
+                chunk=data.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+            actual[item]=digest.hexdigest()
+        for future, item in jobs.items():
+            actual[item]=future.result()
+    # a hard link carries no content of its own, it has the hash of the file it links to
+    for item, target in links.items():
+        if target in actual:
+            actual[item]=actual[target]
+    # tar stops at its end marker, the record padding behind it still has to be read
+    while source.read(CHUNK_SIZE):
+        pass
+    return actual
+
+def compare_hashes(name: Optional[str] = None, expected: Optional[dict] = None, actual: Optional[dict] = None,
+                   complete: bool = True) -> bool:
+    """
+    Reports the files of which the hash differs from the expected one, and with complete,
+    the files that are missing. Returns True when all is well.
+    """
+    mismatches=sorted(item for item, digest in actual.items() if item in expected and expected[item] != digest)
+    missing=sorted(item for item in expected if item not in actual) if complete else []
+    for item in mismatches[:10]:
+        print(f"MISMATCH :: {item}")
+    for item in missing[:10]:
+        print(f"MISSING :: {item}")
+    if mismatches or missing:
+        print(f"{name}: {len(mismatches)} files differ and {len(missing)} are missing out of {len(expected)}")
+        logger.error(f"VERIFY: {name}: {len(mismatches)} files differ, {len(missing)} missing out of {len(expected)}")
+        return False
+    logger.info(f"VERIFY: {name}: {len(actual)} files verified")
+    return True
+
+def verify_path(path: Optional[str] = None, hashes: Optional[dict] = None, threads: Optional[int] = None) -> bool:
+    """
+    Checks the osimage at path against the hashes of the export, hashing with a pool of workers.
+    """
+    actual={}
+    with ThreadPoolExecutor(max_workers=threads or os.cpu_count() or 1) as executor:
+        jobs={executor.submit(hash_file, safe_path(path, item)): item for item in hashes}
+        for future, item in jobs.items():
+            try:
+                actual[item]=future.result()
+            except OSError:
+                pass
+    return compare_hashes(name=path, expected=hashes, actual=actual)
+
+def verify_archive(file: Optional[str] = None, threads: Optional[int] = None) -> bool:
+    """
+    Checks the files inside an archive against its hashes, in one pass over the archive.
+    The image is decompressed by the codec while its files are hashed by a pool of workers.
+    """
+    archive, _, _, image_codec=unmerge(file=file)
+    if not archive or not check_codec(codec=image_codec):
+        return False
+    decompress=codec_command(image_codec, threads=threads, decompress=True)
+    actual, failed={}, []
+    with tempfile.TemporaryFile(dir=TMP_DIR) as codec_errors:
+        image=archive.image_stream()
+        source=image
+        process=None
+        if decompress:
+            process=subprocess.Popen(decompress, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=codec_errors)
+
+            def feed() -> None:
+                try:
+                    while True:
+                        chunk=image.read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        process.stdin.write(chunk)
+                except (OSError, tarfile.TarError) as exp:
+                    failed.append(str(exp))
+                finally:
+                    try:
+                        process.stdin.close()
+                    except OSError:
+                        pass
+
+            feeder=threading.Thread(target=feed, daemon=True)
+            feeder.start()
+            source=process.stdout
+        try:
+            actual=hash_tar(source, threads=threads)
+        except (OSError, tarfile.TarError) as exp:
+            failed.append(str(exp))
+        if process:
+            feeder.join()
+            if process.wait() != 0:
+                failed.append(process_error(process, codec_errors))
+    if failed:
+        print(f"Verifying {file} failed: {failed[0]}")
+        logger.error(f"VERIFY: {file} failed: {failed}")
+        return False
+    archive.read_tail()
+    hashes=archive.hashes()
+    if hashes is None:
+        print(f"STOP :: {file} holds no hashes, it predates verification")
+        return False
+    # an incremental archive only holds what changed, the hashes cover the whole image
+    return compare_hashes(name=file, expected=hashes, actual=actual, complete=not archive.metadata().get('parent'))
+
+def verify_request(file: Optional[str] = None, path: Optional[str] = None, threads: Optional[int] = None) -> bool:
+    """
+    Verifies an archive, or with a path the osimage at that path against the archive.
+    """
+    if file != '-' and not os.path.isfile(file):
+        print(f"STOP :: {file} does not exist")
+        return False
+    if not path:
+        ret=verify_archive(file=file, threads=threads)
+    else:
+        try:
+            with open(file, 'rb') as source:
+                members=read_members(source)
+        except (OSError, tarfile.TarError) as exp:
+            print(f"Reading {file} failed: {exp}")
+            logger.error(f"VERIFY: reading {file} failed: {exp}")
+            return False
+        if '.hashes.dat' not in members:
+            print(f"STOP :: {file} holds no hashes, it predates verification")
+            return False
+        ret=verify_path(path=path, hashes=json.loads(members['.hashes.dat']).get('hashes') or {}, threads=threads)
+    if ret:
+        print(f"{path or file} verified")
+    return ret
+
+class ConfigReader():
+    """
+    Reads a cluster export incrementally. The sections under config are walked object by object
+    with raw_decode, so only a buffer and the object at hand are held in memory. It reads from
+    a file, or from an iterator of text chunks like a streamed http response.
+    """
+
+    def __init__(self, source: Any = None, chunks: Optional[Iterator[str]] = None) -> None:
+        self.source = source
+        self.chunks = chunks
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.position = 0
+        self.eof = False
+
+    def fill(self) -> bool:
+        """
+        Reads the next chunk into the buffer. Returns False at the end of the input.
+        """
+        if self.eof:
+            return False
+        data = next(self.chunks, '') if self.chunks else self.source.read(CHUNK_SIZE)
+        if not data:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.position:] + data
+        self.position = 0
+        return True
+
+    def peek(self) -> Optional[str]:
+        """
+        Skips whitespace and returns the next character, or None at the end.
+        """
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in ' \t\r\n':
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self.fill():
+                return None
+
+    def expect(self, characters: Optional[str] = None) -> str:
+        """
+        Consumes the next character, which has to be one of characters.
+        """
+        character = self.peek()
+        if character is None or character not in characters:
+            raise ValueError(f"expected {' or '.join(characters)} but found {character or 'the end'}")
+        self.position += 1
+        return character
+
+    def value(self) -> Any:
+        """
+        Decodes the next JSON value, reading on while it continues past the buffer.
+        """
+        self.peek()
+        while True:
             try:
-                output = subprocess.check_output(
-                    [
-                        '/usr/bin/tar', '-C', f"{TMP_DIR}",
-                        '-xf', f"{file}",
-                        '.config.dat',
-                        '.osimage.dat'
-                    ],
-                    stderr=subprocess.STDOUT,
-                    universal_newlines=True)
-                with open(f"{TMP_DIR}/.config.dat",'r', encoding = "utf-8") as config_file:
-                    data=config_file.read()
-                    config=json.loads(data)
-                with open(f"{TMP_DIR}/.osimage.dat",'r', encoding = "utf-8") as osimage_file:
-                    image_file=osimage_file.read()
-                if image_file:
-                    output = subprocess.check_output(
-                        [
-                            '/usr/bin/tar', '-C', f"{TMP_DIR}",
-                            '-xf', f"{file}",
-                            f'{image_file}'
-                        ],
-                        stderr=subprocess.STDOUT,
-                        universal_newlines=True)
-            except subprocess.CalledProcessError as exc:
-                output=f"{exc.output}"
-                outputs=output.split("\n")
-                joined='. '.join(outputs[-5:])
-                print(f"Unmerging {file} failed with exit code {exc.returncode}: {joined}")
-                logger.error(f"Unmerging {file} failed with exit code {exc.returncode}: {joined}")
-                return None, None
-            except Exception as exp:
-                print(f"Unmerging {file} failed: {exp}")
-                logger.error(f"Unmerging {file} failed: {exp}")
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+                # a number at the end of the buffer may go on in the next read
+                if end < len(self.buffer) or self.eof:
+                    self.position = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+    def members(self) -> Iterator[str]:
+        """
+        Yields the keys of an object, the caller reads each value before asking for the next key.
+        """
+        self.expect('{')
+        if self.peek() == '}':
+            self.position += 1
+            return
+        while True:
+            key = self.value()
+            if not isinstance(key, str):
+                raise ValueError(f"expected a key but found {key}")
+            self.expect(':')
+            yield key
+            if self.expect(',}') == '}':
+                return
+
+    def objects(self) -> Iterator[tuple]:
+        """
+        Yields section, name and object for every object in the export. The cluster section,
+        and any section that is not a collection of named objects, comes as a whole with name None.
+        """
+        for key in self.members():
+            if key != 'config':
+                self.value()
+                continue
+            for section in self.members():
+                if section != 'cluster' and self.peek() == '{':
+                    for name in self.members():
+                        yield section, name, self.value()
+                else:
+                    yield section, None, self.value()
+        if self.peek() is not None:
+            raise ValueError("unexpected data after the configuration")
+
+
+def post_config(section: Optional[str] = None, objects: Any = None, headers: Optional[dict] = None,
+                timeout: Optional[float] = None) -> bool:
+    """
+    Imports one batch of a section of the cluster configuration.
+    """
+    r = requests.post(f'{CONF["PROTOCOL"]}://{CONF["ENDPOINT"]}/config/cluster/import',
+                      json={'config': {section: objects}}, headers=headers, stream=True, timeout=timeout,
+                      verify=CONF["VERIFY_CERTIFICATE"])
+    status_code=str(r.status_code)
+    if status_code != '201':
+        print(f"importing {section} failed with code {status_code}: {r.text}")
+        logger.error(f"CONFIG: importing {section} failed with code {status_code}: {r.text}")
+        return False
+    return True
+
+def import_cluster(source: Any = None, total: Optional[int] = None, headers: Optional[dict] = None,
+                   timeout: Optional[float] = None, records: bool = True) -> bool:
+    """
+    Imports a cluster export section by section, in batches of at most CLUSTER_BATCH_SIZE objects,
+    while it is being read. Returns True when every batch got imported. When one fails, what the
+    daemon took before it is reported, as that part stays imported.
+    """
+    progress=Progress('import', 'cluster', total=total, records=records)
+    reader=ConfigReader(MeteredStream(source, progress, 'read', count=True))
+    batch, current, counts, committed, last={}, None, {}, {}, None
+
+    def post(section: Optional[str] = None, objects: Any = None) -> bool:
+        nonlocal last
+        start=monotonic()
+        ret=post_config(section=section, objects=objects, headers=headers, timeout=timeout)
+        progress.timed('daemon', monotonic()-start)
+        if ret:
+            committed[section]=committed.get(section, 0) + (len(objects) if section != 'cluster' else 1)
+            last=(section, list(objects)[-1] if section != 'cluster' and objects else None)
+            return True
+        progress.report(final=True)
+        imported=', '.join(f'{count} {name}' for name, count in committed.items()) or 'nothing'
+        after=f", the last one {last[0]} {last[1]}" if last and last[1] else ""
+        print(f"imported before the failing batch of {len(objects)} {section}: {imported}{after}")
+        logger.error(f"CONFIG: import stopped at a batch of {section}, imported before it: {imported}{after}")
+        return False
+
+    try:
+        for section, name, value in reader.objects():
+            if batch and (section != current or len(batch) >= CLUSTER_BATCH_SIZE):
+                if not post(current, batch):
+                    return False
+                batch={}
+            current=section
+            counts[section]=counts.get(section, 0) + 1
+            if name is None:
+                if not post(section, value):
+                    return False
+            else:
+                batch[name]=value
+        if batch and not post(current, batch):
+            return False
+    except ValueError as exp:
+        progress.report(final=True)
+        print(f"Reading the configuration failed: {exp}")
+        logger.error(f"CONFIG: reading the configuration failed after {counts}: {exp}")
+        return False
+    progress.finish()
+    if not counts:
+        print("STOP :: no configuration found to import")
+        logger.error("CONFIG: STOP :: no configuration found to import")
+        return False
+    logger.info(f"CONFIG: imported {', '.join(f'{count} {section}' for section, count in counts.items())}")
+    return True
+
+def fetch_cluster(headers: Optional[dict] = None, timeout: Optional[float] = None) -> Optional[dict]:
+    """
+    Reads the current cluster export of the daemon into {section: {name: object}}, the cluster
+    section under name None. The response is parsed as it comes in.
+    """
+    r = requests.get(f'{CONF["PROTOCOL"]}://{CONF["ENDPOINT"]}/config/cluster/export',headers=headers, stream=True,
+                     timeout=timeout, verify=CONF["VERIFY_CERTIFICATE"])
+    status_code=str(r.status_code)
+    if status_code != '200':
+        print(f"ERROR :: trouble fetching the current configuration: {r.text}")
+        logger.error(f"CONFIG: fetching the current configuration failed with code {status_code}: {r.text}")
+        return None
+    r.encoding='utf-8'
+    current={}
+    chunks=r.iter_content(chunk_size=CHUNK_SIZE, decode_unicode=True)
+    for section, name, value in ConfigReader(chunks=chunks).objects():
+        current.setdefault(section, {})[name]=value
+    return current
+
+def diff_object(current: Any = None, desired: Any = None) -> dict:
+    """
+    Returns the keys of desired of which the value differs from current. Keys current has
+    and desired lacks are left alone, just like an import does.
+    """
+    if not isinstance(current, dict) or not isinstance(desired, dict):
+        return {None: desired} if current != desired else {}
+    return {key: value for key, value in desired.items() if current.get(key) != value}
+
+def short(value: Any = None) -> str:
+    """
+    Returns the JSON of a value, cut to 60 characters for the diff output.
+    """
+    text=json.dumps(value)
+    return text if len(text) <= 60 else f"{text[:57]}..."
+
+def post_object(section: Optional[str] = None, name: Optional[str] = None, value: Any = None,
+                headers: Optional[dict] = None, timeout: Optional[float] = None) -> Optional[str]:
+    """
+    Updates or adds one object through its own config endpoint. Sections without one
+    go through the import endpoint. Returns None or what went wrong.
+    """
+    if section == 'cluster':
+        url, payload=f'{CONF["PROTOCOL"]}://{CONF["ENDPOINT"]}/config/cluster', {'config': {'cluster': value}}
+    elif section in OBJECT_SECTIONS:
+        url=f'{CONF["PROTOCOL"]}://{CONF["ENDPOINT"]}/config/{section}/{name}'
+        payload={'config': {section: {name: value}}}
+    else:
+        url=f'{CONF["PROTOCOL"]}://{CONF["ENDPOINT"]}/config/cluster/import'
+        payload={'config': {section: value if name is None else {name: value}}}
+    r = requests.post(url, json=payload, headers=headers, stream=True, timeout=timeout,
+                      verify=CONF["VERIFY_CERTIFICATE"])
+    status_code=str(r.status_code)
+    if status_code not in ['200', '201', '204']:
+        return f"code {status_code}: {r.text}"
+    return None
+
+def diff_cluster(source: Any = None, headers: Optional[dict] = None, timeout: Optional[float] = None,
+                 threads: Optional[int] = None, dry_run: bool = False) -> bool:
+    """
+    Compares the configuration in source with what the daemon has, shows the differences and,
+    unless it is a dry run, sends only the objects that changed. Sections are applied in the
+    order of the file, the objects within a section concurrently. Returns True when all went well.
+    """
+    current=fetch_cluster(headers=headers, timeout=timeout)
+    if current is None:
+        return False
+    changes, seen=[], {}
+    try:
+        for section, name, value in ConfigReader(source).objects():
+            seen.setdefault(section, set()).add(name)
+            label=section if name is None else f"{section}/{name}"
+            existing=current.get(section, {})
+            if name is not None and name not in existing:
+                print(f"+ {label}")
+                changes.append((section, name, value))
+                continue
+            differences=diff_object(existing.get(name), value)
+            for key, new in differences.items():
+                old=existing.get(name) if key is None else existing.get(name, {}).get(key)
+                print(f"~ {label}{'' if key is None else '.' + key}: {short(old)} -> {short(new)}")
+            if differences:
+                changes.append((section, name, value))
+    except ValueError as exp:
+        print(f"Reading the configuration failed: {exp}")
+        logger.error(f"CONFIG: reading the configuration failed: {exp}")
+        return False
+    for section, objects in current.items():
+        for name in objects:
+            if name is not None and name not in seen.get(section, set()):
+                print(f"  {section}/{name} is not in the file, left alone")
+    sections={}
+    for section, name, value in changes:
+        sections.setdefault(section, []).append((name, value))
+    print(f"{len(changes)} objects to update{': ' if sections else ''}"
+          f"{', '.join(f'{len(objects)} {section}' for section, objects in sections.items())}")
+    logger.info(f"CONFIG: diff found {len(changes)} changed objects in {', '.join(sections) or 'no sections'}")
+    if dry_run or not changes:
+        return True
+    failed=[]
+    with ThreadPoolExecutor(max_workers=threads or DIFF_WORKERS) as executor:
+        for section, objects in sections.items():
+            jobs={executor.submit(post_object, section, name, value, headers, timeout): name for name, value in objects}
+            for future, name in jobs.items():
+                error=future.result()
+                if error:
+                    label=section if name is None else f"{section}/{name}"
+                    print(f"updating {label} failed with {error}")
+                    logger.error(f"CONFIG: updating {label} failed with {error}")
+                    failed.append(label)
+            if failed:
+                # later sections may depend on this one
                 return False
-            return config, image_file
-        print("tar needs to be installed")
-        logger.error("Tar is missing")
-    return None, None
+    logger.info(f"CONFIG: updated {len(changes)} objects")
+    return True
 
 # ----------------------------------------------------------------------------
 
@@ -32,18 +32,39 @@ __email__       = 'diego.sonaglia@clustervision.com'
 __status__      = 'Development'
 
 
+import os
 import re
 import sys
 import json
+import fcntl
+import threading
+from time import time
 import argparse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from configparser import ConfigParser
+from datetime import datetime, timedelta
+from typing import Iterator, List, Optional
 
 import jwt
 import requests
+from requests.adapters import HTTPAdapter
+from hostlist import expand_hostlist, BadHostlist
 
 
-TOKEN = None
+# the token of this run and the time it expires, None when that could not be read
+TOKEN_CACHE = {'token': None, 'expiry': None}
+TOKEN_REFRESH_MARGIN = 30
 LUNA_CONFIG_PATH = '/trinity/local/luna/utils/config/luna.ini'
+SEL_ARCHIVE_DIR = os.environ.get('LNODE_SEL_ARCHIVE', '/trinity/local/luna/utils/sel')
+DEFAULT_WORKERS = 16
+SEVERITIES = ['info', 'warning', 'critical']
+SEL_CRITICAL = ('uncorrectable', 'critical', 'non-recoverable', 'failure detected', 'ac lost',
+                'power off', 'thermal trip', 'ierr', 'machine check', 'fatal', 'bus error')
+SEL_WARNING = ('correctable', 'predictive failure', 'non-critical', 'going high', 'going low',
+               'redundancy lost', 'redundancy degraded', 'degraded', 'drive fault', 'limit reached')
+SEL_TIME_FORMATS = ['%m/%d/%Y %H:%M:%S', '%m/%d/%Y %I:%M:%S %p', '%Y-%m-%d %H:%M:%S']
+SINCE_UNITS = {'m': 'minutes', 'h': 'hours', 'd': 'days', 'w': 'weeks'}
 requests.packages.urllib3.disable_warnings()
 
 # PENDING DIEGO 15 AUG 2023 -> need to test if sel commands on the backend work
@@ -59,31 +80,186 @@ def print_fatal(msg):
     """Print a fatal error message"""
     print(f'\033[91mFATAL\033[0m: {msg}')
 
+def print_warning(msg):
+    """Print a warning message, on stderr so it stays out of JSON output"""
+    print(f'\033[93mWARNING\033[0m: {msg}', file=sys.stderr)
 
-def get_token(settings):
+
+def sel_mentions(text: str, phrases: tuple) -> bool:
+    """
+    Check if text holds one of the phrases as whole words. A hyphen counts as part of a word,
+    so 'critical' is not found in 'non-critical' and 'correctable' not in 'uncorrectable'.
     """
+    return any(re.search(rf'(?<![\w-]){re.escape(phrase)}(?![\w-])', text) for phrase in phrases)
 
-    This method will fetch a valid token for further use.
 
+def sel_severity(event: str, direction: str) -> str:
+    """
+    Classify a SEL event as info, warning or critical from its description.
+
+    >>> sel_severity('Upper Non-critical going high', 'Asserted')
+    'warning'
+    >>> sel_severity('Upper Non-recoverable going high', 'Asserted')
+    'critical'
+    >>> sel_severity('Uncorrectable ECC', 'Asserted')
+    'critical'
+    """
+    if direction and direction.lower().startswith('deasserted'):
+        return 'info'
+    text = event.lower()
+    if sel_mentions(text, SEL_CRITICAL):
+        return 'critical'
+    if sel_mentions(text, SEL_WARNING):
+        return 'warning'
+    return 'info'
+
+
+def parse_sel_time(date: str, clock: str) -> Optional[datetime]:
+    """
+    Parse the date and time columns of ipmitool sel list/elist into a datetime.
+    Timezone suffixes are ignored, Pre-Init entries return None.
+    """
+    tokens = clock.split()
+    for candidate in [' '.join([date] + tokens[:2]), ' '.join([date] + tokens[:1])]:
+        for time_format in SEL_TIME_FORMATS:
+            try:
+                return datetime.strptime(candidate, time_format)
+            except ValueError:
+                continue
+    return None
+
+
+def parse_sel(text: str) -> list:
+    """
+    Parse SEL text (one ipmitool sel list line per entry) into records.
+    """
+    records = []
+    for line in text.splitlines():
+        fields = [field.strip() for field in line.split('|')]
+        if len(fields) < 5:
+            continue
+        record_id, date, clock, sensor, event = fields[:5]
+        direction = fields[5] if len(fields) > 5 else ''
+        timestamp = parse_sel_time(date, clock)
+        records.append({
+            'id': record_id,
+            'timestamp': timestamp.isoformat() if timestamp else None,
+            'sensor': sensor,
+            'sensor_type': sensor.split('#')[0].strip(),
+            'event': event,
+            'direction': direction,
+            'severity': sel_severity(event, direction),
+            'raw': line,
+        })
+    return records
+
+
+def parse_since(value: Optional[str]) -> Optional[datetime]:
+    """
+    Parse --since as a relative age (30m, 12h, 7d, 2w) or an ISO date/time.
+    """
+    if not value:
+        return None
+    match = re.match(r'^(\d+)([mhdw])$', value.strip())
+    if match:
+        return datetime.now() - timedelta(**{SINCE_UNITS[match.group(2)]: int(match.group(1))})
+    try:
+        since = datetime.fromisoformat(value.strip())
+    except ValueError:
+        print_error(f'--since {value} is not a valid age (30m, 12h, 7d, 2w) or ISO date')
+        sys.exit(1)
+    if since.tzinfo:
+        # SEL times carry no zone and are read as local time, so an offset is converted to local time
+        since = since.astimezone().replace(tzinfo=None)
+    return since
+
+
+def filter_sel(records: list, since: Optional[datetime] = None, sensor: Optional[str] = None,
+               severity: Optional[str] = None) -> list:
+    """
+    Keep the records newer than since, matching the sensor text and at least the given severity.
     """
-    # If there is a token check that is valid and return it
-    if TOKEN is not None:
+    minimum = SEVERITIES.index(severity) if severity else 0
+    sensor = sensor.lower() if sensor else None
+    response = []
+    for record in records:
+        if since and (not record['timestamp'] or datetime.fromisoformat(record['timestamp']) < since):
+            continue
+        if sensor and sensor not in record['sensor'].lower() and sensor not in record['event'].lower():
+            continue
+        if SEVERITIES.index(record['severity']) < minimum:
+            continue
+        response.append(record)
+    return response
+
+
+class SelArchive():
+    '''
+    Local append-only SEL archive, one file per node holding one SEL line per entry.
+    An entry is identified by its full line (record id, time, sensor, event, direction),
+    so record ids reused by the BMC after a clear are still kept apart.
+    '''
+
+    def __init__(self, path: str = SEL_ARCHIVE_DIR) -> None:
+        self._path = path
+
+    def _file(self, node: str) -> str:
+        '''
+        Return the archive file of a node, refusing names that would point outside the archive.
+        '''
+        if not node or os.path.basename(node) != node or node.startswith('.'):
+            raise ValueError(f'Invalid node name for the SEL archive: {node}')
+        return os.path.join(self._path, f'{node}.sel')
+
+    def read(self, node: str) -> str:
+        """
+        Return the archived SEL text of a node, empty when nothing is archived.
+        """
         try:
-            # Try to decode the token to check if it is still valid
-            jwt.decode(TOKEN, settings['API']['SECRET_KEY'], algorithms=['HS256'])
-            return TOKEN
-        except jwt.exceptions.ExpiredSignatureError:
-            # If the token is expired is ok, we fetch a new one
-            pass
+            with open(self._file(node), 'r', encoding='utf-8') as archive:
+                return archive.read()
+        except FileNotFoundError:
+            return ''
+
+    def append(self, node: str, text: str) -> int:
+        """
+        Append the entries of text which are not archived yet and return how many were new.
+        """
+        os.makedirs(self._path, exist_ok=True)
+        with open(self._file(node), 'a+', encoding='utf-8') as archive:
+            fcntl.flock(archive, fcntl.LOCK_EX)
+            archive.seek(0)
+            known = {line.strip() for line in archive}
+            new = []
+            for line in text.splitlines():
+                key = line.strip()
+                if key and '|' in key and key not in known:
+                    known.add(key)
+                    new.append(line.rstrip() + '\n')
+            archive.writelines(new)
+        return len(new)
+
+
+def get_token(settings: ConfigParser, session: Optional[requests.Session] = None) -> str:
+    """
+
+    This method will fetch a valid token for further use.
+    The token is kept in TOKEN_CACHE and reused until shortly before it expires,
+    a token of which the expiry can not be read is fetched again every time.
+
+    """
+    # If there is a token which does not expire soon, return it
+    expiry = TOKEN_CACHE['expiry']
+    if TOKEN_CACHE['token'] is not None and expiry is not None and expiry - time() > TOKEN_REFRESH_MARGIN:
+        return TOKEN_CACHE['token']
 
     # Otherwise just fetch a new one
     data = {'username': settings['API']['USERNAME'], 'password': settings['API']['PASSWORD']}
     daemon_url = f"{settings['API']['PROTOCOL']}://{settings['API']['ENDPOINT']}/token"
     try:
-        response = requests.post(
+        response = (session or requests).post(
             daemon_url,
             json=data,
-            stream=True,
             timeout=3,
             verify=(settings['API']['VERIFY_CERTIFICATE'].lower() == 'true'))
     except requests.exceptions.RequestException as err:
@@ -94,6 +270,13 @@ def get_token(settings):
     except (ValueError, KeyError):
         print_fatal(f'Could not obtain a token from {daemon_url}: {response.text}')
         sys.exit(1)
+    try:
+        # Only the expiry is read, the daemon checks the signature
+        claims = jwt.decode(token, options={'verify_signature': False})
+        TOKEN_CACHE['expiry'] = float(claims['exp'])
+    except (jwt.exceptions.InvalidTokenError, KeyError, TypeError, ValueError):
+        TOKEN_CACHE['expiry'] = None
+    TOKEN_CACHE['token'] = token
     return token
 
 
@@ -102,72 +285,215 @@ class CLI():
     Send SEL commands to luna cluster nodes
     '''
 
-    def __init__(self) -> None:
+    def __init__(self, workers: int = DEFAULT_WORKERS, archive: bool = True) -> None:
         self._configs = ConfigParser()
         self._configs.read(LUNA_CONFIG_PATH)
-        self._token = get_token(self._configs)
+        self._base = f'{self._configs["API"]["PROTOCOL"]}://{self._configs["API"]["ENDPOINT"]}'
+        self._verify = self._configs['API']['VERIFY_CERTIFICATE'].lower() == 'true'
+        self._token_lock = threading.Lock()
+        self._workers = max(int(workers), 1)
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self._workers)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+        self._archive = SelArchive() if archive else None
+
+    def list(self, nodes: str, since: Optional[str] = None, sensor: Optional[str] = None,
+             severity: Optional[str] = None, as_json: bool = False, local: bool = False) -> None:
+        '''
+        list all the SEL entries for one or more nodes
+
+        :param nodes: the node or hostlist to run the command on
+        :param since: only entries newer than this age or date
+        :param sensor: only entries whose sensor or event contains this text
+        :param severity: only entries of at least this severity
+        :param as_json: print the parsed records as JSON
+        :param local: answer from the local SEL archive, without contacting the BMCs
+        '''
+        node_list = self._expand(nodes)
+        structured = as_json or since or sensor or severity
+        since = parse_since(since)
+        response, failed = {}, False
+        for node, ok, message in self._fetch_all(node_list, local):
+            failed = failed or not ok
+            if as_json:
+                response[node] = filter_sel(parse_sel(message), since, sensor, severity) if ok else {'error': message}
+                continue
+            if len(node_list) > 1:
+                print(f'\033[1m==> {node} <==\033[0m')
+            if not ok:
+                print_error(message)
+            elif structured:
+                for record in filter_sel(parse_sel(message), since, sensor, severity):
+                    print(record['raw'])
+            else:
+                print(message)
+            sys.stdout.flush()
+        if as_json:
+            print(json.dumps(response, indent=2))
+        if failed:
+            sys.exit(1)
 
-    def list(self, node):
+    def summary(self, nodes: str, since: Optional[str] = None, sensor: Optional[str] = None,
+                severity: Optional[str] = None, as_json: bool = False, local: bool = False) -> None:
         '''
-        list all the SEL entries for one node
+        count the SEL events per event type across one or more nodes
 
-        :param node: the node to run the command on
+        :param nodes: the node or hostlist to run the command on
         '''
-        is_single_node = re.compile("^([a-zA-Z0-9_]+)$").match(node)
-        if (is_single_node):
-            endpoint = f'{self._configs["API"]["PROTOCOL"]}://{self._configs["API"]["ENDPOINT"]}/control/action/sel/{node}/_list'
-            resp = self._send_request(endpoint, 'GET', None)
+        node_list = self._expand(nodes)
+        since = parse_since(since)
+        counts, node_counts, failed = Counter(), Counter(), {}
+        for node, ok, message in self._fetch_all(node_list, local):
+            if not ok:
+                failed[node] = message
+                continue
+            events = set()
+            for record in filter_sel(parse_sel(message), since, sensor, severity):
+                key = (record['sensor_type'], record['event'], record['severity'])
+                counts[key] += 1
+                events.add(key)
+            node_counts.update(events)
+
+        events = [
+            {'sensor_type': key[0], 'event': key[1], 'severity': key[2], 'count': count, 'nodes': node_counts[key]}
+            for key, count in sorted(counts.items(), key=lambda item: (-SEVERITIES.index(item[0][2]), -item[1]))
+        ]
+        if as_json:
+            print(json.dumps({'nodes': len(node_list), 'failed': failed, 'events': events}, indent=2))
         else:
-            print_error('The list command can only be run on a single node, hostlist not supported')
+            print(f'{"Severity":<9} {"Count":>7} {"Nodes":>6}  Event')
+            for event in events:
+                print(f'{event["severity"]:<9} {event["count"]:>7} {event["nodes"]:>6}  '
+                      f'{event["sensor_type"]}: {event["event"]}')
+            for node, message in failed.items():
+                print_error(f'{node}: {message}')
+        if failed:
             sys.exit(1)
+
+    def _expand(self, nodes: str) -> List[str]:
+        """
+        Expand a hostlist into node names.
+        """
         try:
-            data = json.loads(resp.text)
-            message = data['control']['sel']
-            message = message.replace(';;','\n')
-            print(message)
-        except:
-            print(resp.text)
+            return expand_hostlist(nodes)
+        except BadHostlist:
+            print_error(f'{nodes} is not a valid hostlist')
+            sys.exit(1)
 
+    def _fetch_all(self, node_list: list, local: bool = False, strict: bool = False) -> Iterator[tuple]:
+        """
+        Fetch the SEL of the nodes concurrently and yield (node, ok, message) as each finishes.
+        With local the SEL is read from the archive instead, with strict a node fails when archiving fails.
+        """
+        if local:
+            archive = self._archive or SelArchive()
+            for node in node_list:
+                yield node, True, archive.read(node)
+            return
+        with ThreadPoolExecutor(max_workers=max(1, min(self._workers, len(node_list)))) as executor:
+            futures = [executor.submit(self._fetch_sel, node, strict) for node in node_list]
+            for future in as_completed(futures):
+                yield future.result()
+
+    def _sel_list_endpoint(self, node: str) -> str:
+        """
+        Return the daemon endpoint listing the SEL of a node.
+        """
+        return f'{self._base}/control/action/sel/{node}/_list'
+
+    def _sel_message(self, text: str) -> str:
+        """
+        Return the SEL entries of a daemon response, one per line.
+        """
+        try:
+            data = json.loads(text)
+            message = data['control']['sel']
+            return message.replace(';;','\n')
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return text
 
-    def clear(self, nodes):
+    def _fetch_sel(self, node: str, strict: bool = False) -> tuple:
+        """
+        Fetch the SEL of one node inside a worker thread.
+        Errors are returned instead of exiting, so one node does not stop the others.
+        A SEL that cannot be archived is only a warning, unless strict asks for the archive.
+        """
+        try:
+            resp = self._request(self._sel_list_endpoint(node), 'GET', None)
+        except requests.exceptions.RequestException as err:
+            return node, False, str(err)
+        if resp.status_code not in [200, 201, 202, 204]:
+            return node, False, f'Failed to run command: {resp.text}'
+        message = self._sel_message(resp.text)
+        if self._archive:
+            try:
+                self._archive.append(node, message)
+            except (OSError, ValueError) as err:
+                if strict:
+                    return node, False, f'Could not archive the SEL: {err}'
+                print_warning(f'{node}: could not archive the SEL: {err}')
+        return node, True, message
+
+
+    def clear(self, nodes: str) -> None:
         '''
         clear all the SEL entries for one or more nodes
 
         :param nodes: the node(s) to run the command on
         '''
+        if self._archive:
+            failed = [f'{node}: {message}' for node, ok, message in self._fetch_all(self._expand(nodes), strict=True)
+                      if not ok]
+            if failed:
+                print_error('Not clearing, the SEL could not be archived for ' + '; '.join(failed))
+                sys.exit(1)
         is_single_node = re.compile("^([a-zA-Z0-9_]+)$").match(nodes)
         if (is_single_node):
-            endpoint = f'{self._configs["API"]["PROTOCOL"]}://{self._configs["API"]["ENDPOINT"]}/control/action/sel/{nodes}/_clear'
+            endpoint = f'{self._base}/control/action/sel/{nodes}/_clear'
             method = 'GET'
             data = None
         else:
-            endpoint = f'{self._configs["API"]["PROTOCOL"]}://{self._configs["API"]["ENDPOINT"]}/control/action/sel/_clear'
+            endpoint = f'{self._base}/control/action/sel/_clear'
             method = 'POST'
             data = {'control': { 'sel': { 'clear': { 'hostlist': nodes } } } }
         resp = self._send_request(endpoint, method, data)
         print(resp.text)
 
 
-    def _send_request(self, endpoint, method, data):
+    def _headers(self) -> dict:
+        """
+        Return the request headers with the cached token, shared by all worker threads.
+        """
+        with self._token_lock:
+            return {'x-access-tokens': get_token(self._configs, self._session)}
+
+    def _request(self, endpoint: str, method: str, data: Optional[dict]) -> requests.Response:
+        """
+        This method will send the request over the shared session.
+        """
+        if method == 'GET':
+            return self._session.get(endpoint,
+                                     headers=self._headers(),
+                                     timeout=30,
+                                     verify=self._verify)
+        if method == 'POST':
+            return self._session.post(endpoint,
+                                      headers=self._headers(),
+                                      timeout=30,
+                                      verify=self._verify, json=data)
+        raise ValueError(f'Invalid method: {method}')
+
+    def _send_request(self, endpoint: str, method: str, data: Optional[dict]) -> requests.Response:
         """
         This method will send the request.
         """
-        headers = {'x-access-tokens': f'{self._token}'}
         valid_codes = [200, 201, 202, 204]
-        if method == 'GET':
-            resp = requests.get(endpoint,
-                                headers=headers,
-                                stream=True,
-                                timeout=30,
-                                verify=(self._configs['API']['VERIFY_CERTIFICATE'].lower() == 'true'))
-        elif method == 'POST':
-            resp = requests.post(endpoint,
-                                headers=headers,
-                                stream=True,
-                                timeout=30,
-                                verify=(self._configs['API']['VERIFY_CERTIFICATE'].lower() == 'true'), json=data)
-        else:
-            raise ValueError(f'Invalid method: {method}')
+        try:
+            resp = self._request(endpoint, method, data)
+        except requests.exceptions.RequestException as err:
+            print_fatal(f'Unable to reach {endpoint}: {err}')
+            sys.exit(1)
         if resp.status_code not in valid_codes:
             print_error(f'Failed to run command: {resp.text}')
             sys.exit(1)
@@ -175,28 +501,48 @@ class CLI():
         return resp
 
 
-def main():
+def main() -> None:
     """
     The Main method to initiate the script.
     """
-    usage = '%(prog)s {list,clear} <host|hostlist>'
+    usage = '%(prog)s {list,summary,clear} <host|hostlist>'
     parser = argparse.ArgumentParser(description='Luna SEL commands', usage=usage)
     
     subparsers = parser.add_subparsers(help='sub-command help', dest='command')
 
-    parser_list = subparsers.add_parser('list', help='list all the SEL entries for one node')
-    parser_list.add_argument('node', help='the node to run the command on')
+    parser_list = subparsers.add_parser('list', help='list all the SEL entries for one or more nodes')
+    parser_list.add_argument('nodes', help='the node(s) to run the command on')
+
+    parser_summary = subparsers.add_parser('summary', help='count the SEL events per event type across nodes')
+    parser_summary.add_argument('nodes', help='the node(s) to run the command on')
 
-    parser_clear = subparsers.add_parser('clear', help='clear all the SEL entries for one or more nodes')
+    parser_clear = subparsers.add_parser('clear', help='archive, then clear all the SEL entries for one or more nodes')
     parser_clear.add_argument('nodes', help='the node(s) to run the command on')
 
+    for sub in [parser_list, parser_summary]:
+        sub.add_argument('-w', '--workers', type=int, default=DEFAULT_WORKERS,
+                         help=f'number of nodes fetched concurrently (default {DEFAULT_WORKERS})')
+        sub.add_argument('--since', help='only entries newer than an age (30m, 12h, 7d, 2w) or ISO date')
+        sub.add_argument('--sensor', help='only entries whose sensor or event contains this text, e.g. ECC')
+        sub.add_argument('--severity', choices=SEVERITIES, help='only entries of at least this severity')
+        sub.add_argument('--json', action='store_true', help='JSON output')
+        sub.add_argument('--local', action='store_true',
+                         help=f'answer from the local SEL archive ({SEL_ARCHIVE_DIR}) without contacting the BMCs')
+
+    for sub in [parser_list, parser_summary, parser_clear]:
+        sub.add_argument('--no-archive', dest='archive', action='store_false',
+                         help='do not store the fetched SEL entries in the local archive')
+
     args = parser.parse_args()
 
     if args.command == 'list':
-        cli = CLI()
-        cli.list(args.node)
+        cli = CLI(args.workers, args.archive)
+        cli.list(args.nodes, args.since, args.sensor, args.severity, args.json, args.local)
+    elif args.command == 'summary':
+        cli = CLI(args.workers, args.archive)
+        cli.summary(args.nodes, args.since, args.sensor, args.severity, args.json, args.local)
     elif args.command == 'clear':
-        cli = CLI()
+        cli = CLI(archive=args.archive)
         cli.clear(args.nodes)
     else:
         parser.print_help()
@@ -33,9 +33,35 @@ __status__      = "Development"
 
 import os
 import sys
+import socket
+import argparse
 import platform
 import subprocess
+from time import monotonic
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Optional
+import requests
 from termcolor import colored
+from hostlist import expand_hostlist, BadHostlist
+from utils.utils.ini import Ini
+from utils.utils.token import Token
+
+LUNA_INI = '/trinity/local/luna/utils/config/luna.ini'
+DEFAULT_WORKERS = 16
+SSH_TIMEOUT = 10
+CONTROLLER_SERVICES = {
+    "Trinity Core": ["chronyd", "named", "dhcpd", "mariadb", "nfs-server", "nginx"],
+    "Luna": ["luna2-daemon", "aria2c"],
+    "LDAP": ["slapd", "sssd"],
+    "Slurm": ["slurmctld"],
+    "Monitoring core": ["grafana-server", "prometheus-server"],
+    "Trinity OOD": ["httpd", "apache2"]
+}
+NODE_SERVICES = {
+    "Trinity Core": ["chronyd"],
+    "LDAP": ["sssd"],
+    "Slurm": ["slurmd", "munge"]
+}
 
 
 class Diagnosis():
@@ -43,12 +69,15 @@ class Diagnosis():
     Diagnosis Class responsible to check the things related to trinity.
     """
 
-    def __init__(self):
+    def __init__(self, host: Optional[str] = None, role: str = 'controller') -> None:
         """
         Default variables should be here before calling the any method.
+        host is None for the local machine, otherwise the services are queried over SSH.
         """
         self.os_info = {}
         self.controller = False
+        self.host = host
+        self.role = role
 
 
     def check_controller(self):
@@ -76,37 +105,116 @@ class Diagnosis():
         return self.os_info
 
 
-    def trinity_status(self, command=None):
+    def services_status(self, services: Optional[list] = None) -> dict:
         """
-        This method will retrieve the value from the INI
+        This method will query the state of all services with one systemctl call, without a shell.
+        Returns a dictionary of service name to (status, response).
         """
-        self.check_controller()
-        if self.controller is False:
-            self.exit_diagnosis('Trinity Diagnosis is only Available from the Controller OR Luna2 Daemon is not present.')
-        response = ''
-        status = True
-        with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True) as process:
-            output, error = process.communicate()
-            output = output.decode("utf-8")  if output else ''
-            status = False if error else True
-            error = error.decode("utf-8")  if error else ''
-            response = output if output else error
-            response = response.replace('\n', '')
-            response = response.replace('Active:', '')
-            response = response.replace('inactive', colored('inactive', 'red', attrs=['bold', 'dark']))
-            response = response.replace('(dead)', colored('(dead)', 'red', attrs=['bold']))
-            if 'active (running)' in response:
-                response = response.replace('active', colored('active', 'green', attrs=['bold', 'dark']))
-                response = response.replace('(running)', colored('(running)', 'green', attrs=['bold']))
-            if '(exited)' in response:
-                response = response.replace('active', colored('active', 'green', attrs=['bold', 'dark']))
-                response = response.replace('(exited)', colored('(exited)', 'green', attrs=['bold']))
-            response = response.replace('could not be found', colored('could not be found', 'yellow', attrs=['bold']))
-            response = response.strip()
+        if self.host is None and self.role == 'controller':
+            self.check_controller()
+            if self.controller is False:
+                self.exit_diagnosis('Trinity Diagnosis is only Available from the Controller '
+                                    'OR Luna2 Daemon is not present.')
+        services = list(services or [])
+        units = [f'{service}.service' for service in services]
+        command = ['systemctl', 'show', '--property=Id,LoadState,ActiveState,SubState,ActiveEnterTimestamp'] + units
+        if self.host is not None:
+            command = ['ssh', '-o', 'BatchMode=yes', '-o', f'ConnectTimeout={SSH_TIMEOUT}', self.host] + command
+        try:
+            process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
+        except OSError as exp:
+            if self.host is None:
+                self.exit_diagnosis(f'Unable to run systemctl: {exp}')
+            return self.unreachable(services, str(exp))
+        output = process.stdout
+        if self.host is not None and process.returncode == 255:
+            return self.unreachable(services, process.stderr.decode('utf-8').strip())
+        properties = self.parse_properties(output.decode('utf-8') if output else '')
+        response = {}
+        for service, unit in zip(services, units):
+            response[service] = self.format_status(unit, properties.get(unit, {}))
+        return response
 
+
+    def unreachable(self, services: Optional[list] = None, error: Optional[str] = None) -> dict:
+        """
+        This method will mark all services of a host which could not be reached.
+        """
+        message = f"{colored('unreachable', 'red', attrs=['bold'])} {error or ''}".strip()
+        return {service: (False, message) for service in services}
+
+
+    def report(self) -> tuple:
+        """
+        This method will collect the services of this host in one batched query and
+        returns the overall status and the report grouped per category.
+        """
+        categories = CONTROLLER_SERVICES if self.role == 'controller' else NODE_SERVICES
+        services = [service for value in categories.values() for service in value]
+        states = self.services_status(services)
+        status = True
+        response = {}
+        for key, value in categories.items():
+            if key == 'Trinity OOD':
+                value = [self.ood_service(states)]
+            response[key] = {}
+            for service in value:
+                ret, response[key][service] = states[service]
+                if not ret:
+                    status = False
         return status, response
 
 
+    def ood_service(self, states: Optional[dict] = None) -> str:
+        """
+        This method will pick the web server used by OOD, apache2 on Debian and httpd elsewhere.
+        """
+        for service in ['httpd', 'apache2']:
+            if states[service][0]:
+                return service
+        if self.host is None:
+            for _, os_value in self.platform_info().items():
+                if 'debian' in os_value.lower() or 'ubuntu' in os_value.lower():
+                    return 'apache2'
+        return 'httpd'
+
+
+    def parse_properties(self, output: Optional[str] = None) -> dict:
+        """
+        This method will parse the property blocks of systemctl show into a dictionary per unit.
+        """
+        response = {}
+        for block in output.split('\n\n'):
+            unit = {}
+            for line in block.splitlines():
+                key, _, value = line.partition('=')
+                unit[key] = value
+            if unit.get('Id'):
+                response[unit['Id']] = unit
+        return response
+
+
+    def format_status(self, unit: Optional[str] = None, properties: Optional[dict] = None) -> tuple:
+        """
+        This method will render the state of one unit the way systemctl status shows it.
+        """
+        if not properties or properties.get('LoadState') == 'not-found':
+            return False, f"Unit {unit} {colored('could not be found', 'yellow', attrs=['bold'])}."
+        active = properties.get('ActiveState', '')
+        sub = properties.get('SubState', '')
+        if active == 'active':
+            response = (f"{colored(active, 'green', attrs=['bold', 'dark'])} "
+                        f"{colored(f'({sub})', 'green', attrs=['bold'])}")
+        elif active in ['inactive', 'failed']:
+            response = f"{colored(active, 'red', attrs=['bold', 'dark'])} {colored(f'({sub})', 'red', attrs=['bold'])}"
+        else:
+            response = f'{active} ({sub})'
+        since = properties.get('ActiveEnterTimestamp')
+        if since and active == 'active':
+            response = f'{response} since {since}'
+        return True, response
+
+
     def execute(self, command=None):
         """
         This method will retrieve the value from the INI
@@ -125,38 +233,96 @@ class Diagnosis():
         sys.exit(1)
 
 
-def main():
+def get_controllers() -> list:
     """
-    This main method will initiate the script for pip installation.
+    This method will fetch the controllers of the HA setup from the Luna2 daemon.
+    """
+    conf = Ini.read_ini(ini_file=LUNA_INI)
+    token = Token.get_token(username=conf['USERNAME'], password=conf['PASSWORD'], protocol=conf["PROTOCOL"],
+                            endpoint=conf["ENDPOINT"], verify_certificate=conf["VERIFY_CERTIFICATE"])
+    url = f'{conf["PROTOCOL"]}://{conf["ENDPOINT"]}/ha/controllers'
+    try:
+        response = requests.get(url, headers={'x-access-tokens': token}, verify=conf["VERIFY_CERTIFICATE"],
+                                timeout=SSH_TIMEOUT)
+        message = response.json().get('message') if response.ok else None
+    except (requests.exceptions.RequestException, ValueError) as exp:
+        Diagnosis().exit_diagnosis(f'Unable to fetch the controllers from {url}: {exp}')
+    if not isinstance(message, dict):
+        Diagnosis().exit_diagnosis(f'Unable to fetch the controllers from {url}: HTTP {response.status_code}')
+    return list(message.keys())
+
+
+def diagnose(host: Optional[str] = None, role: str = 'controller') -> tuple:
+    """
+    This method will run the diagnosis for one host and time it.
+    """
+    start = monotonic()
+    status, response = Diagnosis(host=host, role=role).report()
+    return status, response, monotonic() - start
+
+
+def print_report(response: Optional[dict] = None, indent: str = '') -> None:
+    """
+    This method will print the services of one host grouped per category.
     """
-    response = {
-        "Trinity Core": {"chronyd": None, "named": None, "dhcpd": None, "mariadb": None, "nfs-server": None, "nginx": None},
-        "Luna": {"luna2-daemon": None, "aria2c": None},
-        "LDAP": {"slapd": None, "sssd": None},
-        "Slurm": {"slurmctld": None, },
-        "Monitoring core": {"grafana-server": None, "prometheus-server": None},
-        "Trinity OOD": {}
-    }
-    debian = False
-    status = True
-    os_info = Diagnosis().platform_info()
-    for _, os_value in os_info.items():
-        if 'debian' in os_value.lower() or 'ubuntu' in os_value.lower():
-            debian = True
-    if debian is True:
-        response["Trinity OOD"]["apache2"] = None
-    else:
-        response["Trinity OOD"]["httpd"] = None
-    for key, value in response.items():
-        for service, val in value.items():
-            ret, response[key][service] = Diagnosis().trinity_status(f"systemctl status {service}.service | grep Active:")
-            if not ret:
-                status = False
     for key, value in response.items():
-        print(colored(key, 'grey', attrs=['bold']))
+        print(indent + colored(key, 'grey', attrs=['bold']))
         for service, val in value.items():
-            print(f'\t{service}: {val}')
+            print(f'{indent}\t{service}: {val}')
         print('\n')
+
+
+def main() -> None:
+    """
+    This main method will initiate the script for pip installation.
+    """
+    parser = argparse.ArgumentParser(prog='trix-diag', description='Check the status of the Trinity services.')
+    parser.add_argument('-a', '--all', action='store_true', help='diagnose all controllers of the HA setup')
+    parser.add_argument('-n', '--nodes', metavar='HOSTLIST', help='also diagnose the nodes in the hostlist over SSH')
+    parser.add_argument('-w', '--workers', type=int, default=DEFAULT_WORKERS,
+                        help=f'number of hosts diagnosed in parallel (default: {DEFAULT_WORKERS})')
+    args = parser.parse_args()
+
+    if not args.all and not args.nodes:
+        status, response, _ = diagnose()
+        print_report(response)
+        if status:
+            sys.exit(0)
+        sys.exit(1)
+
+    local = socket.gethostname().split('.')[0]
+    targets = []
+    if args.all:
+        for controller in get_controllers():
+            host = None if controller.split('.')[0] == local else controller
+            targets.append((controller, host, 'controller'))
+    else:
+        targets.append((local, None, 'controller'))
+    if args.nodes:
+        try:
+            nodes = expand_hostlist(args.nodes)
+        except BadHostlist as exp:
+            Diagnosis().exit_diagnosis(f'Invalid hostlist {args.nodes}: {exp}')
+        targets.extend((node, node, 'node') for node in nodes)
+
+    start = monotonic()
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        futures = {executor.submit(diagnose, host, role): name for name, host, role in targets}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+    elapsed = monotonic() - start
+
+    status = True
+    for name, _, role in targets:
+        ret, response, duration = results[name]
+        status = status and ret
+        print(colored(f'{name} ({role}, {duration:.2f}s)', 'cyan', attrs=['bold']))
+        print_report(response, '\t')
+    print(colored('Timing', 'grey', attrs=['bold']))
+    for name, _, _ in sorted(targets, key=lambda target: results[target[0]][2], reverse=True):
+        print(f'\t{name}: {results[name][2]:.2f}s')
+    print(f'\ttotal: {elapsed:.2f}s for {len(targets)} hosts')
     if status:
         exit(0)
     exit(1)